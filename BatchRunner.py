@@ -0,0 +1,164 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from Metrics import percentile
+
+
+class Batch:
+    '''
+    A batch started by the batch runner, and what has come back of it so far
+    '''
+    def __init__(self, batch_id: int, items: int, sessions: int, on_result, on_done):
+        self.id = batch_id
+        self.items = items
+        self.on_result = on_result
+        self.on_done = on_done
+
+        #sessions whose messages have not all been sent yet
+        self.remaining = sessions
+        self.sessions = sessions
+        self.latencies = []
+        self.failed = 0
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+
+class BatchRunner:
+    '''
+    Batch Runner class
+
+    Sends batches of (uuid, message) items, e.g. a suite of prompts, on a bounded pool of workers shared by every batch.
+    The messages to one chat are sent in the order they appear in the batch, one turn after another; different chats run at the same time,
+    at most max_workers of them. Each item's result is handed back as soon as its turn is over, and the batch's throughput once every item is.
+
+    Attributes:
+        session_store (SessionStore): Where the chats are looked up, and saved once their messages have been sent
+        max_workers (int): The number of chats that may run a batch's messages at once, across every batch
+
+    Methods:
+        run(self, items: list, on_result = None, on_done = None):
+        Starts sending the items in the background, returns the batch's id
+        report(self):
+        Returns the number of batches and items sent, and the throughput of the last batch
+    '''
+    def __init__(self, session_store, max_workers: int = 8):
+        '''
+        Constructor for the BatchRunner class
+        '''
+        self.session_store = session_store
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        self.counters = {
+            "batches": 0,
+            "batches_running": 0,
+            "items": 0,
+            "items_failed": 0,
+        }
+        #of the last batch that finished
+        self.last_batch = {"items_per_second": 0.0, "seconds": 0.0, "latency_p50": 0.0, "latency_p95": 0.0}
+        self.batch_ids = 0
+        self.lock = threading.Lock()
+
+    def run(self, items: list, on_result = None, on_done = None):
+        '''
+        Starts sending the {"uuid", "message"} items and returns the batch's id.
+        on_result is called with {"index", "uuid", "seconds"} and the item's "gpt_response" and "interpreter_output", or its "error",
+        as soon as each item's turn is over; on_done with the batch's stats once every item's is.
+        '''
+        #the items of each chat, in order, as (index in the batch, message)
+        sessions = {}
+        for index, item in enumerate(items):
+            sessions.setdefault(item["uuid"], []).append((index, item["message"]))
+
+        with self.lock:
+            self.batch_ids += 1
+            self.counters["batches"] += 1
+            self.counters["batches_running"] += 1
+            batch = Batch(self.batch_ids, len(items), len(sessions), on_result, on_done)
+
+        for uuid, entries in sessions.items():
+            self.executor.submit(self.run_session, batch, uuid, entries)
+        return batch.id
+
+    def run_session(self, batch: Batch, uuid: str, entries: list):
+        '''
+        Sends one chat's messages of the batch in order, then saves the chat
+        '''
+        #positions in entries whose result has been handed back
+        reported = set()
+
+        def on_result(position: int, result: dict):
+            reported.add(position)
+            self.add_result(batch, uuid, entries[position][0], result)
+
+        error = "No chat with this uuid."
+        try:
+            assistant = self.session_store.get(uuid)
+            if assistant is not None:
+                assistant.send_batch([message for _, message in entries], on_result)
+                #unless the chat was deleted meanwhile
+                if self.session_store.get(uuid) is assistant:
+                    self.session_store.save(uuid, assistant)
+        except Exception as exception:
+            print(f"Batch {batch.id} failed for {uuid}: {exception}")
+            error = str(exception)
+        finally:
+            #every item gets a result, also when the chat is gone or its turns could not be sent
+            for position in range(len(entries)):
+                if position not in reported:
+                    on_result(position, {"error": error, "seconds": 0.0})
+            self.session_done(batch)
+
+    def add_result(self, batch: Batch, uuid: str, index: int, result: dict):
+        failed = "error" in result
+        with batch.lock:
+            batch.latencies.append(result["seconds"])
+            batch.failed += failed
+        with self.lock:
+            self.counters["items"] += 1
+            self.counters["items_failed"] += failed
+        if batch.on_result is not None:
+            try:
+                batch.on_result({"index": index, "uuid": uuid, **result})
+            except Exception as error:
+                print(f"Batch {batch.id} result callback failed: {error}")
+
+    def session_done(self, batch: Batch):
+        '''
+        Reports the batch's stats once the last of its chats is done
+        '''
+        with batch.lock:
+            batch.remaining -= 1
+            if batch.remaining:
+                return
+            seconds = time.perf_counter() - batch.started
+            latencies = list(batch.latencies)
+            stats = {
+                "batch_id": batch.id,
+                "items": batch.items,
+                "succeeded": len(latencies) - batch.failed,
+                "failed": batch.failed,
+                "sessions": batch.sessions,
+                "seconds": seconds,
+                "items_per_second": len(latencies) / seconds if seconds else 0.0,
+                "latency_mean": sum(latencies) / len(latencies) if latencies else 0.0,
+                "latency_p50": percentile(latencies, 50),
+                "latency_p95": percentile(latencies, 95),
+            }
+
+        with self.lock:
+            self.counters["batches_running"] -= 1
+            self.last_batch = {name: stats[name] for name in self.last_batch}
+        if batch.on_done is not None:
+            try:
+                batch.on_done(stats)
+            except Exception as error:
+                print(f"Batch {batch.id} done callback failed: {error}")
+
+    def report(self):
+        '''
+        Returns the number of batches and items sent and failed, and the throughput and latencies of the last batch that finished
+        '''
+        with self.lock:
+            return {**self.counters, **{f"last_batch_{name}": value for name, value in self.last_batch.items()}}
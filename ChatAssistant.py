@@ -1,28 +1,26 @@
 import os
-import re
-import sys
-from io import StringIO
+import time
 import shutil
+import threading
+import weakref
 import openai
-import multiprocessing
-import json
-import base64
-import tempfile
-# KYLE : : :  : pip install nbformat nbclient, used for executing code in the notebook
-import nbformat
-from nbclient import NotebookClient
-from nbconvert.preprocessors import ExecutePreprocessor
-from nbformat.v4 import new_notebook, new_code_cell, new_markdown_cell
-from io import BytesIO
-from PIL import Image
-import requests
-# # KYLE : : :  : pip install tiktoken #Not implemented yet
-# import tiktoken #OpenAI package: Used for checking number of tokens in a string, 
+from globals import session_store, kernel_pool, job_manager, context_router, completion_check, sandbox_manager, image_store, pipeline_executor, metrics, openai_client
+from ContextRouter import classify_remotely
+from ConversationHistory import ConversationHistory
+from ExecutionLog import ExecutionLog
+from OutputCollector import OutputCollector
+from Pipeline import TokenBuffer
+from CodeBlocks import ResponseParser, extract_code_blocks, independent_blocks
+from concurrent.futures import ThreadPoolExecutor
 # # KYLE : : :  : pip install docker #Not implemented yet
 # import docker
 # import tarfile
 # import io
 
+#the newest ChatAssistant of each chat in this process, which owns the chat's kernel and sandbox
+#an older one for the same uuid (evicted from a cache, or deleted and created again) must not tear them down when it is destroyed
+owners = weakref.WeakValueDictionary()
+
 
 class ChatAssistant:
     '''
@@ -36,7 +34,7 @@ class ChatAssistant:
         previous_model (str): The model that was used to generate the previous message
         
     Methods:
-        contextClassifier(self, most_recent_message: str, retries: int = 0):
+        contextClassifier(self, most_recent_message: str):
         Selects the best prompt for the model to use based on the most recent message
     '''
     def __init__(self, openai_api_key: str, uuid: str = ""):
@@ -44,175 +42,331 @@ class ChatAssistant:
         Constructor for the ChatAssistant class
         '''
         
-        openai.api_key = openai_api_key
         self.api_key = openai_api_key # The OpenAI API key to use
+        #every call this chat makes goes out with its own key, the module-level openai.api_key is never set as it is shared by every chat
+        self.client = openai_client.for_key(openai_api_key)
 
-        self.messages = [
+        #the history keeps a running token count and is trimmed to its token budget before each request
+        self.messages = ConversationHistory([
             {"role": "system", "content": "You are Babbage, an experimental AI system with the added capability of a built in python code compiler, access to local files uploaded to you, internet access, the ability to create images through dall-e, and recursive problem solving (by using your ability to send multiple responses, before presenting the final answer to a user). Answer as concisely as possible. To execute code, simply write your python program within code snippets. The interpreter will then send a message to you with the output of your program. You should explain the output and/or finish your problem solving using it in the next message. You have access to your local file system, but you must use code to view and interact with it. You have to ability to solve problems recursively. Use python programs for any problem if they are applicable, such as searching the web with googlesearch. You must use print statements to see the output. When given a file, write a python script to attempt to interpret it. You can open any type of file as long as you use the appropriate library. If the user asks you to use OCR to identify an image, use pytesseract and set the tesseract path to C:\Program Files\Tesseract-OCR\tesseract.exe"},
-        ]
+        ])
 
         self.previous_model = "standard"
 
         self.uuid = uuid
 
-        #Create a notebook for the chat assistant to use, with the given UUID
-        self.notebook = self.create_notebook(uuid)
+        #Record of the code the chat runs and its outputs, exported as a notebook on demand
+        self.execution_log = ExecutionLog(f"notebook_{uuid}.jsonl", f"# Notebook for ChatAssistant {uuid}")
 
         #List of files that have been uploaded to the chat assistant
         self.file_list = []
 
         #used for keeping track of the number of times the problem has been run recursively
         self.recursionAttempts = 0
+
+        #held while a turn runs so concurrent requests for the same chat do not interleave, re-entered by recursive attempts
+        self.lock = threading.RLock()
+
+        #whether the chat's files are kept when this object is destroyed, set when a shared session store owns the chat
+        self.keep_files = False
+
+        #when the chat last received a message or a file, read by the session reaper
+        self.last_activity = time.monotonic()
+
+        #set once close() and release() have run, each only runs once
+        self.closed = False
+        self.released = False
+
+        #run code blocks that share no variables with the rest of a response in their own kernels at the same time as the others
+        #off by default: names those blocks define are not kept in the chat's kernel for later messages
+        self.parallel_code_blocks = False
+
+        #start the standard prompt's response while the router asks the remote classifier, and use it if the route turns out to be standard
+        #only done when the remote classifier is asked, the local classifier decides long before a response could arrive
+        self.speculative_routing = True
+
+        #take a pre-started kernel from the pool so the first execution does not wait on a cold start
+        kernel_pool.assign(uuid)
+        owners[uuid] = self
         
 
 
-    def create_notebook(self, uuid: str):
+    def set_api_key(self, openai_api_key: str):
         '''
-        Creates an IPython notebook with the given UUID.
+        Changes the OpenAI API key the chat's calls are made with
         '''
-        notebook = new_notebook()
-        notebook.cells.append(new_markdown_cell(f"# Notebook for ChatAssistant {uuid}"))
+        self.api_key = openai_api_key
+        self.client = openai_client.for_key(openai_api_key)
 
-        file_path = f"notebook_{uuid}.ipynb"
-        with open(file_path, 'w', encoding='utf-8') as f:
-            nbformat.write(notebook, f)
+    def get_state(self):
+        '''
+        Returns the chat state that is saved by a session store
+        '''
+        return {
+            "messages": self.messages.payload(),
+            "file_list": list(self.file_list),
+            "previous_model": self.previous_model,
+            "recursionAttempts": self.recursionAttempts,
+        }
+
+    def set_state(self, state: dict):
+        '''
+        Restores chat state saved by get_state
+        '''
+        self.messages = ConversationHistory(state["messages"])
+        self.file_list = state["file_list"]
+        self.previous_model = state["previous_model"]
+        self.recursionAttempts = state["recursionAttempts"]
 
-        return file_path
+    def export_notebook(self):
+        '''
+        Writes the code the chat has run, and its outputs, to notebook_{uuid}.ipynb and returns the path
+        '''
+        return self.execution_log.export(f"notebook_{self.uuid}.ipynb")
     
-    def send_code_to_interpreter(self, code: str, timeout: int = 60):
+    def send_code_to_interpreter(self, code: str, timeout: int = 60, max_chars: int = 1000, kernel_id: str = None):
         """
-        Executes the code in the IPython notebook.
-        Temporarily copies the notebook to a sandboxed directory to prevent the code from accessing other files.
-        Temporarily copies all "files" from the notebook to the sandboxed directory to prevent the code from accessing the user's files.
+        Executes the code, recording it and its outputs in the chat's execution log.
+        The code runs in a kernel kept alive by the kernel pool, so variables and imports persist between messages.
+        Runs the code in the chat's sandboxed directory to prevent the code from accessing other files.
+        Uploaded "files" are copied into the sandbox once, the sandbox is reused for every execution and deleted with the chat.
         Limits the execution time of the code to prevent it from running indefinitely.
-        Limits the amount of text that the code can pass to the model to prevent it from running out of tokens.
+        Code in the chat's own kernel that is still running after the job manager's threshold is moved to a background job with the job manager's timeout,
+        and a message with the job's id is returned at once; the job's output is added to the chat's messages when it finishes.
+        If no background slot is free the code is interrupted after timeout seconds as usual.
+        Limits the amount of output the code can produce, interrupting it once it passes the cap, and the amount of text passed to the model,
+        keeping the start and end of the output, to prevent it from running out of tokens.
+        Images the code displays are saved to the sandbox's outputs folder and passed to the model as references.
+        kernel_id runs the code in a kernel other than the chat's own, e.g. for parallel code blocks.
+        Returns {"result": text for the model, "status": "ok", "error", "timeout", "capped", "background" or "busy"}, with "job_id" for the last two
         """
-
-        # Store the original working directory
-        original_working_directory = os.getcwd()
-
-        # Create a safe and isolated working directory
-        safe_working_directory = tempfile.mkdtemp()
+        kernel_id = kernel_id or self.uuid
 
         #if code contains os.chdir, return error. This is to prevent the user from changing the directory of the interpreter
         if "os.chdir" in code:
             response = {
-                        "result": "You are not allowed to change the directory of the interpreter."
+                        "result": "You are not allowed to change the directory of the interpreter.",
+                        "status": "error"
                     }
             return response
         if "os.pardir" in code:
             response = {
-                        "result": "You are not allowed to change the directory of the interpreter."
+                        "result": "You are not allowed to change the directory of the interpreter.",
+                        "status": "error"
                     }
             return response
         #This is still a major security risk, as the user can still change the directory of the interpreter by encoding it in base64 and then decoding it in the interpreter
 
-        try:
-            # Copy the IPython notebook file to the safe directory
-            notebook_filename = os.path.basename(self.notebook)
-            notebook_temp_path = os.path.join(safe_working_directory, notebook_filename)
-            shutil.copy(self.notebook, notebook_temp_path)
+        # The chat's kernel is still busy with a background job, the code would only queue behind it
+        if kernel_id == self.uuid:
+            running = job_manager.active(self.uuid)
+            if running:
+                response = {
+                    "result": f"The interpreter is still running background job {running[0].id}. Its output will be sent in a later message when it finishes, do not run more code until then.",
+                    "status": "busy",
+                    "job_id": running[0].id
+                }
+                return response
 
-            # Read the notebook
-            with open(notebook_temp_path, 'r', encoding='utf-8') as f:
-                notebook = nbformat.read(f, nbformat.NO_CONVERT)
+        # Get the chat's sandboxed working directory, linking in any files uploaded since the last execution
+        with metrics.span("file_staging"):
+            safe_working_directory = sandbox_manager.prepare(self.uuid, self.file_list)
 
-            #move files in file_list to safe_working_directory
-            for file in self.file_list:
-                shutil.copy(file, safe_working_directory)
+        try:
+            #only takes time if the chat has no running kernel yet (or it died), and does not count towards the background threshold
+            with metrics.span("kernel_start"):
+                kernel_pool.acquire(kernel_id)
+        except Exception as error:
+            output = f"Failed to execute the code. Error: {str(error)}"
+            self.execution_log.append(code, [{"output_type": "stream", "name": "stderr", "text": output}])
+            return {"result": output, "status": "error"}
 
-            # Add the code to the notebook
-            notebook.cells.append(new_code_cell(code))
+        collector = OutputCollector(image_directory=os.path.join(safe_working_directory, "outputs"))
+        if kernel_id != self.uuid or job_manager.threshold is None:
+            return self.run_code(code, kernel_id, safe_working_directory, timeout, max_chars, collector)
 
-            # Change the working directory to the safe_working_directory
-            os.chdir(safe_working_directory)
+        # Run the code on a job thread, so it can outlive this request. It gets the background timeout, and is interrupted here if it cannot be moved
+        breakdown = getattr(metrics.local, "breakdown", None)
 
-            # Execute the code
+        def run():
+            metrics.attach(breakdown)
             try:
-                client = NotebookClient(notebook, timeout=timeout)
-                client.execute()
+                return self.run_code(code, kernel_id, safe_working_directory, job_manager.timeout, max_chars, collector)
+            finally:
+                metrics.attach(None)
 
-                cell_output = client.nb.cells[-1]['outputs']
-                if cell_output:
-                    output = cell_output[0]['text'].strip()
-
-                    print(f"Code output: {output}")
-                else:
-                    output = "Code executed successfully, but no output was detected. Please wait for the next user message before reattempting to write the code."
-
-            except Exception as error:
-                output = f"Failed to execute the code. Error: {str(error)}"
+        job = job_manager.start(self.uuid, code, collector, run)
+        if not job_manager.wait(job, job_manager.threshold) and job_manager.hand_off(job, self.finish_job):
+            print(f"Code moved to background job {job.id}")
+            response = {
+                "result": f"The code is still running, so it was moved to background job {job.id}. Its output will be sent in a later message when it finishes.",
+                "status": "background",
+                "job_id": job.id
+            }
+            return response
+        if not job_manager.wait(job, max(timeout - job_manager.threshold, 0)):
+            #every background slot is taken, stop the code at this request's own timeout
+            collector.timed_out = True
+            kernel_pool.interrupt(kernel_id)
+            if not job_manager.wait(job, job_manager.grace):
+                #the code ignores the interrupt (e.g. blocked in a C extension or on I/O), restart the kernel rather than hold the request until the background timeout
+                kernel_pool.release(kernel_id)
+                output = f"Execution timed out after {timeout} seconds and did not stop when interrupted, so the interpreter was restarted and its variables were lost. Output so far:\n{collector.text(max_chars)}"
+                if job_manager.abandon(job, {"result": output, "status": "timeout"}):
+                    print(f"Code in job {job.id} ignored the interrupt, kernel restarted")
+        return job.result
+
+    def run_code(self, code: str, kernel_id: str, cwd: str, timeout: int, max_chars: int, collector: OutputCollector):
+        '''
+        Executes the code in the kernel and logs it, returns the interpreter output of send_code_to_interpreter
+        '''
+        # Execute the code in the session's persistent kernel
+        # The kernel is pointed at the safe_working_directory itself, the server's own working directory is never changed
+        started = time.monotonic()
+        try:
+            with metrics.span("code_execution"):
+                kernel_pool.execute(kernel_id, code, cwd, timeout, collector)
+        except Exception as error:
+            output = f"Failed to execute the code. Error: {str(error)}"
+            self.execution_log.append(code, [{"output_type": "stream", "name": "stderr", "text": output}])
+            return {"result": output, "status": "error"}
+
+        # Append the execution to the log, only the new entry is written
+        self.execution_log.append(code, collector.notebook_outputs())
+
+        # Pass at most max_chars characters of output to the model, keeping its start and end
+        output = collector.text(max_chars)
+        status = "ok"
+        if collector.timed_out:
+            output = f"Execution timed out after {round(time.monotonic() - started)} seconds and was interrupted. Output so far:\n{output}"
+            status = "timeout"
+        elif collector.capped:
+            output = f"The code produced too much output and was interrupted. Output so far:\n{output}"
+            status = "capped"
+        elif collector.error is not None:
+            output = f"Failed to execute the code. Error: {collector.error}\n{output}"
+            status = "error"
+        elif not output:
+            output = "Code executed successfully, but no output was detected. Please wait for the next user message before reattempting to write the code."
+        print(f"Code output: {output}")
+
+        response = {
+            "result": output,
+            "status": status
+        }
+        return response
 
-            with open(notebook_temp_path, 'w', encoding='utf-8') as f:
-                nbformat.write(notebook, f)
+    def finish_job(self, job):
+        '''
+        Adds the output of a finished background job to the chat's messages, after any turn still running on the chat
+        '''
+        with self.lock:
+            self.messages.append({"role": "assistant", "content": f"Babbage Python Interpreter (background job {job.id}): {job.result['result']}"})
+            self.last_activity = time.monotonic()
+        #keep the message if the chat lives in a shared session store, unless the chat was deleted meanwhile
+        if session_store.get(self.uuid) is self:
+            session_store.save(self.uuid, self)
+
+    def run_code_blocks(self, blocks: list, timeout: int = 60):
+        '''
+        Runs every code block of a response and returns one interpreter output for all of them.
+        Blocks run in order in the chat's kernel, and the blocks after one that fails are not run.
+        With parallel_code_blocks set, blocks that share no variables with the others run at the same time in their own kernels (if the pool has room).
+        Returns {"result": the output of each block, "status", "blocks": [{"code", "result", "status"} for each block]}
+        '''
+        if len(blocks) == 1:
+            return self.send_code_to_interpreter(blocks[0], timeout)
 
-                response = {
-                    "result": output
-                }
+        # Split the output budget between the blocks
+        max_chars = max(200, 1000 // len(blocks))
 
-                # Truncate the result if it's too long
-                if len(response['result']) > 1000:
-                    response['result'] = response['result'][:1000] + "..."
+        parallel = []
+        if self.parallel_code_blocks:
+            #leave a kernel for the chat itself, and never make the pool evict other chats' kernels
+            room = kernel_pool.max_kernels - kernel_pool.kernel_count() - 1
+            parallel = sorted(independent_blocks(blocks))[:max(room, 0)]
 
-        finally:
-            # Restore the original working directory
-            os.chdir(original_working_directory)
+        # Stage uploaded files once, before any block runs
+        sandbox_manager.prepare(self.uuid, self.file_list)
 
-            # Clean up the temporary directory
-            shutil.rmtree(safe_working_directory)
+        results = [None] * len(blocks)
+        breakdown = getattr(metrics.local, "breakdown", None)
 
+        def run_parallel(index: int):
+            kernel_id = f"{self.uuid}:block{index}"
+            metrics.attach(breakdown)
+            try:
+                results[index] = self.send_code_to_interpreter(blocks[index], timeout, max_chars, kernel_id)
+            except Exception as error:
+                results[index] = {"result": f"Failed to execute the code. Error: {str(error)}", "status": "error"}
+            finally:
+                metrics.attach(None)
+                kernel_pool.release(kernel_id)
+
+        with ThreadPoolExecutor(max_workers=max(len(parallel), 1)) as executor:
+            for index in parallel:
+                executor.submit(run_parallel, index)
+
+            failed = None
+            for index, code in enumerate(blocks):
+                if index in parallel:
+                    continue
+                if failed is not None:
+                    results[index] = {"result": f"Not run, because block {failed + 1} did not finish successfully.", "status": "skipped"}
+                    continue
+                results[index] = self.send_code_to_interpreter(code, timeout, max_chars)
+                if results[index]["status"] != "ok":
+                    failed = index
+
+        response = {
+            "result": "\n\n".join(f"Block {index + 1}:\n{result['result']}" for index, result in enumerate(results)),
+            "status": "ok" if all(result["status"] == "ok" for result in results) else "error",
+            "blocks": [{"code": code, **result} for code, result in zip(blocks, results)],
+        }
+        #a block moved to a background job stops the blocks after it, its output comes in a later message
+        background = [result for result in results if result["status"] == "background"]
+        if background:
+            response["status"] = "background"
+            response["job_id"] = background[0]["job_id"]
         return response
         
     def add_file_to_list(self, file_path: str):
         """
         Adds a file to the list of files that the interpreter can access.
-        This allows the interpreter to access the file, once it is moved to the sandboxed environment.
+        This allows the interpreter to access the file, once it is linked into the sandboxed environment.
         """
         #add file path to file list
-        self.file_list.append(file_path)
+        with self.lock:
+            self.file_list.append(file_path)
+            self.last_activity = time.monotonic()
 
 
-    def contextClassifier(self, most_recent_message: str, retries: int = 0):
+    def contextClassifier(self, most_recent_message: str):
         '''
-        Runs a classifier model with Davinci Instruct
         Selects the best prompt for the model to use based on the most recent message
+        Uses the shared context router, which classifies locally and only asks Davinci Instruct when it is unsure
         '''
-        try:
-            response = openai.Completion.create(
-                model="text-davinci-003",
-                prompt ="Decide what AI model to pass the message to. If the message has to do with math select \"math\", if the message has to do with \"code\" select \"code\", if the message has to do with internet access select \"internet\", if the model receives a message from the interpreter select \"file\", if the message has to do with downloading any kind of file select \"download\",If the message has to do with creating something other than code select \"creative\", if the message has to do with anything else select \"standard\"\n\nMessage: Search up \"ThePirateBay.com\" on google\nModel: Internet\nMessage: Solve for x in the equation 2x + 3 = 7\nModel: Math\nMessage: Write a program to print \"Hello World\"\nModel: Code\nMessage: What is the capital of France?\nModel: Standard\nMessage: Use the internet to find the capital of france\nModel: Internet\nMessage: File hello.png saved to disk successfully!\"\nModel: File\nMessage: make a download link for the file\nModel: Download\nMessage: create an imaage/picture of an astronaut\nModel: Creative\nMessage:"  + most_recent_message + "\nModel:",
-                temperature=0,
-                max_tokens=60,
-                top_p=1,
-                frequency_penalty=0.5,
-                presence_penalty=0
-            )
+        with metrics.span("classifier"):
+            model = context_router.route(most_recent_message, self.remoteClassifier)
 
-            print("Model Selected:", response.choices[0].text)
-            self.previous_model = response.choices[0].text
-            return response.choices[0].text
-        
-        # Handle rate limit errors
-        except openai.error.RateLimitError as error:
-            print(f"RateLimitError occurred: {error}")
-            if retries < 2:
-                # Try again, incrementing the retries count
-                return self.contextClassifier(most_recent_message, retries=retries + 1)
-            else:
-                # If retries exceeded, return "standard"
-                return "standard"
-        except openai.error.APIError as error:
-            print(f"APIError occurred: {error}")
-            # Default to standard model
-            return "standard"
-        except Exception as error:
-            print(f"An unexpected error occurred: {error}")
-            # Default to standard model
-            return "standard"
+        print("Model Selected:", model)
+        self.previous_model = model
+        return model
 
-    def generate_gpt_response(self, messages: list,interpreterOutput: bool = False):
+    def remoteClassifier(self, most_recent_message: str):
         '''
-        Generates a response from GPT-4 based on the messages list
+        Runs a classifier model with Davinci Instruct, with this chat's API key
+        Returns the selected label, or None if the classifier failed
+        '''
+        return classify_remotely(self.client, most_recent_message)
+
+    def generate_gpt_response(self, messages: list,interpreterOutput: bool = False, on_token = None, gpt_model: str = "gpt-4", cache_type: str = None, route: str = None, speculation = None):
+        '''
+        Generates a response from GPT-4 (or gpt_model) based on the messages list
+        If on_token is given, the response is streamed and on_token is called with each piece of text as it arrives
+        cache_type lets the response cache (if enabled) answer a call identical to an earlier one, the DALL-E prompt rewrite is always cacheable
+        route is the prompt label if it was already chosen, otherwise the context classifier chooses it
+        speculation is called with on_token for a standard route and returns the response started before the route was known, or None to make the call here
         '''
         #if the openai api key is not set, return an error message
         if self.api_key == "":
@@ -222,12 +376,13 @@ class ChatAssistant:
         #select the most recent message
         most_recent_message = messages[-1]['content']
 
-        #delete the last message in the messages list
-        del messages[-1]
+        #the message is sent to the model as the user's, e.g. the interpreter's output
+        if messages[-1]['role'] != "user":
+            messages[-1] = {"role": "user", "content": most_recent_message}
 
         #call prompt selector if interpreterOutput is false
         if interpreterOutput == False:
-            model = self.contextClassifier(most_recent_message)
+            model = route if route is not None else self.contextClassifier(most_recent_message)
         #Do not use a prompt selector if GPT is being fed the output of the interpreter
         elif interpreterOutput == True:
             # model = self.previous_model #use the same model as the previous message
@@ -248,56 +403,79 @@ class ChatAssistant:
         # print(model)
 
         # Approach 2 Model Selection/Prompt Injection
+        #the prompt is injected before the most recent message until the model has answered it, see send_message
+        prompt = None
         if model == "standard":
-            #add the most recent message back to the messages list
-            messages.append({"role": "user", "content": most_recent_message})
+            #send the most recent message as it is
+            prompt = None
         # elif model == "code":
         #     #append the most recent message in the messages, with "hello" at the beginning
         #     messages.append({"role": "user", "content": "write a python snippet to solve the following issue or if there are none give an explanation of the code:::" + most_recent_message})
         elif model == "math":
-            #append the most recent message in the messages, with "solve" at the beginning
+            #inject "solve" at the beginning of the most recent message
             # messages.append({"role": "user", "content": "write a python snippet to solve the following math problem, be sure to use print statements so that you can view the results:::" + most_recent_message})
-            messages.append({"role": "user", "content": "use python to solve the following problem:::" + most_recent_message})
+            prompt = "use python to solve the following problem"
         elif model == "internet":
-            #append the most recent message in the messages, with "search" at the beginning
-            messages.append({"role": "user", "content": "write a python snippet that uses google search (if using googlesearch use the param search() (and do not write num_results, write num instead) with only the query, no other params for links) or another web scraping package to obtain the web result, be sure to use print statements so that you can read it. If the user requests a specific web page then please try to get information from that specific page. Once the interpreter returns the results, Don't spam links in your response. Instead concisely answer the user's request and include only relevent links (and only if you think it is relevant to):::" + most_recent_message})
+            #inject "search" at the beginning of the most recent message
+            prompt = "write a python snippet that uses google search (if using googlesearch use the param search() (and do not write num_results, write num instead) with only the query, no other params for links) or another web scraping package to obtain the web result, be sure to use print statements so that you can read it. If the user requests a specific web page then please try to get information from that specific page. Once the interpreter returns the results, Don't spam links in your response. Instead concisely answer the user's request and include only relevent links (and only if you think it is relevant to)"
         elif model == "file":
-            #append the most recent message in the messages, with "search" at the beginning
-            messages.append({"role": "user", "content": "write a python program to open/interpret the following file, be sure to use print statements so that you can read it:::" + most_recent_message})
+            #inject "open the file" at the beginning of the most recent message
+            prompt = "write a python program to open/interpret the following file, be sure to use print statements so that you can read it"
             # messages.append({"role": "user", "content": "write a python program to execute this, make sure to put it in ```python, and ```. Once you have written the program, the system will send you its output, which you will use to finally state the conclusion:::" + most_recent_message})
         elif model == "download":
-            #append the most recent message in the messages, with "search" at the beginning
-            messages.append({"role": "user", "content": "write a python snippet to cd into public folder, and list the files within it, be sure to use print statements so that you can read it. Once you have done this, you will receive the output from the interpreter. In your next message simply write the link in the following syntax [link]/FILENAMEONLY(Do not put entire path)[/link] :::" + most_recent_message})
+            #inject "list the public folder" at the beginning of the most recent message
+            prompt = "write a python snippet to cd into public folder, and list the files within it, be sure to use print statements so that you can read it. Once you have done this, you will receive the output from the interpreter. In your next message simply write the link in the following syntax [link]/FILENAMEONLY(Do not put entire path)[/link] "
         elif model == "creative":
             # messages.append({"role": "user", "content": "Create a better prompt for the following and only reply with the prompt:::" + most_recent_message})
-            messages.append({"role": "user", "content": "You  have access to Dall-E and are tasked with fixing prompts sent to you you will create a better prompt for the following and only reply with the prompt that will be sent to Dall-E (it does not need to be told to 'create an image'):::" + most_recent_message})
+            prompt = "You  have access to Dall-E and are tasked with fixing prompts sent to you you will create a better prompt for the following and only reply with the prompt that will be sent to Dall-E (it does not need to be told to 'create an image')"
 
         # elif model == "followup":
         #     #append the most recent message in the messages, with "search" at the beginning
         #     messages.append({"role": "user", "content": "write a python snippet to solve the following issue or if there are none give an explanation of the code:::" + most_recent_message})
-        else:
-            messages.append({"role": "user", "content": most_recent_message})
 
-        try:
-            response = openai.ChatCompletion.create(
-                # model="gpt-3.5-turbo",
-                model="gpt-4",
-                messages=messages,
-            )
-            #Approach 2 Remove Injected Prompt from Response to save token memory
-            #if messages 1 contains :::, split the message at :::, remove the first part of the message, and append the second part of the message to the list
-            if ":::" in messages[-1]['content']:
-                # split the most recent message in the list at :::
-                recentMessage = messages[-1]['content'].split(":::")
-                #remove the most recent message from the list
-                messages = messages[:-1]
-                #append the 2nd part of the most recent message to the list
-                messages.append({"role": "user", "content": recentMessage[1]})
+        if prompt is not None:
+            if isinstance(messages, ConversationHistory):
+                messages.inject(prompt)
+            else:
+                messages[-1] = {"role": "user", "content": f"{prompt}:::{most_recent_message}"}
 
+        #keep the history under its token budget, only the trimmed messages are touched
+        if isinstance(messages, ConversationHistory):
+            messages.compact()
+
+        if model == "creative" and cache_type is None:
+            cache_type = "creative_prompt"
+
+        try:
+            with metrics.span("model_call", model=gpt_model):
+                response = None
+                content = speculation(on_token) if speculation is not None and model == "standard" else None
+                if content is None:
+                    response = self.client.create(
+                        openai.ChatCompletion,
+                        cache_type=cache_type,
+                        # model="gpt-3.5-turbo",
+                        model=gpt_model,
+                        messages=messages.payload() if isinstance(messages, ConversationHistory) else messages,
+                        stream=on_token is not None,
+                    )
+                    if on_token is not None:
+                        #collect the streamed response, passing each piece on as it arrives
+                        content = ""
+                        for chunk in response:
+                            token = chunk.choices[0].delta.get('content', "")
+                            if token:
+                                content += token
+                                on_token(token)
+                    else:
+                        content = response.choices[0].message['content']
+            #a speculative response counted its own tokens
+            if response is not None:
+                self.record_token_usage(messages, response, content, gpt_model)
             if model == "creative":
                 # print('Generating creative image...')
                 # Generate the creative text using GPT-4
-                creative_text_response = response.choices[0].message['content']
+                creative_text_response = content
                 # print(creative_text_response)
                 # Use the creative text to prompt DALL-E for an image
                 image_link = self.generate_dalle_image(creative_text_response)
@@ -306,7 +484,7 @@ class ChatAssistant:
                 dall_e_gpt_response = f"{creative_text_response}\n[img]{image_link}[/img]"
                 # print(dall_e_gpt_response)
                 return dall_e_gpt_response
-            return response.choices[0].message['content']
+            return content
         
         # Handle rate limit errors
         except openai.error.RateLimitError as error:
@@ -320,46 +498,126 @@ class ChatAssistant:
             return None
         
 
-    def recursion(self):
+    def speculative_response(self, messages: list, buffer: TokenBuffer, cancelled, gpt_model: str = "gpt-4"):
+        '''
+        Streams the standard prompt's response to messages into buffer before the route is known, stopping as soon as the stage is cancelled
+        The tokens it used are counted whether the response is taken or thrown away
+        '''
+        content = ""
+        try:
+            with metrics.span("speculative_model_call", model=gpt_model):
+                response = self.client.create(openai.ChatCompletion, model=gpt_model, messages=messages, stream=True)
+                try:
+                    for chunk in response:
+                        if cancelled.is_set():
+                            break
+                        token = chunk.choices[0].delta.get('content', "")
+                        if token:
+                            content += token
+                            buffer.append(token)
+                finally:
+                    #closing the stream gives the API key's slot back straight away
+                    if hasattr(response, "close"):
+                        response.close()
+        except Exception as error:
+            buffer.finish(error)
+            return
+        buffer.finish()
+        self.record_token_usage(self.messages, None, content, gpt_model)
+
+    def take_speculation(self, pipeline, buffer: TokenBuffer, on_token = None):
+        '''
+        Returns the speculative response for a turn whose route turned out to be standard, passing its pieces to on_token as they arrive
+        Returns None if it never started (no pool thread was free) or failed, so the call is made again
+        '''
+        if pipeline.cancel("speculative_response", only_pending=True):
+            pipeline_executor.count("speculation_unstarted")
+            return None
+        try:
+            content = buffer.read(on_token)
+        except Exception as error:
+            print(f"Speculative response failed: {error}")
+            pipeline_executor.count("speculation_failed")
+            return None
+        pipeline_executor.count("speculation_hits")
+        return content
+
+    def warm_kernel(self):
+        '''
+        Stages the chat's files and starts its kernel if it has none, while the model answers, so code in the answer does not wait for either.
+        Most turns run no code, so warming only uses an idle kernel or free room under the cap and never shuts down another chat's kernel.
+        '''
+        try:
+            with metrics.span("file_staging"):
+                sandbox_manager.prepare(self.uuid, list(self.file_list))
+            with metrics.span("kernel_start"):
+                kernel_pool.acquire(self.uuid, evict=False)
+        except Exception as error:
+            #running the code tries again and reports the error
+            print(f"Failed to warm up the kernel: {error}")
+
+    def record_token_usage(self, messages: list, response, content: str, gpt_model: str):
+        '''
+        Counts the prompt and completion tokens of a chat completion in the metrics, and against the API key's tokens per minute
+        Streamed responses carry no usage, so their tokens are counted with the history's tokenizer instead
+        Responses from the response cache used no tokens
+        '''
+        if self.client.was_cached():
+            return
+        usage = response.get("usage") if isinstance(response, dict) else None
+        if usage:
+            prompt_tokens, completion_tokens = usage["prompt_tokens"], usage["completion_tokens"]
+        elif isinstance(messages, ConversationHistory):
+            prompt_tokens = messages.total_tokens
+            completion_tokens = messages.count_tokens({"content": content}) - messages.TOKENS_PER_MESSAGE
+        else:
+            return
+        metrics.increment("prompt_tokens", prompt_tokens, model=gpt_model)
+        metrics.increment("completion_tokens", completion_tokens, model=gpt_model)
+        self.client.record_tokens(prompt_tokens + completion_tokens)
+
+    def recursion(self, gpt_response: str = None, interpreter_output: dict = None):
         '''
         Checks if the AI has finished the problem
         returns true if the AI has NOT finished the problem
+        gpt_response and interpreter_output are the results of the turn, used by the completion check policy to skip the check when the turn obviously finished
         '''
 
+        if not completion_check.needs_remote_check(gpt_response, interpreter_output):
+            return False
+
         print("Recursion Check Initiated")
 
-        self.messages.append({"role": "user", "content": "Automated Task Checker: If the user gave you a problem to solve in their previous message, has the problem been solved? If you reply no: you will be put into recursive mode, which will allow you to make another response in order to complete your answer. Reply with ONLY yes or no. If there was NO EXPLICIT problem given by the user, reply yes."})
-        gpt_response = self.generate_gpt_response(self.messages)
+        with metrics.span("recursion_check"):
+            #the checker's question is only in the history for this call
+            mark = self.messages.checkpoint()
+            self.messages.append({"role": "user", "content": "Automated Task Checker: If the user gave you a problem to solve in their previous message, has the problem been solved? If you reply no: you will be put into recursive mode, which will allow you to make another response in order to complete your answer. Reply with ONLY yes or no. If there was NO EXPLICIT problem given by the user, reply yes."})
+            try:
+                gpt_response = self.generate_gpt_response(self.messages, gpt_model=completion_check.check_model, cache_type="recursion_check")
+            finally:
+                self.messages.rollback(mark)
         
-        #format response
-        gpt_response = gpt_response.lower().strip()
-
-        #if the response is yes, return false
-        if gpt_response == "yes":
-            #remove the last two messages from the list
-            self.messages = self.messages[:-2]
-            return False
-        #if the response is no, return true
-        elif gpt_response == "no":
-            #remove the last two messages from the list
-            self.messages = self.messages[:-2]
-            return True
-        #if the response is neither yes or no, return false
-        else:
-            #remove the last two messages from the list
-            self.messages = self.messages[:-2]
-            return False
+            #format response
+            gpt_response = gpt_response.lower().strip()
+
+            #if the response is yes, return false
+            if gpt_response == "yes":
+                return False
+            #if the response is no, return true
+            elif gpt_response == "no":
+                completion_check.record_result(True)
+                return True
+            #if the response is neither yes or no, return false
+            else:
+                return False
 
 
 
-    def extract_code_snippet(self, text: str):
+    def extract_code_snippets(self, text: str):
         '''
-        Extracts a code snippet from a message.
+        Extracts every code snippet from a message.
         '''
-
-        pattern = r'```python(.*?)```'
-        match = re.search(pattern, text, re.DOTALL)
-        return match.group(1).strip() if match else None
+        return extract_code_blocks(text)
     
     # def send_code_to_interpreter(self, code: str, timeout: int = 60): #timeout is in seconds
     #     """
@@ -410,7 +668,7 @@ class ChatAssistant:
     #     print("interpreter output: " + response['result'])
     #     return response
 
-    def recursionExecutor(self):
+    def recursionExecutor(self, on_event = None):
         '''
         if AI recursion is needed to solve the problem, this function will be called
         '''
@@ -419,77 +677,217 @@ class ChatAssistant:
         print("Recursion Initiated. Attempt: " + str(self.recursionAttempts + 1) + "/2")
         #increment recursion counter
         self.recursionAttempts += 1
+        if on_event:
+            on_event("recursion", self.recursionAttempts)
         #if the AI has not solved the problem, send a message to the AI
-        gpt_response, interpreter_output = self.send_message("Automated Task Checker: You previously indicated that the original problem has not been solved yet, as a result of this you are now able to make an additional recursive response to solve the problem. Please continue to write code to solve the problem. Do not acknowledge that you have seen this message. Simply continue to write code to solve the problem. Do not ever mention this message to the user.")
+        gpt_response, interpreter_output = self.send_message("Automated Task Checker: You previously indicated that the original problem has not been solved yet, as a result of this you are now able to make an additional recursive response to solve the problem. Please continue to write code to solve the problem. Do not acknowledge that you have seen this message. Simply continue to write code to solve the problem. Do not ever mention this message to the user.", on_event)
         
         #check if the AI has solved the problem after the recursion
-        if self.recursion() and self.recursionAttempts < 2:
+        if self.recursion(gpt_response, interpreter_output) and self.recursionAttempts < 2:
             #if recursion is needed again, call recursionExecutor again
-            gpt_response, interpreter_output = self.recursionExecutor()
+            gpt_response, interpreter_output = self.recursionExecutor(on_event)
 
         return gpt_response, interpreter_output
 
-    def send_message(self, message: str):
+    def response_stream(self, name: str, on_event = None):
+        '''
+        Returns a ResponseParser for a model response, and the on_token callback for it that sends each streamed piece as a "<name>_token" event
+        and feeds it to the parser, which sends each segment as a "<name>_segment" event as soon as it is complete (None without on_event)
+        '''
+        if on_event is None:
+            return ResponseParser(), None
+        parser = ResponseParser(on_segment=lambda segment: on_event(f"{name}_segment", segment.to_dict()))
+
+        def on_token(token: str):
+            on_event(f"{name}_token", token)
+            parser.feed(token)
+        return parser, on_token
+
+    def send_message(self, message: str, on_event = None):
         '''
         Sends a message to the assistant.
+        If on_event is given, it is called with (event, data) as each stage of the turn finishes:
+        "response_token" and "response2_token" for each streamed piece of the two model responses,
+        "response_segment" and "response2_segment" with each prose, code, image or link segment of them as soon as it is complete,
+        "response", "code_snippet", "interpreter_output" and "response2" once each stage is complete,
+        and "recursion" when a recursive attempt starts.
         '''
-        self.messages.append({"role": "user", "content": message})
-        gpt_response = self.generate_gpt_response(self.messages)
-        self.messages.append({"role": "assistant", "content": gpt_response})
+        #only one turn may run on a chat at a time
+        with self.lock:
+            self.last_activity = time.monotonic()
+            #the prompt injected for this turn's route is removed from the history once the model has answered it, to save tokens in later calls
+            mark = self.messages.checkpoint()
+            try:
+                self.messages.append({"role": "user", "content": message})
+                parser, on_token = self.response_stream("response", on_event)
+
+                # The turn up to the first response as a dependency graph: the route is chosen and the model answers in this thread,
+                # while the chat's kernel is warmed up in the background. If choosing the route means asking the remote classifier,
+                # the standard prompt's response is started alongside it and thrown away if another route is chosen
+                pipeline = pipeline_executor.pipeline()
+                pipeline.add("kernel", self.warm_kernel, background=True)
+                buffer = None
+                if self.speculative_routing and self.api_key != "" and context_router.will_ask_remote(message):
+                    #trimmed as generate_gpt_response trims it, so a standard route sends exactly these messages
+                    self.messages.compact()
+                    buffer = TokenBuffer()
+                    snapshot = self.messages.payload()
+                    pipeline.add("speculative_response", lambda cancelled: self.speculative_response(snapshot, buffer, cancelled), background=True)
+                pipeline.add("route", lambda: self.contextClassifier(message))
+
+                def respond(route):
+                    speculation = None
+                    if buffer is not None:
+                        if str(route).lower().strip() == "standard":
+                            speculation = lambda on_token: self.take_speculation(pipeline, buffer, on_token)
+                        else:
+                            pipeline.cancel("speculative_response")
+                            pipeline_executor.count("speculation_misses")
+                    return self.generate_gpt_response(self.messages, on_token=on_token, route=route, speculation=speculation)
+
+                pipeline.add("response", respond, after=["route"])
+                gpt_response = pipeline.result("response")
+                #the second response and the recursion check see the user's message without the route's prompt
+                self.messages.rollback(mark, keep_messages=True)
+                self.messages.append({"role": "assistant", "content": gpt_response})
+                if on_event:
+                    on_event("response", gpt_response)
         
 
-        code_snippet = self.extract_code_snippet(gpt_response)
-        interpreter_output = None
-        if code_snippet:
-            interpreter_output = self.send_code_to_interpreter(code_snippet)
-            if interpreter_output:
-                interpreter_message = f"Babbage Python Interpreter: {interpreter_output['result']}"
-                self.messages.append({"role": "assistant", "content": interpreter_message})
-                gpt_response_with_interpreter_output = self.generate_gpt_response(self.messages, True)
-                # gpt_response = f"{gpt_response}\n{gpt_response_with_interpreter_output}"
-                gpt_response = f"{gpt_response}\n RES2:{gpt_response_with_interpreter_output}"
+                #the parser has seen the streamed response, only what was added after it (e.g. an image) is parsed now
+                code_snippets = parser.finish(gpt_response).code_blocks()
+                interpreter_output = None
+                if code_snippets:
+                    if on_event:
+                        on_event("code_snippet", "\n\n".join(code_snippets))
+                    #the kernel may still be starting
+                    pipeline.result("kernel")
+                    interpreter_output = self.run_code_blocks(code_snippets)
+                    if interpreter_output:
+                        if on_event:
+                            on_event("interpreter_output", interpreter_output)
+                        interpreter_message = f"Babbage Python Interpreter: {interpreter_output['result']}"
+                        self.messages.append({"role": "assistant", "content": interpreter_message})
+                        parser2, on_token2 = self.response_stream("response2", on_event)
+                        gpt_response_with_interpreter_output = self.generate_gpt_response(self.messages, True, on_token2)
+                        parser2.finish(gpt_response_with_interpreter_output)
+                        if on_event:
+                            on_event("response2", gpt_response_with_interpreter_output)
+                        # gpt_response = f"{gpt_response}\n{gpt_response_with_interpreter_output}"
+                        gpt_response = f"{gpt_response}\n RES2:{gpt_response_with_interpreter_output}"
+
+
+                # check if the AI has solved the problem, if not, initiate recursion
+                recursion = self.recursion(gpt_response, interpreter_output)
+                if recursion and self.recursionAttempts < 2:
+                    gpt_response, interpreter_output = self.recursionExecutor(on_event)
+                #else if its false, reset recursion counter
+                elif recursion == False:
+                    self.recursionAttempts = 0
+
+                return gpt_response, interpreter_output
+            finally:
+                #when the model or a stage fails before the prompt was removed, so the injected prompts never stay in the history
+                self.messages.rollback(mark, keep_messages=True)
+
+    def send_batch(self, messages: list, on_result = None):
+        '''
+        Sends the messages to the assistant one after another, as send_message does.
+        Returns a {"gpt_response", "interpreter_output", "seconds"} result for each message, or {"error", "seconds"} if its turn failed,
+        in which case the messages after it are still sent.
+        Code a turn moved to a background job is waited for before the next message is sent, so each message sees the output of the ones before it.
+        If on_result is given, it is called with the index and result of each message as soon as its turn is over.
+        '''
+        results = []
+        for index, message in enumerate(messages):
+            started = time.perf_counter()
+            try:
+                with metrics.span("request", endpoint="send_batch"):
+                    gpt_response, interpreter_output = self.send_message(message)
+                result = {"gpt_response": gpt_response, "interpreter_output": interpreter_output}
+            except Exception as error:
+                print(f"Batch message {index} failed for {self.uuid}: {error}")
+                result = {"error": str(error)}
+            #the job's output is added to the messages before it counts as done
+            for job in job_manager.jobs_for(self.uuid):
+                if not job.done.is_set():
+                    job_manager.wait(job)
+            result["seconds"] = time.perf_counter() - started
+            results.append(result)
+            if on_result is not None:
+                on_result(index, result)
+        return results
+
+    def generate_dalle_image(self, prompt: str, size: str = "512x512"):
+        '''
+        Returns the local URL of an image for the prompt, served by this server from the image store
+        A prompt that was drawn before reuses its image, otherwise DALL-E draws it and it is downloaded in the background
+        '''
+        key = image_store.key(prompt, size)
+        image_url = image_store.lookup(key)
+        if image_url is not None:
+            return image_url
 
+        # Call the Dall-E API with the prompt
+        with metrics.span("dalle_image"):
+            response = self.client.create(
+                openai.Image,
+                cache_type="image",
+                prompt=prompt,
+                n=1,
+                size=size,
+            )
 
-        # check if the AI has solved the problem, if not, initiate recursion
-        recursion = self.recursion()
-        if recursion and self.recursionAttempts < 2:
-            gpt_response, interpreter_output = self.recursionExecutor()
-        #else if its false, reset recursion counter
-        elif recursion == False:
-            self.recursionAttempts = 0
+        # Download the generated image from its temporary URL, the local URL works straight away
+        return image_store.add(key, response["data"][0]["url"])
 
+    def owns_chat(self):
+        """
+        Returns False if a newer ChatAssistant for the same chat exists in this process, which then owns the chat's kernel, sandbox and files
+        """
+        #a dying object's entry is already gone, so it still owns the chat unless a newer one took over
+        return owners.get(self.uuid) in (None, self)
 
-        return gpt_response, interpreter_output
-    
-    def generate_dalle_image(self, prompt: str):
-        # Call the Dall-E API with the prompt
-        response = openai.Image.create(
-            prompt=prompt,
-            n=1,
-            size="512x512",
-        )
-
-        # Get the URL of the generated image
-        image_url = response["data"][0]["url"]
-        # print(image_url)
-        # Download and save the image
-        # response = requests.get(image_url)
-        # img = Image.open(BytesIO(response.content))
-        # file_path = f"{prompt}_dalle_image.png"
-        # img.save(file_path)
-
-        return image_url
+    def release(self):
+        """
+        Releases what this process holds for the chat: its kernel and its sandbox.
+        Only runs once, and not at all if a newer ChatAssistant for the chat owns them.
+        """
+        if self.released:
+            return
+        self.released = True
+        if not self.owns_chat():
+            return
+        #shut down the kernel that was kept alive for this chat
+        kernel_pool.release(self.uuid)
+        #delete the chat's sandbox, and any uploads no other chat shares
+        sandbox_manager.delete(self.uuid, self.file_list)
+
+    def close(self):
+        """
+        Releases the chat's kernel and sandbox and, unless keep_files is set, deletes its upload folder, execution log and exported notebook.
+        Called by the session reaper when it evicts the chat, or by the destructor, whichever comes first.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        #the chat's files are kept if the chat lives on in a shared session store, or in a newer ChatAssistant
+        if not self.keep_files and self.owns_chat():
+            #if the folder named after the uuid exists, delete it
+            if os.path.exists(self.uuid):
+                #delete the folder named after the uuid
+                shutil.rmtree(self.uuid)
+            #delete the execution log named after the uuid
+            self.execution_log.delete()
+            #if an .ipynb file named after the uuid was exported, delete it
+            if os.path.exists("notebook_" + self.uuid + ".ipynb"):
+                #delete the .ipynb file named after the uuid
+                os.remove("notebook_" + self.uuid + ".ipynb")
+        #released last, so stored uploads that were only linked from the deleted folder are cleaned up with the sandbox
+        self.release()
 
     def __del__(self):
         """
         Destructor for the ChatAssistant class
         """
-        #if the folder named after the uuid exists, delete it
-        if os.path.exists(self.uuid):
-            #delete the folder named after the uuid
-            shutil.rmtree(self.uuid)
-        #if the .ipynb file named after the uuid exists, delete it
-        if os.path.exists("notebook_" + self.uuid + ".ipynb"):
-            #delete the .ipynb file named after the uuid
-            os.remove("notebook_" + self.uuid + ".ipynb")
-       
\ No newline at end of file
+        self.close()
@@ -0,0 +1,236 @@
+import re
+import ast
+import builtins
+
+#the language of the code blocks that are run and hidden from the response shown to the user
+PYTHON = "python"
+
+#where a segment other than prose starts -> the text that ends it, None if the marker is the whole segment
+MARKERS = {"```": "```", "RES2:": None, "[img]": "[/img]", "[link]": "[/link]"}
+MARKER = re.compile("|".join(re.escape(marker) for marker in MARKERS))
+#the most text at the end of a chunk that may be the start of a marker or of the text that ends one
+LONGEST_MARKER = max(len(text) for marker, closing in MARKERS.items() for text in (marker, closing or ""))
+
+#the end of an open segment, or the RES2 boundary, which only a python code block can contain
+CLOSING = {marker: re.compile(re.escape(closing) + "|RES2:") for marker, closing in MARKERS.items() if closing}
+PYTHON_CLOSING = re.compile("```")
+TAG_KINDS = {"[img]": "image", "[link]": "link"}
+
+#an image or link tag that is not closed within this many characters is ordinary text
+MAX_TAG_LENGTH = 2048
+
+#the language of a code block: what follows the opening fence up to the first whitespace
+LANGUAGE = re.compile(r"[^\s`]*")
+
+BUILTIN_NAMES = set(dir(builtins))
+
+
+class Segment:
+    '''
+    A piece of a model response: "prose", a "code" block, the "res2" boundary before the response to the interpreter's output,
+    or an "image" or "link" tag. text is the code of a code block and the URL of a tag, raw is the segment as it appears in the response.
+    part is 0 before the RES2 boundary and 1 after it.
+    '''
+    def __init__(self, kind: str, raw: str, part: int, text: str = None, language: str = None):
+        self.kind = kind
+        self.raw = raw
+        self.part = part
+        self.text = raw if text is None else text
+        self.language = language
+
+    def to_dict(self):
+        segment = {"type": self.kind, "part": self.part, "text": self.text}
+        if self.kind == "code":
+            segment["language"] = self.language
+        return segment
+
+
+class ResponseParser:
+    '''
+    Response Parser class
+
+    Splits a model response into typed segments in one pass over the text, as it arrives: prose, code blocks with their language,
+    the RES2 boundary, and image and link tags. A code block or tag that is never closed is ordinary prose, as is anything inside a code block.
+    The RES2 boundary ends the first part of the response, so only a python code block can span it, and a tag or other code block open at the boundary is prose.
+    Nothing is scanned twice: each feed only searches the new text, and the few characters before it that may start a marker.
+
+    Attributes:
+        on_segment: Called with each Segment as soon as it is complete, e.g. to stream code blocks before the rest of the response
+        segments (list): The segments found so far
+
+    Methods:
+        feed(self, chunk: str):
+        Parses the next piece of the response
+        close(self):
+        Parses what is left at the end of the response
+        finish(self, text: str):
+        Parses the rest of text, the whole response, and closes the parser
+        code_blocks(self, language: str = PYTHON):
+        Returns the code of every code block in the language
+        text(self, part: int = 0):
+        Returns the text of a part of the response as it is shown to the user, without its python code blocks
+    '''
+    def __init__(self, on_segment = None):
+        '''
+        Constructor for the ResponseParser class
+        '''
+        self.on_segment = on_segment
+        self.segments = []
+        self.buffer = ""
+        self.part = 0
+
+        #where the text not yet in a segment starts, where the search for the next marker resumes, and the open marker being read
+        self.start = 0
+        self.scan = 0
+        self.marker = None
+
+    def feed(self, chunk: str):
+        self.buffer += chunk
+        self.parse(final=False)
+        return self
+
+    def close(self):
+        self.parse(final=True)
+        return self
+
+    def finish(self, text: str):
+        '''
+        Parses the part of text, the whole response, that was not fed yet and closes the parser.
+        A response that does not continue what was fed (e.g. a failed stream that was retried) is parsed again from the start, without calling on_segment.
+        '''
+        text = text or ""
+        if not text.startswith(self.buffer):
+            self.__init__()
+        return self.feed(text[len(self.buffer):]).close()
+
+    def add(self, kind: str, end: int, **fields):
+        segment = Segment(kind, self.buffer[self.start:end], self.part, **fields)
+        self.segments.append(segment)
+        self.start = end
+        if self.on_segment is not None:
+            self.on_segment(segment)
+
+    def parse(self, final: bool):
+        buffer = self.buffer
+        while True:
+            if self.marker is None:
+                match = MARKER.search(buffer, self.scan)
+                if match is None:
+                    if final and self.start < len(buffer):
+                        self.add("prose", len(buffer))
+                    #the end of the buffer may be the start of a marker
+                    self.scan = max(self.scan, len(buffer) - LONGEST_MARKER + 1)
+                    return
+                if match.start() > self.start:
+                    self.add("prose", match.start())
+                self.scan = match.end()
+                if match.group() == "RES2:":
+                    self.add("res2", match.end())
+                    self.part += 1
+                    continue
+                self.marker = match.group()
+
+            if self.marker == "```" and not final and len(buffer) < self.start + len("```" + PYTHON):
+                #not known yet whether this is a python code block
+                return
+            python = self.marker == "```" and buffer.startswith("```" + PYTHON, self.start)
+            body_start = self.start + len(self.marker)
+            limit = len(buffer) if self.marker == "```" else body_start + MAX_TAG_LENGTH + len(MARKERS[self.marker])
+            match = (PYTHON_CLOSING if python else CLOSING[self.marker]).search(buffer, self.scan, limit)
+            if match is None or match.group() == "RES2:":
+                if final or match is not None or limit < len(buffer):
+                    #never closed, the marker is ordinary text and the search goes on after it
+                    self.marker = None
+                    self.scan = body_start
+                    continue
+                self.scan = max(self.scan, len(buffer) - LONGEST_MARKER + 1)
+                return
+
+            end = match.start()
+            if python:
+                self.add("code", match.end(), text=buffer[body_start + len(PYTHON):end].strip(), language=PYTHON)
+            elif self.marker == "```":
+                body = buffer[body_start:end]
+                language = LANGUAGE.match(body).group()
+                self.add("code", match.end(), text=body[len(language):].strip(), language=language)
+            else:
+                self.add(TAG_KINDS[self.marker], match.end(), text=buffer[body_start:end].strip())
+            self.marker = None
+            self.scan = self.start
+
+    def code_blocks(self, language: str = PYTHON):
+        return [segment.text for segment in self.segments if segment.kind == "code" and segment.language == language]
+
+    def text(self, part: int = 0):
+        return "".join(segment.raw for segment in self.segments
+                       if segment.part == part and segment.kind != "res2" and not (segment.kind == "code" and segment.language == PYTHON))
+
+    def has_part(self, part: int):
+        return self.part >= part
+
+
+def parse_response(text: str):
+    '''
+    Returns a closed ResponseParser holding the segments of a whole response
+    '''
+    return ResponseParser().finish(text)
+
+
+def extract_code_blocks(text: str):
+    '''
+    Returns the code of every python code block in text, in order
+    '''
+    return parse_response(text).code_blocks()
+
+
+def defined_and_used_names(code: str):
+    '''
+    Returns the names a block of code defines (assigns, imports, functions, classes) and the names it reads.
+    Raises SyntaxError if the code is not plain python (e.g. IPython magics).
+    '''
+    defined, used = set(), set()
+    for node in ast.walk(ast.parse(code)):
+        if isinstance(node, ast.Name):
+            (used if isinstance(node.ctx, ast.Load) else defined).add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            defined.add(node.name)
+        elif isinstance(node, ast.arg):
+            defined.add(node.arg)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            defined.add(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == "*":
+                    #anything could have been imported
+                    raise SyntaxError("star import")
+                defined.add((alias.asname or alias.name).split(".")[0])
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            used.update(node.names)
+    return defined, used
+
+
+def independent_blocks(blocks: list):
+    '''
+    Returns the indexes of the blocks that can run on their own in a fresh kernel:
+    they read no name they do not define themselves (so they do not rely on earlier blocks or the chat's kernel),
+    and no other block reads a name they define (so nothing depends on them running in the chat's kernel).
+    Files written by one block and read by another are not detected.
+    '''
+    names = []
+    for code in blocks:
+        try:
+            names.append(defined_and_used_names(code))
+        except SyntaxError:
+            names.append(None)
+
+    independent = set()
+    for index, entry in enumerate(names):
+        if entry is None:
+            continue
+        defined, used = entry
+        if used - defined - BUILTIN_NAMES:
+            continue
+        needed_by_others = any(other is None or defined & other[1] for other_index, other in enumerate(names) if other_index != index)
+        if not needed_by_others:
+            independent.add(index)
+    return independent
@@ -0,0 +1,97 @@
+import re
+import threading
+
+
+class CompletionCheckPolicy:
+    '''
+    Completion Check Policy class
+
+    Decides whether ChatAssistant.recursion needs to ask the model if the problem has been solved.
+    The remote check costs a full chat completion, so in "heuristic" mode it is skipped when the turn produced no code block,
+    no interpreter error and no "next step" markers, since the model has nothing left to continue.
+    It is never run while the turn's code is still running in a background job, as its output has not come back yet.
+
+    Attributes:
+        mode (str): "heuristic" to gate the remote check, "always" to always run it, "never" to never run it
+        check_model (str): The chat model used for the remote check, e.g. a cheaper model than the one answering the user
+
+    Methods:
+        needs_remote_check(self, gpt_response: str, interpreter_output: dict = None):
+        Returns True if the remote check should be run for the turn
+        record_result(self, unfinished: bool):
+        Records the answer of a remote check
+        report(self):
+        Returns how often each path was taken
+    '''
+    NEXT_STEP_MARKERS = re.compile(r"\b(next step|next,? (i|we)('ll| will)|let me|(i|we)('ll| will) now|step \d+|then (i|we)('ll| will)|continu(e|ing) (with|to|by))\b", re.IGNORECASE)
+    INTERPRETER_ERRORS = re.compile(r"^Failed to execute the code|Traceback \(most recent call last\)|\b\w*(Error|Exception):", re.MULTILINE)
+
+    def __init__(self, mode: str = "heuristic", check_model: str = "gpt-4"):
+        '''
+        Constructor for the CompletionCheckPolicy class
+        '''
+        self.mode = mode
+        self.check_model = check_model
+
+        self.counters = {
+            "skipped": 0,
+            #skipped because the code was still running in a background job
+            "background_job": 0,
+            "remote": 0,
+            "remote_unfinished": 0,
+            #why the heuristic gate let the remote check through
+            "code_block": 0,
+            "interpreter_error": 0,
+            "next_step_marker": 0,
+        }
+        self.lock = threading.Lock()
+
+    def count(self, *names):
+        with self.lock:
+            for name in names:
+                self.counters[name] += 1
+
+    def needs_remote_check(self, gpt_response: str, interpreter_output: dict = None):
+        '''
+        Returns True if the remote check should be run for a turn that produced gpt_response and interpreter_output
+        '''
+        if interpreter_output is not None and interpreter_output.get("status") in ("background", "busy"):
+            self.count("skipped", "background_job")
+            return False
+        if self.mode == "never":
+            self.count("skipped")
+            return False
+        if self.mode == "always":
+            self.count("remote")
+            return True
+
+        reasons = []
+        if interpreter_output is not None or "```" in (gpt_response or ""):
+            reasons.append("code_block")
+        if interpreter_output is not None and self.INTERPRETER_ERRORS.search(str(interpreter_output.get("result", ""))):
+            reasons.append("interpreter_error")
+        if self.NEXT_STEP_MARKERS.search(gpt_response or ""):
+            reasons.append("next_step_marker")
+
+        if not reasons:
+            self.count("skipped")
+            return False
+        self.count("remote", *reasons)
+        return True
+
+    def record_result(self, unfinished: bool):
+        '''
+        Records the answer of a remote check
+        '''
+        if unfinished:
+            self.count("remote_unfinished")
+
+    def report(self):
+        '''
+        Returns how often each path was taken
+        '''
+        with self.lock:
+            report = dict(self.counters)
+        checks = report["skipped"] + report["remote"]
+        report["skip_rate"] = (report["skipped"] / checks) if checks else None
+        return report
@@ -0,0 +1,302 @@
+import re
+import threading
+import time
+import openai
+from collections import OrderedDict
+
+#The labels the context classifier can select, see ChatAssistant.generate_gpt_response
+LABELS = ["math", "code", "internet", "file", "download", "creative", "standard"]
+
+#Few-shot examples used by the remote classifier prompt
+FEW_SHOT_EXAMPLES = [
+    ("Search up \"ThePirateBay.com\" on google", "internet"),
+    ("Solve for x in the equation 2x + 3 = 7", "math"),
+    ("Write a program to print \"Hello World\"", "code"),
+    ("What is the capital of France?", "standard"),
+    ("Use the internet to find the capital of france", "internet"),
+    ("File hello.png saved to disk successfully!\"", "file"),
+    ("make a download link for the file", "download"),
+    ("create an imaage/picture of an astronaut", "creative"),
+]
+
+#Labeled messages that are not in the remote prompt and were not used to write the local classifier's rules,
+#so both classifiers are measured on messages neither was tuned to
+HELD_OUT_EXAMPLES = [
+    ("What's 15% of 240?", "math"),
+    ("Find the roots of x^2 - 5x + 6", "math"),
+    ("How many ways can I arrange 6 books on a shelf?", "math"),
+    ("Convert 98.6 degrees Fahrenheit to Celsius", "math"),
+    ("Can you fix this TypeError in my pandas code?", "code"),
+    ("Write a function that reverses a linked list", "code"),
+    ("How do I read a CSV file in Python?", "code"),
+    ("Refactor this loop into a list comprehension", "code"),
+    ("What's the weather in Tokyo right now?", "internet"),
+    ("Who won the football match last night?", "internet"),
+    ("Check the latest version of numpy on PyPI", "internet"),
+    ("Find me reviews of the new iPhone", "internet"),
+    ("File sales_2023.xlsx saved to disk successfully!", "file"),
+    ("File notes.txt saved to disk successfully!", "file"),
+    ("Babbage Python Interpreter: data.csv loaded", "file"),
+    ("Give me a link so I can save the chart", "download"),
+    ("Let me download the cleaned dataset as a CSV", "download"),
+    ("Export the results so I can grab them", "download"),
+    ("Draw a cat wearing a space helmet", "creative"),
+    ("Paint me a sunset over the mountains", "creative"),
+    ("Write a short poem about autumn", "creative"),
+    ("Design a logo for my coffee shop", "creative"),
+    ("Who wrote Pride and Prejudice?", "standard"),
+    ("Tell me a joke", "standard"),
+    ("What's the difference between a virus and a bacterium?", "standard"),
+    ("Thanks, that helps a lot!", "standard"),
+]
+
+#Prompt for the remote classifier, the message to classify and "\nModel:" are appended to it
+REMOTE_PROMPT = "Decide what AI model to pass the message to. If the message has to do with math select \"math\", if the message has to do with \"code\" select \"code\", if the message has to do with internet access select \"internet\", if the model receives a message from the interpreter select \"file\", if the message has to do with downloading any kind of file select \"download\",If the message has to do with creating something other than code select \"creative\", if the message has to do with anything else select \"standard\"\n\n" + "\n".join(f"Message: {message}\nModel: {label.capitalize()}" for message, label in FEW_SHOT_EXAMPLES) + "\nMessage:"
+
+
+def classify_remotely(client, message: str):
+    '''
+    Runs the remote classifier, Davinci Instruct, on the message through client (an OpenAIClient.KeyClient)
+    Returns the selected label, or None if the classifier failed
+    '''
+    try:
+        response = client.create(
+            openai.Completion,
+            cache_type="classifier",
+            model="text-davinci-003",
+            prompt =REMOTE_PROMPT + message + "\nModel:",
+            temperature=0,
+            max_tokens=60,
+            top_p=1,
+            frequency_penalty=0.5,
+            presence_penalty=0
+        )
+
+        return response.choices[0].text
+
+    # Handle rate limit errors, the client has already retried with backoff so let the router use the local label
+    except openai.error.RateLimitError as error:
+        print(f"RateLimitError occurred: {error}")
+        return None
+    except openai.error.APIError as error:
+        print(f"APIError occurred: {error}")
+        return None
+    except Exception as error:
+        print(f"An unexpected error occurred: {error}")
+        return None
+
+
+class KeywordClassifier:
+    '''
+    Keyword Classifier class
+
+    Local, in-process replacement for the remote context classifier.
+    Each label has a list of weighted regex rules, the label with the highest total weight wins.
+
+    Methods:
+        classify(self, message: str):
+        Returns the best label and a confidence between 0 and 1
+    '''
+    RULES = {
+        #messages from the recursion checker must reach the model unchanged
+        "standard": [
+            (r"^automated task checker:", 10.0),
+        ],
+        "file": [
+            (r"\bsaved to disk\b", 3.0),
+            (r"^file\b", 1.0),
+            (r"\binterpreter\b", 1.0),
+        ],
+        "download": [
+            (r"\bdownload", 2.0),
+            (r"\blink (to|for) (the|this|that|my) file", 2.0),
+        ],
+        "creative": [
+            (r"\b(create|draw|generate|make|paint|design|render)\b.*\b(image|imaage|picture|photo|drawing|painting|logo|art|illustration|portrait)s?\b", 3.0),
+            (r"\b(image|picture|photo|drawing|painting)s? of\b", 2.0),
+            (r"\bdall-?e\b", 2.0),
+        ],
+        "internet": [
+            (r"\b(search|google|look up|lookup|browse|scrape)\b", 2.0),
+            (r"\b(internet|online|website|web ?page|web|url)\b", 1.5),
+            (r"https?://|\bwww\.|\b\w+\.(com|org|net|io|gov|edu)\b", 1.5),
+            (r"\b(latest|news|today|current|weather|price of)\b", 1.0),
+        ],
+        "math": [
+            (r"\b(solve|equation|integral|integrate|derivative|differentiate|calculate|compute|factorial|sqrt|square root|probability|matrix|logarithm)\b", 2.0),
+            (r"\d+\s*[-+*/^=]\s*\d+|\d[a-z]\b", 1.5),
+            (r"\b(sum|product|average|mean|median) of\b", 1.0),
+        ],
+        "code": [
+            #plots are drawn by running code, not by DALL-E
+            (r"\b(matplotlib|pyplot|plt|seaborn|plotly|ggplot|bokeh)\b", 6.0),
+            (r"\b(code|program|script|function|python|debug|bug|compile|algorithm|regex|sql|javascript|class)\b", 2.0),
+            (r"```|\bdef \w+\(|\bimport \w+", 2.0),
+            (r"\b(print|hello world)\b", 1.0),
+        ],
+    }
+
+    def __init__(self):
+        '''
+        Constructor for the KeywordClassifier class
+        '''
+        self.rules = {label: [(re.compile(pattern, re.IGNORECASE), weight) for pattern, weight in rules]
+                      for label, rules in self.RULES.items()}
+
+    def classify(self, message: str):
+        '''
+        Returns the best label for the message and a confidence between 0 and 1.
+        Messages that match no rule are "standard" with a confidence of 0.
+        '''
+        scores = {}
+        for label, rules in self.rules.items():
+            score = sum(weight for pattern, weight in rules if pattern.search(message))
+            if score:
+                scores[label] = score
+
+        if not scores:
+            return "standard", 0.0
+
+        label = max(scores, key=scores.get)
+        return label, scores[label] / sum(scores.values())
+
+
+class ContextRouter:
+    '''
+    Context Router class
+
+    Picks the prompt label for a message with a local classifier, caching the result by normalized message text.
+    Messages the local classifier is unsure about, including every message that matches none of its rules, are passed to the remote classifier.
+
+    Attributes:
+        classifier: The local classifier, any object with a classify(message) method returning (label, confidence)
+        use_remote_fallback (bool): Whether to ask the remote classifier when the local confidence is below fallback_threshold
+        fallback_threshold (float): The confidence below which the remote classifier is used
+        cache_size (int): The number of messages to keep in the LRU cache
+
+    Methods:
+        route(self, message: str, remote_classifier = None):
+        Returns the label for the message
+        will_ask_remote(self, message: str):
+        Returns True if routing the message will ask the remote classifier
+        report(self):
+        Returns call counts and mean latency for the cache, local and remote classifiers
+        evaluate(self, examples: list = HELD_OUT_EXAMPLES, remote_classifier = None):
+        Returns the accuracy and mean latency of the local and remote classifiers on labeled examples
+    '''
+    def __init__(self, classifier = None, use_remote_fallback: bool = True, fallback_threshold: float = 0.6, cache_size: int = 1024):
+        '''
+        Constructor for the ContextRouter class
+        '''
+        self.classifier = classifier if classifier is not None else KeywordClassifier()
+        self.use_remote_fallback = use_remote_fallback
+        self.fallback_threshold = fallback_threshold
+        self.cache_size = cache_size
+
+        #normalized message -> label
+        self.cache = OrderedDict()
+
+        #source -> [calls, total seconds]
+        self.stats = {"cache": [0, 0.0], "local": [0, 0.0], "remote": [0, 0.0]}
+
+        #how often the remote classifier agreed with the local one when both were run
+        self.remote_agreements = 0
+
+        self.lock = threading.Lock()
+
+    def normalize(self, message: str):
+        return " ".join(message.lower().split())
+
+    def record(self, source: str, seconds: float):
+        with self.lock:
+            self.stats[source][0] += 1
+            self.stats[source][1] += seconds
+
+    def route(self, message: str, remote_classifier = None):
+        '''
+        Returns the label for the message.
+        remote_classifier is a callable taking the message and returning a label, or None if it failed.
+        '''
+        key = self.normalize(message)
+
+        start = time.perf_counter()
+        with self.lock:
+            label = self.cache.get(key)
+            if label is not None:
+                self.cache.move_to_end(key)
+        if label is not None:
+            self.record("cache", time.perf_counter() - start)
+            return label
+
+        start = time.perf_counter()
+        label, confidence = self.classifier.classify(message)
+        self.record("local", time.perf_counter() - start)
+
+        #a label the remote classifier was asked for but did not give (e.g. a transient error) is not cached, the next call asks again
+        cacheable = True
+        if self.use_remote_fallback and remote_classifier is not None and confidence < self.fallback_threshold:
+            start = time.perf_counter()
+            remote_label = remote_classifier(message)
+            self.record("remote", time.perf_counter() - start)
+
+            #keep the local label if the remote classifier failed or returned something unknown
+            remote_label = str(remote_label).lower().strip()
+            if remote_label in LABELS:
+                if remote_label == label:
+                    with self.lock:
+                        self.remote_agreements += 1
+                label = remote_label
+            else:
+                cacheable = False
+
+        if cacheable:
+            with self.lock:
+                self.cache[key] = label
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        return label
+
+    def will_ask_remote(self, message: str):
+        '''
+        Returns True if routing the message will ask the remote classifier (if one is given), the only slow way a message is routed
+        '''
+        if not self.use_remote_fallback:
+            return False
+        with self.lock:
+            if self.normalize(message) in self.cache:
+                return False
+        return self.classifier.classify(message)[1] < self.fallback_threshold
+
+    def report(self):
+        '''
+        Returns call counts and mean latency (ms) for the cache, local and remote classifiers
+        '''
+        with self.lock:
+            report = {source: {"calls": calls, "mean_latency_ms": (total / calls * 1000) if calls else 0.0}
+                      for source, (calls, total) in self.stats.items()}
+            remote_calls = self.stats["remote"][0]
+            report["remote"]["agreement_with_local"] = (self.remote_agreements / remote_calls) if remote_calls else None
+        return report
+
+    def evaluate(self, examples: list = HELD_OUT_EXAMPLES, remote_classifier = None):
+        '''
+        Returns the accuracy and mean latency (ms) of the local classifier, and of the remote classifier if given, on labeled examples.
+        By default on the held-out examples, as the local rules were written against the few-shot examples. Bypasses the cache.
+        '''
+        classifiers = {"local": lambda message: self.classifier.classify(message)[0]}
+        if remote_classifier is not None:
+            classifiers["remote"] = remote_classifier
+
+        results = {}
+        for name, classify in classifiers.items():
+            correct = 0
+            total_time = 0.0
+            for message, expected in examples:
+                start = time.perf_counter()
+                label = classify(message)
+                total_time += time.perf_counter() - start
+                if str(label).lower().strip() == expected:
+                    correct += 1
+            results[name] = {"accuracy": correct / len(examples), "mean_latency_ms": total_time / len(examples) * 1000}
+        return results
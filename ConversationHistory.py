@@ -0,0 +1,231 @@
+import sys
+# KYLE : : :  : pip install tiktoken
+import tiktoken #OpenAI package: Used for checking number of tokens in a string
+
+
+def load_encoding(model: str):
+    '''
+    Returns the tiktoken encoding for the model, or None if it cannot be loaded (e.g. no network to fetch the BPE file)
+    '''
+    try:
+        return tiktoken.encoding_for_model(model)
+    except Exception as error:
+        print(f"Failed to load tokenizer for {model}, estimating token counts instead: {error}")
+        return None
+
+
+class Message:
+    '''
+    A message in the conversation history, with its token count.
+    Roles and injected prompts are interned so every message shares one copy of them, and the dict sent to the API is built the first time it is needed.
+    Reads like the API's dict, e.g. message["content"].
+    '''
+    __slots__ = ("role", "content", "prompt", "tokens", "seq", "payload")
+
+    def __init__(self, role: str, content: str, prompt: str = None):
+        self.role = sys.intern(role)
+        self.content = content
+        #a prompt injected before the content, sent to the model as "prompt:::content" until it is rolled back
+        self.prompt = sys.intern(prompt) if prompt is not None else None
+        self.tokens = 0
+        #when the message was added to its history, None once it has been removed
+        self.seq = None
+        self.payload = None
+
+    @classmethod
+    def from_dict(cls, message):
+        return message if isinstance(message, Message) else cls(message["role"], message["content"])
+
+    def to_dict(self):
+        if self.payload is None:
+            content = self.content if self.prompt is None else f"{self.prompt}:::{self.content}"
+            self.payload = {"role": self.role, "content": content}
+        return self.payload
+
+    def __getitem__(self, key: str):
+        return self.to_dict()[key]
+
+    def get(self, key: str, default = None):
+        return self.to_dict().get(key, default)
+
+    def __repr__(self):
+        return f"Message({self.to_dict()!r})"
+
+
+class ConversationHistory(list):
+    '''
+    Conversation History class
+
+    The list of chat messages of a chat, held as Message records with a running token count, so the history can be held under a token budget
+    without re-tokenizing it on every call. Each message is tokenized once, when it is added.
+    Messages and prompts that only belong to one call (the recursion checker's question, the prompt injected for a route)
+    are added after a checkpoint and rolled back after it, touching only what was added rather than copying the history.
+
+    Attributes:
+        max_tokens (int): The token budget for the messages sent to the model
+        keep_recent (int): The number of most recent messages that are never trimmed
+        total_tokens (int): The number of tokens in the history
+
+    Methods:
+        compact(self):
+        Trims the oldest messages until the history fits in max_tokens
+        payload(self):
+        Returns the messages as the list of dicts sent to the API
+        inject(self, prompt: str):
+        Sends the last message with prompt injected before it, until it is rolled back
+        checkpoint(self):
+        Returns a mark to roll back to
+        rollback(self, mark: int, keep_messages: bool = False):
+        Removes the messages added and the prompts injected since the mark
+    '''
+    #tokens added by the chat format for every message, and to prime the reply
+    TOKENS_PER_MESSAGE = 3
+    TOKENS_PER_REPLY = 3
+
+    encodings = {}
+
+    def __init__(self, messages: list = (), model: str = "gpt-4", max_tokens: int = 6000, keep_recent: int = 4):
+        '''
+        Constructor for the ConversationHistory class
+        '''
+        super().__init__()
+        self.model = model
+        self.max_tokens = max_tokens
+        self.keep_recent = keep_recent
+
+        self.total_tokens = self.TOKENS_PER_REPLY
+
+        #counts the messages added and prompts injected, checkpoints are positions in this count
+        self.next_seq = 0
+
+        #(seq, message, the message's token count before the injection) of every prompt injected and not rolled back yet, newest last
+        self.injected = []
+
+        self.extend(messages)
+
+    def count_tokens(self, message):
+        '''
+        Returns the number of tokens a message (a Message or a dict) takes up in a chat completion request
+        '''
+        if self.model not in self.encodings:
+            self.encodings[self.model] = load_encoding(self.model)
+        encoding = self.encodings[self.model]
+
+        tokens = self.TOKENS_PER_MESSAGE
+        for value in (message.to_dict() if isinstance(message, Message) else message).values():
+            value = str(value)
+            #roughly 4 characters per token if the tokenizer is unavailable
+            tokens += len(encoding.encode(value)) if encoding else len(value) // 4 + 1
+        return tokens
+
+    def added(self, message):
+        '''
+        Returns the message as a Message record of this history, counted and numbered
+        '''
+        message = Message.from_dict(message)
+        message.tokens = self.count_tokens(message)
+        message.seq = self.next_seq
+        self.next_seq += 1
+        self.total_tokens += message.tokens
+        return message
+
+    def removed(self, messages):
+        for message in messages:
+            self.total_tokens -= message.tokens
+            message.seq = None
+
+    def append(self, message):
+        super().append(self.added(message))
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def __iadd__(self, messages):
+        self.extend(messages)
+        return self
+
+    def insert(self, index: int, message):
+        super().insert(index, self.added(message))
+
+    def pop(self, index: int = -1):
+        message = super().pop(index)
+        self.removed([message])
+        return message
+
+    def remove(self, message: Message):
+        self.pop(self.index(message))
+
+    def clear(self):
+        self.removed(self)
+        super().clear()
+
+    def __delitem__(self, index):
+        self.removed(self[index] if isinstance(index, slice) else [self[index]])
+        super().__delitem__(index)
+
+    def __setitem__(self, index, value):
+        self.removed(self[index] if isinstance(index, slice) else [self[index]])
+        value = [self.added(message) for message in value] if isinstance(index, slice) else self.added(value)
+        super().__setitem__(index, value)
+
+    def payload(self):
+        '''
+        Returns the messages as the list of dicts sent to the API, each dict built once and reused by later calls
+        '''
+        return [message.to_dict() for message in self]
+
+    def inject(self, prompt: str):
+        '''
+        Sends the last message to the model with prompt injected before it, as "prompt:::message", until it is rolled back
+        '''
+        message = self[-1]
+        self.injected.append((self.next_seq, message, message.tokens))
+        self.next_seq += 1
+        self.total_tokens -= message.tokens
+        message.prompt = sys.intern(prompt)
+        message.payload = None
+        message.tokens = self.count_tokens(message)
+        self.total_tokens += message.tokens
+
+    def checkpoint(self):
+        return self.next_seq
+
+    def rollback(self, mark: int, keep_messages: bool = False):
+        '''
+        Removes the messages added and the prompts injected since the checkpoint, touching only what is removed.
+        A message an injected prompt is removed from gets back the token count it had before, it is not tokenized again.
+        With keep_messages only the injected prompts are removed, e.g. once the model has answered a turn whose messages are kept.
+        '''
+        if not keep_messages:
+            while self and self[-1].seq is not None and self[-1].seq >= mark:
+                self.pop()
+        while self.injected and self.injected[-1][0] >= mark:
+            _, message, tokens = self.injected.pop()
+            if message.seq is not None:
+                self.total_tokens += tokens - message.tokens
+            message.prompt = None
+            message.payload = None
+            message.tokens = tokens
+
+    def compact(self):
+        '''
+        Trims the oldest messages (after the system prompt) until the history fits in max_tokens.
+        The token counts of the trimmed messages are subtracted from the running total, so nothing is re-tokenized;
+        removing them still shifts the rest of the list along, which is linear in the history length but only moves references.
+        '''
+        if self.total_tokens <= self.max_tokens:
+            return
+
+        #the system prompt is always kept
+        first = 1
+        last = len(self) - self.keep_recent
+
+        tokens = self.total_tokens
+        end = first
+        while tokens > self.max_tokens and end < last:
+            tokens -= self[end].tokens
+            end += 1
+
+        if end > first:
+            del self[first:end]
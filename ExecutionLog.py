@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import threading
+
+
+class ExecutionLog:
+    '''
+    Execution Log class
+
+    Append-only record of the code a chat has run and its outputs, one JSON line per execution.
+    Each execution appends a single line, so the cost of recording it stays the same however long the chat gets,
+    and the notebook is only built from the log when it is exported.
+
+    Attributes:
+        path (str): The JSON-lines file the executions are appended to
+        title (str): The heading of the exported notebook
+
+    Methods:
+        append(self, source: str, outputs: list):
+        Records an execution and its outputs
+        to_notebook(self):
+        Returns the executions as a notebook
+        export(self, path: str):
+        Writes the executions to an .ipynb file
+    '''
+    def __init__(self, path: str, title: str = ""):
+        '''
+        Constructor for the ExecutionLog class
+        '''
+        self.path = path
+        self.title = title
+
+        #number of executions in the log, counted from the file the first time it is needed (e.g. a session loaded from a session store)
+        self.count = None
+
+        self.lock = threading.Lock()
+
+    def execution_count(self):
+        '''
+        Returns the number of executions in the log. Call with the lock held.
+        '''
+        if self.count is None:
+            self.count = 0
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    self.count = sum(1 for _ in f)
+        return self.count
+
+    def append(self, source: str, outputs: list):
+        '''
+        Records an execution and its outputs (notebook outputs, as returned by the kernel pool).
+        Returns the execution count of the new entry.
+        '''
+        with self.lock:
+            execution_count = self.execution_count() + 1
+            entry = {"execution_count": execution_count, "time": time.time(), "source": source, "outputs": outputs}
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + "\n")
+            self.count = execution_count
+        return execution_count
+
+    def entries(self):
+        '''
+        Returns every execution in the log, oldest first
+        '''
+        with self.lock:
+            if not os.path.exists(self.path):
+                return []
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                #a line cut short by a crash part way through writing it
+                continue
+        return entries
+
+    def to_notebook(self):
+        '''
+        Returns the executions as a notebook, one code cell (with its outputs) per execution
+        '''
+        #imported on the first export rather than with the server
+        import nbformat
+        from nbformat.v4 import new_notebook, new_code_cell, new_markdown_cell
+
+        notebook = new_notebook()
+        if self.title:
+            notebook.cells.append(new_markdown_cell(self.title))
+        for entry in self.entries():
+            cell = new_code_cell(entry["source"], execution_count=entry["execution_count"])
+            cell.outputs = [nbformat.from_dict(output) for output in entry["outputs"]]
+            notebook.cells.append(cell)
+        return notebook
+
+    def export(self, path: str):
+        '''
+        Writes the executions to an .ipynb file, returns its path
+        '''
+        import nbformat
+
+        with open(path, 'w', encoding='utf-8') as f:
+            nbformat.write(self.to_notebook(), f)
+        return path
+
+    def delete(self):
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.count = 0
@@ -0,0 +1,196 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+
+class ImageStore:
+    '''
+    Image Store class
+
+    Keeps the images DALL-E generates on local disk, so chats show them from this server instead of OpenAI's URLs, which expire after an hour.
+    Each image is keyed by its prompt and size, and a prompt that was already drawn reuses its image without calling DALL-E again.
+    The image is downloaded in the background and stored under the hash of its content, next to a WebP copy and a WebP thumbnail made once when it arrives.
+    Until the download has finished the image is served from OpenAI's URL.
+
+    Attributes:
+        directory (str): Where images, their variants and the prompt index are stored
+        thumbnail_size (int): The longest side of the thumbnail variant, in pixels
+        fetch_timeout (int): Seconds a download may take
+
+    Methods:
+        key(self, prompt: str, size: str):
+        Returns the key of an image
+        lookup(self, key: str):
+        Returns the local URL of a stored or downloading image, or None
+        add(self, key: str, remote_url: str):
+        Downloads the image in the background, returns its local URL
+        locate(self, key: str, variant: str = None):
+        Returns where an image is: its file on disk, or the remote URL while it downloads
+        report(self):
+        Returns prompt hits, downloads and stored bytes
+    '''
+    #variant name -> file suffix
+    VARIANTS = {"webp": ".webp", "thumb": ".thumb.webp"}
+
+    #image keys and content digests are sha256 hex digests, anything else is never joined into a path
+    KEY = re.compile(r"[0-9a-f]{64}")
+
+    def __init__(self, directory: str = "images", thumbnail_size: int = 256, fetch_timeout: int = 30, max_workers: int = 2):
+        '''
+        Constructor for the ImageStore class
+        '''
+        self.directory = directory
+        self.thumbnail_size = thumbnail_size
+        self.fetch_timeout = fetch_timeout
+
+        #prompt key -> {"digest": content hash once downloaded, "remote_url": OpenAI's URL until then, "failed": whether the download failed}
+        self.images = {}
+
+        self.counters = {
+            "prompt_hits": 0,
+            "prompt_misses": 0,
+            "downloaded": 0,
+            "download_failed": 0,
+            "stored_bytes": 0,
+        }
+        self.lock = threading.Lock()
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        os.makedirs(os.path.join(directory, "prompts"), exist_ok=True)
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    def key(self, prompt: str, size: str):
+        return hashlib.sha256(json.dumps({"prompt": prompt, "size": size}).encode()).hexdigest()
+
+    def url(self, key: str):
+        return f"/images/{key}"
+
+    def index_path(self, key: str):
+        return os.path.join(self.directory, "prompts", key)
+
+    def entry(self, key: str):
+        '''
+        Returns the image's entry, reading it from the prompt index on disk if this process has not seen it yet (e.g. after a restart)
+        '''
+        with self.lock:
+            entry = self.images.get(key)
+        if entry is None and os.path.exists(self.index_path(key)):
+            with open(self.index_path(key), 'r') as f:
+                entry = {"digest": f.read().strip(), "remote_url": None, "failed": False}
+            with self.lock:
+                entry = self.images.setdefault(key, entry)
+        return entry
+
+    def lookup(self, key: str):
+        '''
+        Returns the local URL of an image that is stored or downloading, or None if the prompt has not been drawn (or its download failed)
+        '''
+        entry = self.entry(key)
+        if entry is None or entry["failed"]:
+            self.count("prompt_misses")
+            return None
+        self.count("prompt_hits")
+        return self.url(key)
+
+    def add(self, key: str, remote_url: str):
+        '''
+        Starts downloading a generated image and returns its local URL
+        '''
+        with self.lock:
+            self.images[key] = {"digest": None, "remote_url": remote_url, "failed": False}
+        self.executor.submit(self.fetch, key, remote_url)
+        return self.url(key)
+
+    def fetch(self, key: str, remote_url: str):
+        '''
+        Downloads an image, stores it under the hash of its content with its variants, and records it in the prompt index
+        '''
+        try:
+            response = requests.get(remote_url, timeout=self.fetch_timeout)
+            response.raise_for_status()
+            content = response.content
+            digest = hashlib.sha256(content).hexdigest()
+
+            #identical images are stored once
+            original = os.path.join(self.directory, digest + ".png")
+            if not os.path.exists(original):
+                stored = self.write_variants(digest, content)
+                self.write(original, content)
+                self.count("stored_bytes", len(content) + stored)
+
+            self.write(self.index_path(key), digest)
+        except Exception as error:
+            print(f"Failed to download image {key}: {error}")
+            with self.lock:
+                self.images[key]["failed"] = True
+            self.count("download_failed")
+            return
+
+        with self.lock:
+            self.images[key] = {"digest": digest, "remote_url": None, "failed": False}
+        self.count("downloaded")
+
+    def write_variants(self, digest: str, content: bytes):
+        '''
+        Writes the WebP copy and the thumbnail of an image, returns the bytes written
+        '''
+        #imported with the first image rather than with the server, see Warmup
+        from PIL import Image
+
+        image = Image.open(BytesIO(content))
+        image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+        thumbnail = image.copy()
+        thumbnail.thumbnail((self.thumbnail_size, self.thumbnail_size))
+
+        written = 0
+        for variant, picture in (("webp", image), ("thumb", thumbnail)):
+            buffer = BytesIO()
+            picture.save(buffer, "WEBP", quality=80)
+            self.write(os.path.join(self.directory, digest + self.VARIANTS[variant]), buffer.getvalue())
+            written += buffer.tell()
+        return written
+
+    def write(self, path: str, content):
+        '''
+        Writes a file under a temporary name and moves it into place, so a file is never served half written
+        '''
+        temporary_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary_path, 'wb' if isinstance(content, bytes) else 'w') as f:
+            f.write(content)
+        os.replace(temporary_path, path)
+
+    def locate(self, key: str, variant: str = None):
+        '''
+        Returns ("file", file name in directory) for a stored image or variant, ("remote", OpenAI's URL) while it downloads,
+        or None for an unknown or malformed key or variant
+        '''
+        if not self.KEY.fullmatch(key) or (variant is not None and variant not in self.VARIANTS):
+            return None
+        entry = self.entry(key)
+        if entry is None:
+            return None
+        if entry["digest"] is not None:
+            if not self.KEY.fullmatch(entry["digest"]):
+                return None
+            return ("file", entry["digest"] + (self.VARIANTS[variant] if variant else ".png"))
+        #OpenAI's URL still works for a while after a failed download
+        if entry["remote_url"] is not None:
+            return ("remote", entry["remote_url"])
+        return None
+
+    def report(self):
+        '''
+        Returns prompt hits and misses, downloads and the bytes stored by this process
+        '''
+        with self.lock:
+            report = dict(self.counters)
+            report["images"] = len(self.images)
+        return report
@@ -0,0 +1,233 @@
+import time
+import uuid as uuid_module
+import threading
+
+
+class Job:
+    '''
+    A code execution started by the job manager, and what it has printed so far
+    '''
+    def __init__(self, session_id: str, code: str, collector):
+        self.id = uuid_module.uuid4().hex
+        self.session_id = session_id
+        self.code = code
+        self.collector = collector
+
+        #"running" until the execution returns, then "finished"
+        self.status = "running"
+        #whether the request that started the job stopped waiting for it
+        self.background = False
+        #whether the job was finished without its execution, which did not stop when interrupted; the execution's own result is dropped
+        self.abandoned = False
+        #the interpreter output of the execution, once it has finished
+        self.result = None
+
+        self.started = time.time()
+        self.finished = None
+        self.done = threading.Event()
+
+        #called with the job when a background job finishes
+        self.callbacks = []
+
+    def report(self, max_chars: int = 2000):
+        '''
+        Returns the job's status, its progress and its output so far
+        '''
+        report = {
+            "job_id": self.id,
+            "uuid": self.session_id,
+            "status": self.status,
+            "background": self.background,
+            "elapsed_seconds": round((self.finished or time.time()) - self.started, 3),
+            "output_bytes": self.collector.bytes,
+            "output_lines": self.collector.lines,
+            "partial_output": self.collector.text(max_chars),
+        }
+        if self.result is not None:
+            report["result"] = self.result
+        return report
+
+
+class JobManager:
+    '''
+    Job Manager class
+
+    Runs code executions so that long ones do not tie up the HTTP request that started them.
+    Every execution starts on its own thread and the request waits for it as before. If it is still running after threshold seconds,
+    it is handed over to one of max_jobs background slots with timeout seconds to finish, and the request goes on with the job's id.
+    When every slot is taken the request keeps waiting up to its own timeout, so the number of background executions stays bounded.
+    Code that is then interrupted gets grace seconds to stop, otherwise the request restarts the kernel and abandons the job.
+    Finished jobs are kept for keep_seconds so their status and result can still be looked up.
+
+    Attributes:
+        max_jobs (int): The maximum number of executions running in the background at once
+        threshold (float): Seconds an execution runs for before it is moved to the background, or None to never move executions
+        timeout (int): Seconds a background execution may run for before it is interrupted
+        keep_seconds (int): Seconds a finished job is kept for
+        grace (float): Seconds interrupted code is given to stop before its kernel is restarted
+
+    Methods:
+        start(self, session_id: str, code: str, collector, run):
+        Starts run() (the execution) on a new thread and returns its Job
+        hand_off(self, job: Job, callback):
+        Moves a running job to a background slot
+        get(self, job_id: str):
+        Returns the job with the given id, or None
+        abandon(self, job: Job, result: dict):
+        Finishes a job whose execution did not stop when interrupted with the given result
+        active(self, session_id: str):
+        Returns the session's jobs that are still running
+        report(self):
+        Returns how many executions finished inline, moved to the background or had to wait for a slot
+    '''
+    def __init__(self, max_jobs: int = 4, threshold: float = 20.0, timeout: int = 1800, keep_seconds: int = 3600, grace: float = 5.0):
+        '''
+        Constructor for the JobManager class
+        '''
+        self.max_jobs = max_jobs
+        self.threshold = threshold
+        self.timeout = timeout
+        self.keep_seconds = keep_seconds
+        self.grace = grace
+
+        self.slots = threading.BoundedSemaphore(max_jobs)
+
+        #job id -> Job
+        self.jobs = {}
+
+        self.counters = {
+            "inline": 0,
+            "background": 0,
+            #executions past the threshold that found every background slot taken
+            "no_slot": 0,
+            "background_finished": 0,
+            #executions that ignored the interrupt, whose kernel was restarted
+            "abandoned": 0,
+        }
+        self.lock = threading.Lock()
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def prune(self):
+        '''
+        Forgets jobs that finished more than keep_seconds ago. Call with the lock held.
+        '''
+        now = time.time()
+        expired = [job_id for job_id, job in self.jobs.items() if job.finished is not None and now - job.finished > self.keep_seconds]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def start(self, session_id: str, code: str, collector, run):
+        '''
+        Starts run() on a new thread and returns its Job. run() executes the code and returns its interpreter output.
+        '''
+        job = Job(session_id, code, collector)
+        with self.lock:
+            self.prune()
+            self.jobs[job.id] = job
+        threading.Thread(target=self.run_job, args=(job, run), daemon=True).start()
+        return job
+
+    def run_job(self, job: Job, run):
+        try:
+            result = run()
+        except Exception as error:
+            result = {"result": f"Failed to execute the code. Error: {str(error)}", "status": "error"}
+
+        with self.lock:
+            if job.abandoned:
+                return
+            job.result = result
+            job.status = "finished"
+            job.finished = time.time()
+            background = job.background
+
+        if background:
+            self.slots.release()
+            self.count("background_finished")
+            for callback in job.callbacks:
+                try:
+                    callback(job)
+                except Exception as error:
+                    print(f"Background job {job.id} callback failed: {error}")
+            #the callbacks hold their chat, which is cleaned up once nothing refers to it
+            job.callbacks = []
+        else:
+            self.count("inline")
+        #set once the callbacks have run, so whoever waits for a background job also sees its output in the chat's messages
+        job.done.set()
+
+    def wait(self, job: Job, timeout: float = None):
+        '''
+        Waits up to timeout seconds for the job to finish, returns True if it has
+        '''
+        return job.done.wait(timeout)
+
+    def hand_off(self, job: Job, callback = None):
+        '''
+        Moves a running job to a background slot, callback(job) is called when it finishes.
+        Returns False if the job has already finished or every slot is taken, the caller then keeps waiting for it.
+        '''
+        if not self.slots.acquire(blocking=False):
+            self.count("no_slot")
+            return False
+        with self.lock:
+            if job.status == "finished":
+                handed_off = False
+            else:
+                job.background = True
+                if callback is not None:
+                    job.callbacks.append(callback)
+                handed_off = True
+        if not handed_off:
+            self.slots.release()
+            return False
+        self.count("background")
+        return True
+
+    def abandon(self, job: Job, result: dict):
+        '''
+        Finishes a job that is not in the background and whose execution did not stop when interrupted, with result, once its kernel has been shut down.
+        The execution's thread may stay blocked until its own timeout, what it returns then is dropped.
+        Returns False if the job has finished meanwhile.
+        '''
+        with self.lock:
+            if job.status == "finished":
+                return False
+            job.abandoned = True
+            job.result = result
+            job.status = "finished"
+            job.finished = time.time()
+        self.count("abandoned")
+        job.done.set()
+        return True
+
+    def get(self, job_id: str):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def active(self, session_id: str):
+        '''
+        Returns the session's jobs that are still running
+        '''
+        with self.lock:
+            return [job for job in self.jobs.values() if job.session_id == session_id and job.status == "running"]
+
+    def jobs_for(self, session_id: str):
+        '''
+        Returns the session's jobs, oldest first
+        '''
+        with self.lock:
+            return sorted((job for job in self.jobs.values() if job.session_id == session_id), key=lambda job: job.started)
+
+    def report(self):
+        '''
+        Returns how many executions finished inline, moved to the background or had to wait for a slot, and the jobs running now
+        '''
+        with self.lock:
+            report = dict(self.counters)
+            report["running"] = sum(1 for job in self.jobs.values() if job.status == "running")
+            report["running_background"] = sum(1 for job in self.jobs.values() if job.status == "running" and job.background)
+        return report
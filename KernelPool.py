@@ -0,0 +1,308 @@
+import os
+import tempfile
+import threading
+import time
+from OutputCollector import OutputCollector
+
+
+class PooledKernel:
+    '''
+    A running IPython kernel and the blocking client used to talk to it
+    '''
+    def __init__(self, kernel_manager, kernel_client):
+        self.kernel_manager = kernel_manager
+        self.kernel_client = kernel_client
+
+        #only one cell may run on a kernel at a time
+        self.lock = threading.Lock()
+
+        #executions that were handed the kernel and have not finished, counted under the pool lock so it is never evicted in between
+        self.users = 0
+
+        #used for idle-timeout and LRU eviction
+        self.last_used = time.monotonic()
+
+    def is_alive(self):
+        return self.kernel_manager.is_alive()
+
+    def in_use(self):
+        return self.users > 0 or self.lock.locked()
+
+    def shutdown(self):
+        '''
+        Stops the client channels and kills the kernel process
+        '''
+        try:
+            self.kernel_client.stop_channels()
+            self.kernel_manager.shutdown_kernel(now=True)
+        except Exception as error:
+            print(f"Failed to shut down kernel: {error}")
+
+
+class KernelPool:
+    '''
+    Kernel Pool class
+
+    Keeps IPython kernels alive between code executions so that a ChatAssistant does not pay a cold kernel start on every message.
+
+    Attributes:
+        pool_size (int): The number of pre-started idle kernels to keep ready for new sessions
+        max_kernels (int): The maximum number of kernels (idle and assigned) that may run at once
+        idle_timeout (int): Seconds a session kernel may go unused before it is shut down
+        startup_timeout (int): Seconds to wait for a new kernel to become ready
+
+    Methods:
+        assign(self, uuid: str):
+        Hands a pre-started kernel to a new session, if one is ready
+        acquire(self, uuid: str, evict: bool = True, use: bool = False):
+        Returns the session's kernel, starting one if needed
+        execute(self, uuid: str, code: str, cwd: str, timeout: int = 60, collector: OutputCollector = None):
+        Runs code in the session's kernel and returns the collected output
+    '''
+    def __init__(self, pool_size: int = 2, max_kernels: int = 20, idle_timeout: int = 900, startup_timeout: int = 60):
+        '''
+        Constructor for the KernelPool class
+        '''
+        self.pool_size = pool_size
+        self.max_kernels = max_kernels
+        self.idle_timeout = idle_timeout
+        self.startup_timeout = startup_timeout
+
+        #pre-started kernels that have not been handed to a session yet
+        self.idle_kernels = []
+
+        #uuid -> PooledKernel
+        self.session_kernels = {}
+
+        #number of kernels currently being started, counted against max_kernels
+        self.starting = 0
+
+        self.lock = threading.Lock()
+
+    def start_kernel(self):
+        '''
+        Starts a new IPython kernel and waits for it to be ready
+        '''
+        # KYLE : : :  : pip install jupyter_client ipykernel (installed alongside nbclient)
+        #imported with the first kernel rather than with the server, see Warmup
+        from jupyter_client import KernelManager
+
+        kernel_manager = KernelManager(kernel_name="python3")
+        #start outside of any sandbox, which may be deleted while the kernel is still running
+        kernel_manager.start_kernel(cwd=tempfile.gettempdir())
+        kernel_client = kernel_manager.client()
+        kernel_client.start_channels()
+        try:
+            kernel_client.wait_for_ready(timeout=self.startup_timeout)
+        except RuntimeError:
+            kernel_client.stop_channels()
+            kernel_manager.shutdown_kernel(now=True)
+            raise
+        return PooledKernel(kernel_manager, kernel_client)
+
+    def kernel_count(self):
+        return len(self.idle_kernels) + len(self.session_kernels) + self.starting
+
+    def fill(self):
+        '''
+        Starts kernels until the idle pool is full or the kernel cap is reached
+        '''
+        while True:
+            with self.lock:
+                if len(self.idle_kernels) + self.starting >= self.pool_size or self.kernel_count() >= self.max_kernels:
+                    return
+                self.starting += 1
+            try:
+                kernel = self.start_kernel()
+            except Exception as error:
+                print(f"Failed to pre-start kernel: {error}")
+                with self.lock:
+                    self.starting -= 1
+                return
+            with self.lock:
+                self.starting -= 1
+                self.idle_kernels.append(kernel)
+
+    def prestart(self):
+        '''
+        Refills the idle pool in the background
+        '''
+        threading.Thread(target=self.fill, daemon=True).start()
+
+    def warm(self):
+        '''
+        Fills the idle pool and waits until every kernel being started is ready, e.g. before the server accepts traffic
+        '''
+        self.fill()
+        #kernels started by an earlier prestart() are counted in starting, not filled again
+        deadline = time.monotonic() + self.startup_timeout
+        while self.starting and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return len(self.idle_kernels)
+
+    def assign(self, uuid: str):
+        '''
+        Hands a pre-started kernel to a new session, if one is ready.
+        If the pool is empty the session kernel is started on first execution instead.
+        '''
+        with self.lock:
+            if uuid not in self.session_kernels and self.idle_kernels:
+                kernel = self.idle_kernels.pop()
+                kernel.last_used = time.monotonic()
+                self.session_kernels[uuid] = kernel
+        self.prestart()
+
+    def acquire(self, uuid: str, evict: bool = True, use: bool = False):
+        '''
+        Returns the kernel for the session, taking one from the idle pool or starting one if needed.
+        At the kernel cap the least recently used kernel of another session that is not in use is shut down to make room,
+        unless evict is False: then None is returned and no kernel is started.
+        With use set the kernel is marked in use before it is returned, so it cannot be evicted before the caller runs code on it;
+        the caller must call done(kernel) afterwards.
+        '''
+        self.evict_idle()
+
+        with self.lock:
+            kernel = self.session_kernels.get(uuid)
+            if kernel is not None and not kernel.is_alive():
+                #the kernel died (e.g. the code called exit()), start over with a fresh one
+                del self.session_kernels[uuid]
+                kernel.shutdown()
+                kernel = None
+            if kernel is None and self.idle_kernels:
+                kernel = self.idle_kernels.pop()
+                self.session_kernels[uuid] = kernel
+            if kernel is not None:
+                kernel.last_used = time.monotonic()
+                if use:
+                    kernel.users += 1
+                return kernel
+
+            #no kernel available, make room under the cap before starting one
+            evicted = None
+            if not evict and self.kernel_count() >= self.max_kernels:
+                return None
+            candidates = [key for key, running in self.session_kernels.items() if not running.in_use()]
+            if self.kernel_count() >= self.max_kernels and candidates:
+                evicted = self.session_kernels.pop(min(candidates, key=lambda key: self.session_kernels[key].last_used))
+            self.starting += 1
+
+        if evicted is not None:
+            evicted.shutdown()
+        try:
+            kernel = self.start_kernel()
+        finally:
+            with self.lock:
+                self.starting -= 1
+
+        with self.lock:
+            #another request for the same session may have won the race
+            existing = self.session_kernels.get(uuid)
+            if existing is None:
+                self.session_kernels[uuid] = kernel
+            if use:
+                (kernel if existing is None else existing).users += 1
+        if existing is not None:
+            kernel.shutdown()
+            kernel = existing
+        kernel.last_used = time.monotonic()
+        self.prestart()
+        return kernel
+
+    def done(self, kernel: PooledKernel):
+        '''
+        Marks a kernel returned by acquire(use=True) as no longer in use
+        '''
+        with self.lock:
+            kernel.users -= 1
+
+    def release(self, uuid: str):
+        '''
+        Shuts down the kernel belonging to the session
+        '''
+        with self.lock:
+            kernel = self.session_kernels.pop(uuid, None)
+        if kernel is not None:
+            kernel.shutdown()
+
+    def interrupt(self, uuid: str):
+        '''
+        Interrupts the code running in the session's kernel, keeping the kernel and its variables
+        '''
+        with self.lock:
+            kernel = self.session_kernels.get(uuid)
+        if kernel is not None:
+            kernel.kernel_manager.interrupt_kernel()
+
+    def memory(self, uuid: str):
+        '''
+        Returns the resident memory of the session's kernel process in bytes, or 0 if it has none or it cannot be read (e.g. not on Linux)
+        '''
+        with self.lock:
+            kernel = self.session_kernels.get(uuid)
+        if kernel is None:
+            return 0
+        try:
+            pid = kernel.kernel_manager.provisioner.process.pid
+            with open(f"/proc/{pid}/statm", 'r') as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (AttributeError, OSError, ValueError, IndexError):
+            return 0
+
+    def evict_idle(self):
+        '''
+        Shuts down session kernels that have not been used within idle_timeout
+        '''
+        now = time.monotonic()
+        with self.lock:
+            expired = [uuid for uuid, kernel in self.session_kernels.items()
+                       if now - kernel.last_used > self.idle_timeout and not kernel.in_use()]
+            kernels = [self.session_kernels.pop(uuid) for uuid in expired]
+        for kernel in kernels:
+            kernel.shutdown()
+
+    def execute(self, uuid: str, code: str, cwd: str, timeout: int = 60, collector: OutputCollector = None):
+        '''
+        Runs code in the session's kernel from the given working directory.
+        Returns the OutputCollector (a new one if none is given) holding everything the code printed, returned, displayed or raised.
+        Code that runs for longer than timeout seconds, or whose output passes the collector's caps, is interrupted,
+        with collector.timed_out or collector.capped set and the output so far kept.
+        '''
+        if collector is None:
+            collector = OutputCollector()
+
+        kernel = self.acquire(uuid, use=True)
+        try:
+            with kernel.lock:
+                client = kernel.kernel_client
+
+                #point the kernel at the sandbox for this execution
+                client.execute_interactive(f"__import__('os').chdir({cwd!r})", silent=True, store_history=False, timeout=self.startup_timeout)
+
+                #stop runaway output as soon as it passes the cap, rather than buffering it until the timeout
+                collector.on_cap = kernel.kernel_manager.interrupt_kernel
+                try:
+                    reply = client.execute_interactive(code, timeout=timeout, output_hook=collector.hook, allow_stdin=False)
+                    if reply['content']['status'] == 'error' and collector.error is None:
+                        collector.error = f"{reply['content']['ename']}: {reply['content']['evalue']}"
+                except TimeoutError:
+                    #stop the runaway code but keep the kernel (and its variables) alive
+                    kernel.kernel_manager.interrupt_kernel()
+                    collector.timed_out = True
+                finally:
+                    kernel.last_used = time.monotonic()
+        finally:
+            self.done(kernel)
+
+        return collector
+
+    def shutdown_all(self):
+        '''
+        Shuts down every kernel in the pool
+        '''
+        with self.lock:
+            kernels = self.idle_kernels + list(self.session_kernels.values())
+            self.idle_kernels = []
+            self.session_kernels = {}
+        for kernel in kernels:
+            kernel.shutdown()
@@ -0,0 +1,168 @@
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+
+def percentile(values: list, percent: float):
+    '''
+    Returns the nearest-rank percentile of values, or 0.0 if there are none
+    '''
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(percent / 100 * len(values)) - 1))]
+
+
+class Metrics:
+    '''
+    Metrics class
+
+    Records how long each stage of a turn takes and how many tokens each model call uses, for the /metrics endpoint.
+    Stage timings go into Prometheus histograms, and into the breakdown of the current request if one is being collected.
+
+    Attributes:
+        prefix (str): Prefix of every metric name
+        buckets (tuple): Upper bounds (seconds) of the stage latency histogram buckets
+
+    Methods:
+        span(self, stage: str, **labels):
+        Context manager that times a stage
+        increment(self, name: str, value: float = 1, **labels):
+        Adds value to a counter
+        collect(self):
+        Context manager that collects the stages timed on this thread, for a per-request breakdown
+        render(self):
+        Returns every metric in the Prometheus text format
+    '''
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, prefix: str = "gptx", buckets: tuple = BUCKETS):
+        '''
+        Constructor for the Metrics class
+        '''
+        self.prefix = prefix
+        self.buckets = buckets
+
+        #(stage, labels) -> [count in each bucket, count, sum]
+        self.histograms = {}
+
+        #(name, labels) -> value
+        self.counters = {}
+
+        #callables returning {metric name: value} for gauges owned by other components, e.g. the kernel pool
+        self.collectors = []
+
+        #breakdown of the request being handled on each thread
+        self.local = threading.local()
+
+        self.lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float, **labels):
+        '''
+        Records that a stage took seconds
+        '''
+        key = (stage, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][index] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+        breakdown = getattr(self.local, "breakdown", None)
+        if breakdown is not None:
+            breakdown.append({"stage": stage, **labels, "ms": round(seconds * 1000, 3)})
+
+    @contextmanager
+    def span(self, stage: str, **labels):
+        '''
+        Times the body of the with block as stage, whether or not it raises
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def register(self, collector):
+        '''
+        Adds a callable returning {metric name: value}, rendered as gauges on every scrape
+        '''
+        self.collectors.append(collector)
+
+    @contextmanager
+    def collect(self):
+        '''
+        Collects the stages timed on this thread while the with block runs.
+        Yields the list the breakdown is collected into, with one {"stage", labels..., "ms"} entry per span in the order they finished.
+        '''
+        previous = getattr(self.local, "breakdown", None)
+        self.local.breakdown = breakdown = []
+        try:
+            yield breakdown
+        finally:
+            self.local.breakdown = previous
+
+    def attach(self, breakdown: list):
+        '''
+        Collects the stages timed on this thread into an existing breakdown, e.g. on a worker thread running a streamed turn.
+        Pass None to stop collecting.
+        '''
+        self.local.breakdown = breakdown
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ""
+        escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+    def render(self):
+        '''
+        Returns every metric in the Prometheus text exposition format
+        '''
+        with self.lock:
+            histograms = {key: (list(buckets), count, total) for key, (buckets, count, total) in self.histograms.items()}
+            counters = dict(self.counters)
+
+        name = f"{self.prefix}_stage_seconds"
+        lines = [f"# HELP {name} Time spent in each stage of a turn", f"# TYPE {name} histogram"]
+        for (stage, labels), (buckets, count, total) in sorted(histograms.items()):
+            labels = (("stage", stage),) + labels
+            for bound, bucket_count in zip(self.buckets, buckets):
+                lines.append(f"{name}_bucket{self.format_labels(labels + (('le', bound),))} {bucket_count}")
+            lines.append(f"{name}_bucket{self.format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{self.format_labels(labels)} {total}")
+            lines.append(f"{name}_count{self.format_labels(labels)} {count}")
+
+        typed = set()
+        for (counter, labels), value in sorted(counters.items()):
+            name = f"{self.prefix}_{counter}_total"
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{self.format_labels(labels)} {value}")
+
+        for collector in self.collectors:
+            try:
+                values = collector()
+            except Exception as error:
+                print(f"Failed to collect metrics: {error}")
+                continue
+            for gauge, value in sorted(values.items()):
+                if value is None:
+                    continue
+                name = f"{self.prefix}_{gauge}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
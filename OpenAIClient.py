@@ -0,0 +1,380 @@
+import time
+import random
+import hashlib
+import weakref
+import threading
+from collections import deque
+import openai
+from openai.util import convert_to_openai_object
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class PooledSession(requests.Session):
+    '''
+    requests Session shared by every thread that calls OpenAI.
+    openai closes its session every few minutes on each thread, which would drop the pooled connections of every other thread,
+    so close() keeps the pool and shutdown() really closes it.
+    '''
+    def close(self):
+        pass
+
+    def shutdown(self):
+        super().close()
+
+
+class StreamedResponse:
+    '''
+    A streamed response that holds its API key's slot until it has been read to the end, closed, or dropped without being read.
+    on_complete is called with the chunks once the stream has been read to the end.
+    '''
+    def __init__(self, response, release, on_complete = None):
+        self.response = response
+        self.chunks = iter(response)
+        self.on_complete = on_complete
+        self.received = []
+        #releases the slot exactly once, whichever comes first, and when the response is garbage collected
+        self.release = weakref.finalize(self, release)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.release()
+            if self.on_complete is not None:
+                self.on_complete(self.received)
+                self.on_complete = None
+            raise
+        except BaseException:
+            self.release()
+            raise
+        if self.on_complete is not None:
+            self.received.append(chunk)
+        return chunk
+
+    def close(self):
+        self.release()
+        if hasattr(self.response, "close"):
+            self.response.close()
+
+
+class KeyUsage:
+    '''
+    Concurrency slots and the requests and tokens of the last minute for one API key
+    '''
+    def __init__(self, max_concurrency: int):
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.in_flight = 0
+
+        #start times of requests, and (time, tokens) of finished requests, within the last WINDOW seconds
+        self.requests = deque()
+        self.tokens = deque()
+        self.token_total = 0
+
+    def expire(self, now: float, window: float):
+        while self.requests and now - self.requests[0] >= window:
+            self.requests.popleft()
+        while self.tokens and now - self.tokens[0][0] >= window:
+            self.token_total -= self.tokens.popleft()[1]
+
+
+class KeyClient:
+    '''
+    Key Client class
+
+    An OpenAIClient bound to one API key. Each ChatAssistant owns one, so its calls are made, billed and rate limited with its own key
+    and never with whichever key another session set last.
+
+    Methods:
+        create(self, resource, **params):
+        Calls resource.create with this client's API key
+        record_tokens(self, tokens: int):
+        Counts tokens used by a call against the key's tokens per minute
+        was_cached(self):
+        Whether the last call made on this thread was answered from the response cache
+    '''
+    def __init__(self, client, api_key: str):
+        '''
+        Constructor for the KeyClient class
+        '''
+        self.client = client
+        self.api_key = api_key
+
+    def create(self, resource, **params):
+        return self.client.create(resource, api_key=self.api_key, **params)
+
+    def record_tokens(self, tokens: int):
+        self.client.record_tokens(self.api_key, tokens)
+
+    def was_cached(self):
+        return self.client.was_cached()
+
+
+class OpenAIClient:
+    '''
+    OpenAI Client class
+
+    Every OpenAI call goes through this client. Calls share one pool of keep-alive connections, so a call does not pay a new TLS handshake,
+    at most max_concurrency calls per API key run at once, and rate limits and transient errors are retried with exponential backoff and full jitter,
+    so a burst from many sessions spreads its retries out instead of hitting the API again all at the same moment.
+    Requests and tokens are counted per API key over the last minute. With requests_per_minute or tokens_per_minute set,
+    a key that has used its share waits for the window to move on, so one busy tenant is held back here instead of tripping OpenAI's limits.
+
+    Attributes:
+        max_concurrency (int): The maximum number of calls that may run at once for one API key
+        max_retries (int): The number of times a call is retried before its error is raised
+        base_delay (float): Seconds of backoff before the first retry, doubled for every retry after it
+        max_delay (float): The longest backoff between two retries, in seconds
+        requests_per_minute (int): The most requests one API key may start in a minute, or None for no limit
+        tokens_per_minute (int): The most tokens one API key may use in a minute, or None for no limit
+        cache (ResponseCache): Answers repeated calls of the cached call types without calling OpenAI, or None to call OpenAI every time
+
+    Methods:
+        for_key(self, api_key: str):
+        Returns a KeyClient that makes every call with api_key
+        create(self, resource, api_key: str, cache_type: str = None, **params):
+        Calls resource.create (e.g. openai.ChatCompletion) with retries, under the API key's concurrency and rate limits
+        record_tokens(self, api_key: str, tokens: int):
+        Counts tokens used by a call against the key's tokens per minute
+        was_cached(self):
+        Whether the last call made on this thread was answered from the response cache
+        usage(self):
+        Returns the requests and tokens of the last minute for each API key
+        report(self):
+        Returns call, retry and throttling counts
+        warmup(self, connections: int = 2):
+        Opens connections to the API ahead of the first call
+    '''
+    #seconds over which requests and tokens per minute are counted
+    WINDOW = 60.0
+
+    #the OpenAI API is on a single host, connections are not tied to an API key
+    POOL_SIZE = 64
+
+    RETRYABLE_ERRORS = (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.APIConnectionError,
+                        openai.error.Timeout, openai.error.TryAgain)
+
+    def __init__(self, max_concurrency: int = 8, max_retries: int = 4, base_delay: float = 1.0, max_delay: float = 30.0,
+                 requests_per_minute: int = None, tokens_per_minute: int = None, cache = None):
+        '''
+        Constructor for the OpenAIClient class
+        '''
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.cache = cache
+
+        #whether the last call on each thread was answered from the cache
+        self.local = threading.local()
+
+        self.session = PooledSession()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.POOL_SIZE, max_retries=2)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        #openai picks up the session on every thread
+        openai.requestssession = self.session
+
+        #API key -> KeyUsage
+        self.keys = {}
+
+        self.counters = {
+            "calls": 0,
+            "retries": 0,
+            "failed": 0,
+            #calls that waited because their API key had max_concurrency calls running
+            "throttled": 0,
+            #calls that waited because their API key had used its requests or tokens for the minute
+            "rate_limited": 0,
+        }
+        self.lock = threading.Lock()
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def for_key(self, api_key: str):
+        '''
+        Returns a KeyClient that makes every call with api_key
+        '''
+        return KeyClient(self, api_key)
+
+    def key_usage(self, api_key: str):
+        with self.lock:
+            usage = self.keys.get(api_key)
+            if usage is None:
+                usage = self.keys[api_key] = KeyUsage(self.max_concurrency)
+            return usage
+
+    def wait_for_rate(self, usage: KeyUsage):
+        '''
+        Waits until the key is under its requests and tokens per minute, then counts a request against it
+        '''
+        waited = False
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                usage.expire(now, self.WINDOW)
+                delays = []
+                if self.requests_per_minute is not None and len(usage.requests) >= self.requests_per_minute:
+                    delays.append(usage.requests[0] + self.WINDOW - now)
+                if self.tokens_per_minute is not None and usage.token_total >= self.tokens_per_minute and usage.tokens:
+                    delays.append(usage.tokens[0][0] + self.WINDOW - now)
+                if not delays:
+                    usage.requests.append(now)
+                    usage.in_flight += 1
+                    return
+            if not waited:
+                self.count("rate_limited")
+                waited = True
+            time.sleep(max(min(delays), 0.01))
+
+    def record_tokens(self, api_key: str, tokens: int):
+        '''
+        Counts tokens used by a call against the key's tokens per minute
+        '''
+        usage = self.key_usage(api_key)
+        with self.lock:
+            usage.tokens.append((time.monotonic(), tokens))
+            usage.token_total += tokens
+
+    def was_cached(self):
+        return getattr(self.local, "cached", False)
+
+    def finish(self, usage: KeyUsage):
+        with self.lock:
+            usage.in_flight -= 1
+        usage.slots.release()
+
+    def is_retryable(self, error: Exception):
+        if isinstance(error, self.RETRYABLE_ERRORS):
+            return True
+        #server errors, but not bad requests
+        return isinstance(error, openai.error.APIError) and (error.http_status or 0) >= 500
+
+    def backoff(self, attempt: int, error: Exception):
+        '''
+        Returns the seconds to wait before retry number attempt (from 0): the server's Retry-After if it sent one,
+        otherwise a random delay up to base_delay * 2 ** attempt
+        '''
+        retry_after = (getattr(error, "headers", None) or {}).get("retry-after")
+        try:
+            return min(float(retry_after), self.max_delay)
+        except (TypeError, ValueError):
+            return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def create(self, resource, api_key: str, cache_type: str = None, **params):
+        '''
+        Calls resource.create(**params) with api_key, e.g. on openai.ChatCompletion, and returns its response.
+        cache_type names the kind of call (e.g. "recursion_check"), an identical earlier call of a cached type is answered from the cache.
+        Streamed responses hold the API key's slot until they have been read to the end.
+        Raises the last error if the call still fails after max_retries retries.
+        '''
+        self.local.cached = False
+        cache_key = None
+        if cache_type is not None and self.cache is not None and self.cache.caches(cache_type):
+            cache_key = self.cache.key(cache_type, resource, params)
+            cached = self.cache.get(cache_type, cache_key)
+            if cached is not None:
+                self.local.cached = True
+                if params.get("stream"):
+                    return iter([convert_to_openai_object(chunk) for chunk in cached])
+                return convert_to_openai_object(cached)
+
+        usage = self.key_usage(api_key)
+        if not usage.slots.acquire(blocking=False):
+            self.count("throttled")
+            usage.slots.acquire()
+        try:
+            self.wait_for_rate(usage)
+        except BaseException:
+            usage.slots.release()
+            raise
+        self.count("calls")
+
+        try:
+            attempt = 0
+            while True:
+                try:
+                    response = resource.create(api_key=api_key, **params)
+                    break
+                except Exception as error:
+                    if attempt >= self.max_retries or not self.is_retryable(error):
+                        self.count("failed")
+                        raise
+                    delay = self.backoff(attempt, error)
+                    print(f"{type(error).__name__} from OpenAI, retrying in {delay:.1f}s: {error}")
+                    self.count("retries")
+                    attempt += 1
+                    #the slot is kept while waiting, so a rate limited key does not start more calls in the meantime
+                    time.sleep(delay)
+        except BaseException:
+            self.finish(usage)
+            raise
+
+        if params.get("stream"):
+            #only a stream that was read to the end is cached
+            on_complete = (lambda chunks: self.cache.put(cache_type, cache_key, chunks)) if cache_key is not None else None
+            return StreamedResponse(response, lambda: self.finish(usage), on_complete)
+        self.finish(usage)
+        if cache_key is not None:
+            self.cache.put(cache_type, cache_key, response)
+        return response
+
+    def usage(self):
+        '''
+        Returns the requests and tokens of the last minute, and the calls in flight, for each API key.
+        Keys are identified by a short hash, never by the key itself.
+        '''
+        now = time.monotonic()
+        with self.lock:
+            report = {}
+            for api_key, usage in self.keys.items():
+                usage.expire(now, self.WINDOW)
+                report[hashlib.sha256(api_key.encode()).hexdigest()[:12]] = {
+                    "requests_per_minute": len(usage.requests),
+                    "tokens_per_minute": usage.token_total,
+                    "in_flight": usage.in_flight,
+                }
+            return report
+
+    def report(self):
+        '''
+        Returns call, retry and throttling counts
+        '''
+        with self.lock:
+            return dict(self.counters)
+
+    def warmup(self, connections: int = 2):
+        '''
+        Opens connections to the API at the same time, so the first calls do not pay the TLS handshake.
+        The requests are not authenticated, any response leaves its connection in the pool. Returns the number of connections opened.
+        '''
+        opened = []
+
+        def connect():
+            try:
+                response = self.session.get(openai.api_base + "/models", timeout=10)
+                #read to the end, so the connection goes back to the pool
+                response.content
+                opened.append(response.status_code)
+            except requests.RequestException as error:
+                print(f"Failed to open a connection to OpenAI: {error}")
+
+        threads = [threading.Thread(target=connect) for _ in range(min(connections, self.POOL_SIZE))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return len(opened)
+
+    def shutdown(self):
+        '''
+        Closes the pooled connections
+        '''
+        self.session.shutdown()
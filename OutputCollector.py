@@ -0,0 +1,201 @@
+import os
+import re
+import base64
+import threading
+import uuid as uuid_module
+from collections import deque
+
+#colour codes in IPython tracebacks
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+
+IMAGE_EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/gif": "gif", "image/svg+xml": "svg"}
+
+
+class OutputCollector:
+    '''
+    Output Collector class
+
+    Collects what a cell prints, returns and displays from the kernel's iopub messages as they arrive.
+    Every output type (stdout, stderr, results, display data and errors) is merged into one text in the order it arrived.
+    Only the first and last keep_chars characters of that text are held, so a runaway print loop cannot fill the server's memory,
+    and once the output passes max_bytes or max_lines on_cap is called (the kernel pool interrupts the kernel).
+    Images are written to image_directory and referred to by path instead of being held as base64.
+
+    Attributes:
+        max_bytes (int): The output size at which the execution is interrupted
+        max_lines (int): The number of output lines at which the execution is interrupted
+        keep_chars (int): Characters kept from each of the start and the end of the output
+        image_directory (str): Directory images are saved to, referred to relative to its parent (the kernel's working directory)
+        on_cap: Called once when the output passes max_bytes or max_lines
+        capped (bool): Whether the output passed max_bytes or max_lines
+        timed_out (bool): Whether the execution was stopped for running too long
+        error (str): "ename: evalue" if the code raised
+
+    Methods:
+        hook(self, msg: dict):
+        Output hook for BlockingKernelClient.execute_interactive
+        text(self, max_chars: int = None):
+        Returns the merged output, shortened to its start and end if it is longer than max_chars
+        notebook_outputs(self):
+        Returns the outputs as notebook outputs, for the execution log
+    '''
+    def __init__(self, max_bytes: int = 256 * 1024, max_lines: int = 5000, keep_chars: int = 4000, image_directory: str = None, on_cap = None):
+        '''
+        Constructor for the OutputCollector class
+        '''
+        self.max_bytes = max_bytes
+        self.max_lines = max_lines
+        self.keep_chars = keep_chars
+        self.image_directory = image_directory
+        self.on_cap = on_cap
+
+        self.head = ""
+        #text after the head, trimmed from the left to keep_chars
+        self.tail = deque()
+        self.tail_chars = 0
+        self.omitted_chars = 0
+
+        self.bytes = 0
+        self.lines = 0
+        self.capped = False
+        self.timed_out = False
+        self.error = None
+        self.images = []
+
+        #notebook outputs received before the cap, consecutive stream outputs merged
+        self.outputs = []
+
+        #the output of a background job is read while it is still arriving
+        self.lock = threading.RLock()
+
+    def add_text(self, text: str):
+        if not text:
+            return
+        self.bytes += len(text.encode('utf-8', 'replace'))
+        self.lines += text.count("\n")
+
+        room = self.keep_chars - len(self.head)
+        if room > 0:
+            self.head += text[:room]
+            text = text[room:]
+        if text:
+            self.tail.append(text)
+            self.tail_chars += len(text)
+            excess = self.tail_chars - self.keep_chars
+            while excess > 0:
+                first = self.tail[0]
+                if len(first) <= excess:
+                    self.tail.popleft()
+                    dropped = len(first)
+                else:
+                    self.tail[0] = first[excess:]
+                    dropped = excess
+                self.tail_chars -= dropped
+                self.omitted_chars += dropped
+                excess -= dropped
+
+        if not self.capped and (self.bytes > self.max_bytes or self.lines > self.max_lines):
+            self.capped = True
+            if self.on_cap is not None:
+                self.on_cap()
+
+    def add_output(self, output):
+        if self.capped:
+            return
+        last = self.outputs[-1] if self.outputs else None
+        if output.output_type == "stream" and last is not None and last.output_type == "stream" and last.name == output.name:
+            last.text += output.text
+        else:
+            self.outputs.append(output)
+
+    def save_image(self, data: dict):
+        '''
+        Writes the first image in a display's data to image_directory, returns its path relative to the kernel's working directory
+        '''
+        for mime_type, extension in IMAGE_EXTENSIONS.items():
+            if mime_type in data:
+                os.makedirs(self.image_directory, exist_ok=True)
+                file_name = f"output_{uuid_module.uuid4().hex[:12]}.{extension}"
+                content = data[mime_type]
+                content = content.encode('utf-8') if mime_type == "image/svg+xml" else base64.b64decode(content)
+                with open(os.path.join(self.image_directory, file_name), 'wb') as f:
+                    f.write(content)
+                path = os.path.join(os.path.basename(self.image_directory), file_name)
+                self.images.append(path)
+                return path
+        return None
+
+    def hook(self, msg: dict):
+        '''
+        Output hook for BlockingKernelClient.execute_interactive, called with each iopub message of the execution
+        '''
+        with self.lock:
+            self.handle(msg['header']['msg_type'], msg)
+
+    def handle(self, msg_type: str, msg: dict):
+        #imported with the first output rather than with the server, see Warmup
+        from nbformat.v4 import output_from_msg, new_output
+
+        content = msg['content']
+        if msg_type == "stream":
+            self.add_text(content['text'])
+            self.add_output(output_from_msg(msg))
+
+        elif msg_type in ("execute_result", "display_data"):
+            data = content.get('data', {})
+            image_path = self.save_image(data) if self.image_directory is not None else None
+            if image_path is not None:
+                reference = f"[image: {image_path}]"
+                self.add_text(reference + "\n")
+                #the notebook keeps the reference, not the image data
+                self.add_output(new_output("display_data", data={"text/plain": reference}, metadata={"image_path": image_path}))
+            else:
+                self.add_text(data.get('text/plain', "") + "\n")
+                self.add_output(output_from_msg(msg))
+
+        elif msg_type == "error":
+            self.error = f"{content['ename']}: {content['evalue']}"
+            traceback = "\n".join(ANSI_ESCAPE.sub("", line) for line in content.get('traceback', []))
+            self.add_text((traceback or self.error) + "\n")
+            self.add_output(output_from_msg(msg))
+
+    def text(self, max_chars: int = None):
+        '''
+        Returns the merged output. Output that was cut down while it arrived, or is longer than max_chars, keeps its start and end.
+        '''
+        with self.lock:
+            return self.render_text(max_chars)
+
+    def render_text(self, max_chars: int = None):
+        head = self.head
+        tail = "".join(self.tail)
+        omitted = self.omitted_chars
+        if omitted == 0:
+            #nothing was dropped while the output arrived, so head and tail are one continuous text
+            text = head + tail
+            if max_chars is None or len(text) <= max_chars:
+                return text.strip()
+            head, tail = text, text
+        elif max_chars is None or len(head) + len(tail) <= max_chars:
+            return f"{head}\n... [{omitted} characters omitted] ...\n{tail}".strip()
+
+        kept_head = head[:max_chars // 2]
+        kept_tail = tail[len(tail) - min(len(tail), max_chars - len(kept_head)):]
+        if omitted == 0:
+            omitted = len(head) - len(kept_head) - len(kept_tail)
+        else:
+            omitted += len(head) - len(kept_head) + len(tail) - len(kept_tail)
+        return f"{kept_head}\n... [{omitted} characters omitted] ...\n{kept_tail}".strip()
+
+    def notebook_outputs(self):
+        '''
+        Returns the outputs as notebook outputs. If the output was capped, the end of it follows the outputs received before the cap.
+        '''
+        from nbformat.v4 import new_output
+
+        with self.lock:
+            outputs = list(self.outputs)
+        if self.capped:
+            outputs.append(new_output("stream", name="stderr",
+                                      text=f"\n... [output limit reached, execution interrupted] ...\n{''.join(self.tail)}"))
+        return outputs
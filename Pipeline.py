@@ -0,0 +1,222 @@
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError
+
+
+class Stage:
+    '''
+    A stage of a pipeline: its function, the stages it depends on, and its result
+    '''
+    def __init__(self, name: str, function, after: list, background: bool):
+        self.name = name
+        self.function = function
+        self.after = after
+        self.background = background
+        self.future = Future()
+
+        #set when the stage is cancelled, a running stage that takes a "cancelled" argument checks it to stop early
+        self.cancelled = threading.Event()
+        self.takes_cancelled = "cancelled" in inspect.signature(function).parameters
+
+        #dependencies still running, for background stages
+        self.waiting = len(after)
+        self.lock = threading.Lock()
+
+
+class TokenBuffer:
+    '''
+    Text produced piece by piece by a background stage, read by another stage while it is still arriving
+    '''
+    def __init__(self):
+        self.tokens = []
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def append(self, token: str):
+        with self.condition:
+            self.tokens.append(token)
+            self.condition.notify_all()
+
+    def finish(self, error: Exception = None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+    def read(self, on_token = None):
+        '''
+        Waits for the whole text and returns it, calling on_token with each piece (those already received first) as it arrives.
+        Raises the producer's error if it failed.
+        '''
+        position = 0
+        while True:
+            with self.condition:
+                while position == len(self.tokens) and not self.done:
+                    self.condition.wait()
+                tokens = self.tokens[position:]
+                done, error = self.done, self.error
+            position += len(tokens)
+            if on_token is not None:
+                for token in tokens:
+                    on_token(token)
+            if done and position == len(self.tokens):
+                if error is not None:
+                    raise error
+                return "".join(self.tokens)
+
+
+class Pipeline:
+    '''
+    Pipeline class
+
+    The stages of one turn as a small dependency graph. Each stage is a function that takes the results of the stages it depends on as keyword arguments
+    (and "cancelled", an Event set if the stage is cancelled, if it accepts one).
+    Background stages run on the executor's pool as soon as their dependencies have finished, so independent stages overlap;
+    the other stages run in the thread that asks for their result, once the results they need are in.
+    A background stage may only depend on other background stages, so a pool thread never waits on work queued behind it.
+
+    Methods:
+        add(self, name: str, function, after: tuple = (), background: bool = False):
+        Adds a stage that runs after the stages named in after
+        result(self, name: str, timeout: float = None):
+        Returns the stage's result, running it (and what it depends on) in this thread if it is not a background stage
+        cancel(self, name: str, only_pending: bool = False):
+        Cancels a stage, returns True if it had not started
+    '''
+    def __init__(self, executor):
+        '''
+        Constructor for the Pipeline class
+        '''
+        self.executor = executor
+        self.stages = {}
+
+        #background stages report their stage timings to the turn that started them
+        self.breakdown = getattr(executor.metrics.local, "breakdown", None) if executor.metrics is not None else None
+
+    def add(self, name: str, function, after: tuple = (), background: bool = False):
+        after = [self.stages[dependency] for dependency in after]
+        if background and not all(dependency.background for dependency in after):
+            raise ValueError(f"Background stage {name} can only depend on background stages")
+        stage = Stage(name, function, after, background)
+        self.stages[name] = stage
+
+        if background:
+            if not after:
+                self.executor.submit(self, stage)
+            for dependency in after:
+                dependency.future.add_done_callback(lambda _, stage=stage: self.dependency_done(stage))
+        return stage
+
+    def dependency_done(self, stage: Stage):
+        with stage.lock:
+            stage.waiting -= 1
+            ready = stage.waiting == 0
+        if ready:
+            self.executor.submit(self, stage)
+
+    def run(self, stage: Stage):
+        '''
+        Runs the stage with its dependencies' results, unless it was cancelled before it started
+        '''
+        if not stage.future.set_running_or_notify_cancel():
+            return
+        try:
+            arguments = {dependency.name: dependency.future.result() for dependency in stage.after}
+            if stage.cancelled.is_set():
+                raise CancelledError()
+            if stage.takes_cancelled:
+                arguments["cancelled"] = stage.cancelled
+            stage.future.set_result(stage.function(**arguments))
+        except BaseException as error:
+            stage.future.set_exception(error)
+
+    def result(self, name: str, timeout: float = None):
+        stage = self.stages[name]
+        if not stage.background and not (stage.future.running() or stage.future.done()):
+            for dependency in stage.after:
+                self.result(dependency.name)
+            self.run(stage)
+        return stage.future.result(timeout)
+
+    def cancel(self, name: str, only_pending: bool = False):
+        '''
+        Cancels the stage: a stage that has not started never runs, and a running stage is asked to stop.
+        With only_pending, a stage that is already running is left alone. Returns True if the stage had not started.
+        '''
+        stage = self.stages[name]
+        if stage.future.cancel():
+            stage.cancelled.set()
+            return True
+        if not only_pending:
+            stage.cancelled.set()
+        return False
+
+
+class PipelineExecutor:
+    '''
+    Pipeline Executor class
+
+    Runs the background stages of every chat's pipelines on one bounded pool of threads,
+    and counts how the speculative stages turned out: used (hit), thrown away because the turn took another path (miss), or never started.
+
+    Attributes:
+        max_workers (int): The number of background stages that may run at once
+        metrics (Metrics): Stage timings of background stages are added to the breakdown of the turn that started them
+
+    Methods:
+        pipeline(self):
+        Returns a new Pipeline for a turn
+        count(self, name: str):
+        Counts a speculation outcome
+        report(self):
+        Returns the number of stages run and the speculation hits and misses
+    '''
+    def __init__(self, max_workers: int = 16, metrics = None):
+        '''
+        Constructor for the PipelineExecutor class
+        '''
+        self.max_workers = max_workers
+        self.metrics = metrics
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        self.counters = {
+            "background_stages": 0,
+            "speculation_hits": 0,
+            "speculation_misses": 0,
+            #speculative stages that had not started by the time they were needed
+            "speculation_unstarted": 0,
+            #speculative stages that failed, the turn then made the call itself
+            "speculation_failed": 0,
+        }
+        self.lock = threading.Lock()
+
+    def count(self, name: str):
+        with self.lock:
+            self.counters[name] += 1
+
+    def pipeline(self):
+        return Pipeline(self)
+
+    def submit(self, pipeline: Pipeline, stage: Stage):
+        self.count("background_stages")
+        self.executor.submit(self.run, pipeline, stage)
+
+    def run(self, pipeline: Pipeline, stage: Stage):
+        if self.metrics is not None:
+            self.metrics.attach(pipeline.breakdown)
+        try:
+            pipeline.run(stage)
+        finally:
+            if self.metrics is not None:
+                self.metrics.attach(None)
+
+    def report(self):
+        '''
+        Returns the number of background stages run, the speculation outcomes and the hit rate
+        '''
+        with self.lock:
+            report = dict(self.counters)
+        speculations = report["speculation_hits"] + report["speculation_misses"]
+        report["speculation_hit_rate"] = report["speculation_hits"] / speculations if speculations else None
+        return report
@@ -0,0 +1,142 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    '''
+    Response Cache class
+
+    Caches OpenAI responses for calls that are repeated verbatim: the Davinci classifier (temperature 0), the recursion check,
+    the creative prompt rewrite for DALL-E and the image itself. Responses are keyed by the call type, the model, every parameter and a hash of the messages,
+    so only an identical call is answered from the cache. Each call type has its own TTL, types without one are never cached.
+    Entries are kept in an in-memory LRU, and in a SQLite file as well if disk_path is set, so they survive restarts and are shared by worker processes.
+
+    Attributes:
+        max_entries (int): The maximum number of responses kept in memory
+        ttls (dict): Call type -> seconds a response of that type is reused for
+        disk_path (str): The SQLite file of the disk tier, or None to keep responses in memory only
+
+    Methods:
+        key(self, cache_type: str, resource, params: dict):
+        Returns the cache key of a call
+        get(self, cache_type: str, key: str):
+        Returns the cached response, or None
+        put(self, cache_type: str, key: str, response):
+        Caches a response
+        report(self):
+        Returns hits, misses and hit rate for each call type
+    '''
+    #OpenAI's image URLs expire after an hour
+    DEFAULT_TTLS = {
+        "classifier": 7 * 24 * 60 * 60,
+        "recursion_check": 24 * 60 * 60,
+        "creative_prompt": 24 * 60 * 60,
+        "image": 50 * 60,
+    }
+
+    def __init__(self, max_entries: int = 4096, ttls: dict = None, disk_path: str = None):
+        '''
+        Constructor for the ResponseCache class
+        '''
+        self.max_entries = max_entries
+        self.ttls = dict(self.DEFAULT_TTLS if ttls is None else ttls)
+        self.disk_path = disk_path
+
+        #key -> (expiry time, response), least recently used first
+        self.entries = OrderedDict()
+
+        #call type -> {"memory_hits", "disk_hits", "misses"}
+        self.stats = {}
+
+        self.lock = threading.Lock()
+
+        if disk_path is not None:
+            with self.connect() as connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, expires_at REAL)")
+                connection.execute("DELETE FROM responses WHERE expires_at < ?", (time.time(),))
+
+    def connect(self):
+        return sqlite3.connect(self.disk_path, timeout=30)
+
+    def caches(self, cache_type: str):
+        '''
+        Whether responses of the call type are cached
+        '''
+        return cache_type in self.ttls
+
+    def key(self, cache_type: str, resource, params: dict):
+        '''
+        Returns the cache key of a call: a hash of the call type, the resource and every parameter except the API key
+        '''
+        call = {"type": cache_type, "resource": resource.__name__,
+                "params": {name: value for name, value in params.items() if name != "api_key"}}
+        return hashlib.sha256(json.dumps(call, sort_keys=True, default=str).encode()).hexdigest()
+
+    def count(self, cache_type: str, name: str):
+        with self.lock:
+            stats = self.stats.setdefault(cache_type, {"memory_hits": 0, "disk_hits": 0, "misses": 0})
+            stats[name] += 1
+
+    def get(self, cache_type: str, key: str):
+        '''
+        Returns the cached response (as plain JSON data), or None if there is none or it has expired
+        '''
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                else:
+                    del self.entries[key]
+                    entry = None
+        if entry is not None:
+            self.count(cache_type, "memory_hits")
+            return json.loads(entry[1])
+
+        if self.disk_path is not None:
+            with self.connect() as connection:
+                row = connection.execute("SELECT response, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+            if row is not None:
+                self.remember(key, row[1], row[0])
+                self.count(cache_type, "disk_hits")
+                return json.loads(row[0])
+
+        self.count(cache_type, "misses")
+        return None
+
+    def remember(self, key: str, expires_at: float, response: str):
+        with self.lock:
+            self.entries[key] = (expires_at, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def put(self, cache_type: str, key: str, response):
+        '''
+        Caches a response for the call type's TTL
+        '''
+        expires_at = time.time() + self.ttls[cache_type]
+        #stored serialized, so a caller changing the response it was handed cannot change the cached copy
+        response = json.dumps(response)
+        self.remember(key, expires_at, response)
+        if self.disk_path is not None:
+            with self.connect() as connection:
+                connection.execute("INSERT OR REPLACE INTO responses (key, response, expires_at) VALUES (?, ?, ?)", (key, response, expires_at))
+
+    def report(self):
+        '''
+        Returns hits, misses and hit rate for each call type
+        '''
+        with self.lock:
+            report = {cache_type: dict(stats) for cache_type, stats in self.stats.items()}
+            entries = len(self.entries)
+        for stats in report.values():
+            hits = stats["memory_hits"] + stats["disk_hits"]
+            stats["hit_rate"] = hits / (hits + stats["misses"]) if hits + stats["misses"] else None
+        return {"entries": entries, "types": report}
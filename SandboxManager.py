@@ -0,0 +1,192 @@
+import os
+import fcntl
+import shutil
+import hashlib
+import threading
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024):
+    '''
+    Returns the sha256 hex digest of a file, read in chunks
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+#ioctl request for a copy-on-write clone of a whole file (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def clone_or_copy(source: str, destination: str):
+    '''
+    Places a copy of source at destination, as a copy-on-write reflink if the filesystem supports it so the data is not duplicated.
+    Never a hardlink: a write through one path would change the file for every chat that has it.
+    '''
+    with open(source, 'rb') as src, open(destination, 'xb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    shutil.copystat(source, destination)
+
+
+def make_read_only(path: str):
+    os.chmod(path, 0o444)
+
+
+class SandboxManager:
+    '''
+    Sandbox Manager class
+
+    Keeps one sandbox directory per chat for the interpreter to run in, reused for the lifetime of the chat.
+    Uploaded files are kept in a content-addressed store and copied into the sandbox the first time they are needed,
+    so large uploads are not copied again on every execution.
+    Chats only share the data of identical files through copy-on-write reflinks; on filesystems without them every chat gets its own copy,
+    so code that rewrites a file in place never changes another chat's file. Stored files are read-only.
+
+    Attributes:
+        root (str): The directory holding the store and the sandboxes, on the same filesystem as the uploads so reflinks work
+
+    Methods:
+        prepare(self, uuid: str, file_list: list):
+        Returns the sandbox directory for the chat, with every uploaded file in it
+        delete(self, uuid: str, file_list: list = ()):
+        Deletes the chat's sandbox and any stored files no other chat uses
+    '''
+    def __init__(self, root: str = "uploads"):
+        '''
+        Constructor for the SandboxManager class
+        '''
+        #absolute, the kernels run the code from the sandbox whatever their own working directory
+        self.root = os.path.abspath(root)
+        self.store_directory = os.path.join(self.root, "store")
+        self.sandbox_directory = os.path.join(self.root, "sandboxes")
+        os.makedirs(self.store_directory, exist_ok=True)
+        os.makedirs(self.sandbox_directory, exist_ok=True)
+
+        #uuid -> {source file path: (digest, size, modified time)} of files already staged into the sandbox
+        self.staged = {}
+
+        #file path -> (digest, size, modified time) of uploads whose digest was computed while they were received
+        self.digests = {}
+
+        self.lock = threading.Lock()
+
+    def sandbox_path(self, uuid: str):
+        return os.path.join(self.sandbox_directory, uuid)
+
+    def store_path(self, digest: str):
+        return os.path.join(self.store_directory, digest)
+
+    def add_to_store(self, path: str, digest: str):
+        '''
+        Copies the file into the store under its digest, unless the store already has it
+        '''
+        store_path = self.store_path(digest)
+        if os.path.exists(store_path):
+            return
+        #copied under a temporary name and renamed, so a stored file is never seen half written
+        temp_path = f"{store_path}.{threading.get_ident()}.tmp"
+        clone_or_copy(path, temp_path)
+        make_read_only(temp_path)
+        os.replace(temp_path, store_path)
+
+    def ingest(self, path: str, digest: str):
+        '''
+        Adds a just-uploaded file with a known digest to the store.
+        If the store already has the same content (e.g. another chat uploaded it), the upload is replaced by a reflink of the stored copy
+        where the filesystem supports it, so identical uploads take up disk space once.
+        '''
+        store_path = self.store_path(digest)
+        if os.path.exists(store_path):
+            temp_path = path + ".clone"
+            try:
+                clone_or_copy(store_path, temp_path)
+                os.chmod(temp_path, 0o644)
+                os.replace(temp_path, path)
+            except FileNotFoundError:
+                #the stored copy was deleted meanwhile, the upload is stored again below
+                pass
+        self.add_to_store(path, digest)
+        stat = os.stat(path)
+        with self.lock:
+            self.digests[path] = (digest, stat.st_size, stat.st_mtime_ns)
+
+    def store_file(self, path: str):
+        '''
+        Adds a file to the content-addressed store, returns its digest
+        '''
+        #uploads are hashed while they are received, only hash files that have changed since
+        stat = os.stat(path)
+        with self.lock:
+            known = self.digests.get(path)
+        if known is not None and known[1:] == (stat.st_size, stat.st_mtime_ns):
+            digest = known[0]
+        else:
+            digest = hash_file(path)
+        self.add_to_store(path, digest)
+        return digest
+
+    def prepare(self, uuid: str, file_list: list):
+        '''
+        Returns the sandbox directory for the chat, creating it if needed.
+        Files in file_list that are not in the sandbox yet are stored and copied into it, files already staged are skipped.
+        '''
+        sandbox = self.sandbox_path(uuid)
+        os.makedirs(sandbox, exist_ok=True)
+
+        with self.lock:
+            staged = dict(self.staged.setdefault(uuid, {}))
+
+        for file in dict.fromkeys(file_list):
+            #skip files that have not changed since they were staged, a re-upload under the same name is staged again
+            stat = os.stat(file)
+            if file in staged and staged[file][1:] == (stat.st_size, stat.st_mtime_ns):
+                continue
+
+            digest = self.store_file(file)
+            destination = os.path.join(sandbox, os.path.basename(file))
+            #a newer upload with the same name replaces the old one
+            if os.path.exists(destination):
+                os.remove(destination)
+            try:
+                clone_or_copy(self.store_path(digest), destination)
+            except FileNotFoundError:
+                #another worker sharing the store deleted it meanwhile
+                clone_or_copy(file, destination)
+            #the chat's copy is its own to change, unlike the stored file
+            os.chmod(destination, 0o644)
+            with self.lock:
+                self.staged.setdefault(uuid, {})[file] = (digest, stat.st_size, stat.st_mtime_ns)
+
+        return sandbox
+
+    def delete(self, uuid: str, file_list: list = ()):
+        '''
+        Deletes the chat's sandbox, and any stored files of the chat (staged or uploaded in file_list) that no other chat in this process uses
+        '''
+        with self.lock:
+            staged = self.staged.pop(uuid, {})
+            digests = set(entry[0] for entry in staged.values())
+            for file in file_list:
+                entry = self.digests.pop(file, None)
+                if entry is not None:
+                    digests.add(entry[0])
+            #copies share no links, so what is still in use is counted here
+            in_use = set(entry[0] for files in self.staged.values() for entry in files.values())
+            in_use.update(entry[0] for entry in self.digests.values())
+
+        sandbox = self.sandbox_path(uuid)
+        if os.path.exists(sandbox):
+            shutil.rmtree(sandbox)
+
+        for digest in digests - in_use:
+            try:
+                os.remove(self.store_path(digest))
+            except FileNotFoundError:
+                pass
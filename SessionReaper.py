@@ -0,0 +1,291 @@
+import os
+import re
+import time
+import shutil
+import threading
+
+#the uuids the client generates, folders and files named after anything else are never treated as a chat's leftovers
+CHAT_UUID = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+#where a chat's files end up when the chat itself is gone: its upload folder, older upload folders, its execution log and exported notebook, and its chunked uploads, unfinished or marked as committed
+ORPHAN_PATTERNS = [re.compile(rf"^({CHAT_UUID.pattern})$"),
+                   re.compile(rf"^notebook_({CHAT_UUID.pattern})\.(jsonl|ipynb)$"),
+                   re.compile(rf"^({CHAT_UUID.pattern})-[A-Za-z0-9_-]+\.(part|done)$")]
+
+
+def path_size(path: str):
+    '''
+    Returns the bytes used by a file or everything under a directory, or 0 if it does not exist
+    '''
+    try:
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+    except OSError:
+        return 0
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(directory, name)).st_size
+            except OSError:
+                continue
+    return total
+
+
+def remove_path(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class SessionReaper:
+    '''
+    Session Reaper class
+
+    Evicts chats in the background, so a long-running worker's memory and disk use stay flat when clients never call /delete_chat.
+    Every interval seconds it measures each chat this process holds: its disk use (upload folder, sandbox outputs, execution log, exported notebook)
+    and its memory (the kernel process and the message history). It evicts chats idle for longer than ttl and chats over a per-session quota,
+    then the least recently active chats until the totals are under the global quotas. Chats in the middle of a turn or with a background job running are left alone.
+    An evicted chat is deleted as with /delete_chat and its kernel, sandbox and files are released straight away rather than whenever its destructor runs.
+    With a session store shared between worker processes, a chat is only deleted once no worker has saved it for ttl seconds;
+    otherwise only this process's copy of it, its kernel and its sandbox are released, and the chat lives on for the other workers.
+    Files left behind by chats that are gone (e.g. after a restart or crash) are deleted once they are older than orphan_age.
+
+    Attributes:
+        ttl (int): Seconds a chat may go without a message or file before it is evicted
+        session_disk_quota (int): The most bytes of disk one chat may use, or None for no limit
+        session_memory_quota (int): The most bytes of memory one chat may use, or None for no limit
+        disk_quota (int): The most bytes of disk all chats together may use, or None for no limit
+        memory_quota (int): The most bytes of memory all chats together may use, or None for no limit
+        interval (int): Seconds between sweeps
+        orphan_age (int): Seconds a left-behind file must be unmodified for before it is deleted, at least the session store's TTL
+        orphan_directories (list): Directories searched for left-behind files, besides the sandboxes
+
+    Methods:
+        start(self):
+        Sweeps every interval seconds on a background thread
+        sweep(self):
+        Evicts idle chats and chats over the quotas, deletes left-behind files, returns what it did
+        report(self):
+        Returns eviction counts, reclaimed bytes and the usage measured by the last sweep
+    '''
+    def __init__(self, session_store, sessions_lock, kernel_pool, sandbox_manager, job_manager, ttl: int = 6 * 60 * 60,
+                 session_disk_quota: int = 1024 ** 3, session_memory_quota: int = 2 * 1024 ** 3,
+                 disk_quota: int = 20 * 1024 ** 3, memory_quota: int = 16 * 1024 ** 3,
+                 interval: int = 60, orphan_age: int = 24 * 60 * 60, orphan_directories: list = (".", "uploads", os.path.join("uploads", "incoming"))):
+        '''
+        Constructor for the SessionReaper class
+        '''
+        self.session_store = session_store
+        self.sessions_lock = sessions_lock
+        self.kernel_pool = kernel_pool
+        self.sandbox_manager = sandbox_manager
+        self.job_manager = job_manager
+
+        self.ttl = ttl
+        self.session_disk_quota = session_disk_quota
+        self.session_memory_quota = session_memory_quota
+        self.disk_quota = disk_quota
+        self.memory_quota = memory_quota
+        self.interval = interval
+        self.orphan_age = max(orphan_age, getattr(session_store, "ttl", 0))
+        self.orphan_directories = list(orphan_directories) + [sandbox_manager.sandbox_directory]
+
+        self.counters = {
+            "sweeps": 0,
+            #chats evicted for each reason
+            "evicted_ttl": 0,
+            "evicted_session_disk": 0,
+            "evicted_session_memory": 0,
+            "evicted_global_disk": 0,
+            "evicted_global_memory": 0,
+            #evictions that only released this process's copy of a chat another worker still serves
+            "released_local": 0,
+            #evictions put off because the chat was busy
+            "skipped_busy": 0,
+            "orphans_removed": 0,
+            "reclaimed_disk_bytes": 0,
+            "reclaimed_memory_bytes": 0,
+        }
+        #measured by the last sweep
+        self.usage = {"sessions": 0, "disk_bytes": 0, "memory_bytes": 0, "sweep_seconds": 0.0}
+        self.lock = threading.Lock()
+
+        self.thread = None
+
+    def count(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    def start(self):
+        '''
+        Sweeps every interval seconds on a background thread
+        '''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception as error:
+                print(f"Session reaper sweep failed: {error}")
+
+    def disk_usage(self, uuid: str, assistant):
+        '''
+        Returns the bytes of disk the chat uses. Uploads are counted in the upload folder and again in the sandbox, which holds its own copy of them.
+        '''
+        return (path_size(uuid)
+                + path_size(self.sandbox_manager.sandbox_path(uuid))
+                + path_size(assistant.execution_log.path)
+                + path_size(f"notebook_{uuid}.ipynb"))
+
+    def memory_usage(self, uuid: str, assistant):
+        '''
+        Returns the bytes of memory the chat uses: its kernel process, and roughly its message history
+        '''
+        return self.kernel_pool.memory(uuid) + sum(len(str(message.get("content", ""))) for message in list(assistant.messages))
+
+    def measure(self):
+        '''
+        Returns a {"uuid", "assistant", "idle", "idle_everywhere", "disk", "memory"} entry for every chat held by this process, least recently active first.
+        idle is the time since this process last served the chat, idle_everywhere since any worker sharing the session store last saved it.
+        '''
+        now, wall_clock = time.monotonic(), time.time()
+        sessions = []
+        for uuid, assistant in self.session_store.live():
+            idle = now - assistant.last_activity
+            saved = self.session_store.last_saved(uuid) if self.session_store.shared else None
+            sessions.append({"uuid": uuid, "assistant": assistant, "idle": idle,
+                             "idle_everywhere": min(idle, wall_clock - saved) if saved is not None else idle,
+                             "disk": self.disk_usage(uuid, assistant), "memory": self.memory_usage(uuid, assistant)})
+        sessions.sort(key=lambda session: -session["idle"])
+        return sessions
+
+    def evict(self, session: dict, reason: str):
+        '''
+        Deletes the chat and releases everything it holds, returns False if it was busy and was left alone.
+        A chat another worker sharing the session store has served within ttl is not deleted, only this process's copy of it is released.
+        '''
+        uuid, assistant = session["uuid"], session["assistant"]
+        everywhere = not self.session_store.shared or session["idle_everywhere"] > self.ttl
+        #taken in the same order as the requests that look up a chat, then the chat's lock is held until it is closed so no turn can start on it
+        with self.sessions_lock:
+            #a turn or a background job is still using the chat
+            if not assistant.lock.acquire(blocking=False):
+                self.count("skipped_busy")
+                return False
+            if self.job_manager.active(uuid):
+                assistant.lock.release()
+                self.count("skipped_busy")
+                return False
+            if everywhere:
+                self.session_store.delete(uuid)
+            else:
+                self.session_store.drop(uuid)
+        try:
+            if everywhere:
+                assistant.keep_files = False
+                assistant.close()
+                reclaimed = session["disk"]
+            else:
+                #the chat's uploads, execution log and notebook stay for the other workers
+                reclaimed = path_size(self.sandbox_manager.sandbox_path(uuid))
+                assistant.release()
+        finally:
+            assistant.lock.release()
+
+        print(f"Session reaper evicted {uuid} ({reason}{'' if everywhere else ', this process only'})")
+        self.count(f"evicted_{reason}")
+        if not everywhere:
+            self.count("released_local")
+        self.count("reclaimed_disk_bytes", reclaimed)
+        self.count("reclaimed_memory_bytes", session["memory"])
+        return True
+
+    def remove_orphans(self, live: set):
+        '''
+        Deletes upload folders, sandboxes, execution logs, notebooks and unfinished uploads of chats that are gone from the session store
+        and have not been modified for orphan_age seconds. Returns the bytes reclaimed.
+        '''
+        reclaimed = 0
+        now = time.time()
+        for directory in self.orphan_directories:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                match = next((pattern.match(name) for pattern in ORPHAN_PATTERNS if pattern.match(name)), None)
+                if match is None or match.group(1) in live:
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    if now - os.path.getmtime(path) < self.orphan_age:
+                        continue
+                except OSError:
+                    continue
+                #another worker process may hold the chat in a shared session store
+                if match.group(1) in self.session_store:
+                    continue
+                size = path_size(path)
+                remove_path(path)
+                reclaimed += size
+                self.count("orphans_removed")
+        self.count("reclaimed_disk_bytes", reclaimed)
+        return reclaimed
+
+    def sweep(self):
+        '''
+        Evicts idle chats and chats over the quotas, least recently active first, then deletes left-behind files.
+        Returns the uuids evicted for each reason.
+        '''
+        started = time.perf_counter()
+        sessions = self.measure()
+        evicted = {}
+
+        def evict(session: dict, reason: str):
+            if self.evict(session, reason):
+                evicted.setdefault(reason, []).append(session["uuid"])
+                return True
+            return False
+
+        remaining = []
+        for session in sessions:
+            if session["idle"] > self.ttl and evict(session, "ttl"):
+                continue
+            if self.session_disk_quota is not None and session["disk"] > self.session_disk_quota and evict(session, "session_disk"):
+                continue
+            if self.session_memory_quota is not None and session["memory"] > self.session_memory_quota and evict(session, "session_memory"):
+                continue
+            remaining.append(session)
+
+        # Evict the least recently active chats until the rest fit in the global quotas
+        disk = sum(session["disk"] for session in remaining)
+        memory = sum(session["memory"] for session in remaining)
+        kept = []
+        for session in remaining:
+            over_disk = self.disk_quota is not None and disk > self.disk_quota
+            over_memory = self.memory_quota is not None and memory > self.memory_quota
+            if (over_disk or over_memory) and evict(session, "global_disk" if over_disk else "global_memory"):
+                disk -= session["disk"]
+                memory -= session["memory"]
+                continue
+            kept.append(session)
+
+        self.remove_orphans(set(session["uuid"] for session in kept))
+
+        with self.lock:
+            self.counters["sweeps"] += 1
+            self.usage = {"sessions": len(kept), "disk_bytes": disk, "memory_bytes": memory, "sweep_seconds": time.perf_counter() - started}
+        return evicted
+
+    def report(self):
+        '''
+        Returns eviction counts, reclaimed bytes and the usage measured by the last sweep
+        '''
+        with self.lock:
+            return {**self.counters, **self.usage}
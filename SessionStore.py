@@ -0,0 +1,270 @@
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class SessionStore:
+    '''
+    Session Store class
+
+    Interface for where app.py keeps the ChatAssistant for each uuid.
+
+    Methods:
+        get(self, uuid: str):
+        Returns the ChatAssistant for the uuid, or None if there is no such session
+        save(self, uuid: str, assistant):
+        Stores the ChatAssistant (or its latest state) for the uuid
+        delete(self, uuid: str):
+        Deletes the session, returns True if it existed
+        live(self):
+        Returns the sessions that have a ChatAssistant in this process, for the session reaper
+        last_saved(self, uuid: str):
+        Returns when any process last saved the session, for stores shared between processes
+        drop(self, uuid: str):
+        Forgets this process's ChatAssistant for the session, keeping the session in a shared store
+    '''
+    #whether other worker processes use the same sessions
+    shared = False
+
+    def get(self, uuid: str):
+        raise NotImplementedError
+
+    def save(self, uuid: str, assistant):
+        raise NotImplementedError
+
+    def delete(self, uuid: str):
+        raise NotImplementedError
+
+    def __contains__(self, uuid: str):
+        return self.get(uuid) is not None
+
+    def live(self):
+        '''
+        Returns (uuid, assistant) for every session that has a ChatAssistant in this process
+        '''
+        raise NotImplementedError
+
+    def last_saved(self, uuid: str):
+        '''
+        Returns the time.time() at which any process last saved the session, or None if the store does not know or the session is gone
+        '''
+        return None
+
+    def drop(self, uuid: str):
+        '''
+        Forgets this process's ChatAssistant for the session, returns True if it had one. The session itself is kept where the store is shared.
+        '''
+        return self.delete(uuid)
+
+
+class MemorySessionStore(SessionStore):
+    '''
+    Memory Session Store class
+
+    Keeps ChatAssistant objects in this process, evicting the least recently used once max_sessions is reached
+    and any session not used within ttl seconds. Evicted sessions are deleted, as with /delete_chat.
+
+    Attributes:
+        max_sessions (int): The maximum number of sessions kept
+        ttl (int): Seconds a session may go unused before it is evicted
+    '''
+    def __init__(self, max_sessions: int = 1000, ttl: int = 24 * 60 * 60):
+        '''
+        Constructor for the MemorySessionStore class
+        '''
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+
+        #uuid -> (assistant, last used), least recently used first
+        self.sessions = OrderedDict()
+
+        self.lock = threading.Lock()
+
+    def evict(self):
+        '''
+        Drops expired sessions, then the least recently used ones while over max_sessions. Call with the lock held.
+        Returns the evicted assistants, so they are destroyed after the lock is released.
+        '''
+        evicted = []
+        now = time.monotonic()
+        while self.sessions:
+            uuid, (assistant, last_used) = next(iter(self.sessions.items()))
+            if now - last_used <= self.ttl and len(self.sessions) <= self.max_sessions:
+                break
+            del self.sessions[uuid]
+            evicted.append(assistant)
+        return evicted
+
+    def get(self, uuid: str):
+        with self.lock:
+            entry = self.sessions.get(uuid)
+            if entry is not None:
+                self.sessions[uuid] = (entry[0], time.monotonic())
+                self.sessions.move_to_end(uuid)
+            evicted = self.evict()
+        del evicted
+        return entry[0] if entry is not None else None
+
+    def save(self, uuid: str, assistant):
+        with self.lock:
+            self.sessions[uuid] = (assistant, time.monotonic())
+            self.sessions.move_to_end(uuid)
+            evicted = self.evict()
+        del evicted
+
+    def __contains__(self, uuid: str):
+        #without touching the session, so checking for it does not keep it alive
+        with self.lock:
+            return uuid in self.sessions
+
+    def live(self):
+        with self.lock:
+            return [(uuid, entry[0]) for uuid, entry in self.sessions.items()]
+
+    def delete(self, uuid: str):
+        with self.lock:
+            entry = self.sessions.pop(uuid, None)
+        #the ChatAssistant destructor cleans up once any turn still running on the chat has finished with it
+        return entry is not None
+
+
+class SQLiteSessionStore(SessionStore):
+    '''
+    SQLite Session Store class
+
+    Serializes each session (messages, file_list, previous_model, recursionAttempts and the API key) to a SQLite database,
+    so sessions survive restarts and can be shared by several worker processes on the same host.
+    Each process keeps a bounded cache of live ChatAssistant objects, which is refreshed when another process has saved a newer state.
+    Kernels are per process, so interpreter variables are not shared between workers.
+
+    Attributes:
+        path (str): The SQLite database file
+        max_cached (int): The maximum number of ChatAssistant objects cached in this process
+        ttl (int): Seconds a session may go unused before it is deleted
+    '''
+    shared = True
+
+    def __init__(self, path: str = "sessions.db", max_cached: int = 200, ttl: int = 24 * 60 * 60):
+        '''
+        Constructor for the SQLiteSessionStore class
+        '''
+        self.path = path
+        self.max_cached = max_cached
+        self.ttl = ttl
+
+        #uuid -> (assistant, version), least recently used first
+        self.cache = OrderedDict()
+
+        self.lock = threading.Lock()
+
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS sessions (uuid TEXT PRIMARY KEY, api_key TEXT, state TEXT, version INTEGER, updated_at REAL)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def cache_assistant(self, uuid: str, assistant, version: int):
+        '''
+        Caches a live ChatAssistant, dropping the least recently used ones over max_cached. Call with the lock held.
+        Returns the dropped assistants, which are released once the lock is released.
+        '''
+        self.cache[uuid] = (assistant, version)
+        self.cache.move_to_end(uuid)
+        evicted = []
+        while len(self.cache) > self.max_cached:
+            evicted.append(self.cache.popitem(last=False)[1][0])
+        return evicted
+
+    def release(self, evicted: list):
+        for assistant in evicted:
+            #the session lives on in the database, only this process's kernel and sandbox are released
+            assistant.release()
+
+    def delete_expired(self):
+        with self.connect() as connection:
+            expired = [row[0] for row in connection.execute("SELECT uuid FROM sessions WHERE updated_at < ?", (time.time() - self.ttl,))]
+        for uuid in expired:
+            self.delete(uuid)
+
+    def get(self, uuid: str):
+        with self.connect() as connection:
+            row = connection.execute("SELECT api_key, state, version FROM sessions WHERE uuid = ?", (uuid,)).fetchone()
+        if row is None:
+            return None
+        api_key, state, version = row
+
+        with self.lock:
+            entry = self.cache.get(uuid)
+            if entry is not None and entry[1] == version:
+                self.cache.move_to_end(uuid)
+                return entry[0]
+
+        # Imported here, as ChatAssistant imports globals, which creates the session store
+        from ChatAssistant import ChatAssistant
+
+        if entry is not None:
+            #another process saved a newer state
+            assistant = entry[0]
+        else:
+            assistant = ChatAssistant(api_key, uuid)
+            #the chat's files belong to the database entry, not to this object
+            assistant.keep_files = True
+        with assistant.lock:
+            assistant.set_api_key(api_key)
+            assistant.set_state(json.loads(state))
+
+        with self.lock:
+            evicted = self.cache_assistant(uuid, assistant, version)
+        self.release(evicted)
+        return assistant
+
+    def save(self, uuid: str, assistant):
+        assistant.keep_files = True
+        with assistant.lock:
+            state = json.dumps(assistant.get_state())
+        with self.connect() as connection:
+            #the version is read and written in one write transaction, so two workers saving at once never write the same version
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT version FROM sessions WHERE uuid = ?", (uuid,)).fetchone()
+            version = row[0] + 1 if row is not None else 1
+            connection.execute("INSERT OR REPLACE INTO sessions (uuid, api_key, state, version, updated_at) VALUES (?, ?, ?, ?, ?)",
+                               (uuid, assistant.api_key, state, version, time.time()))
+        with self.lock:
+            evicted = self.cache_assistant(uuid, assistant, version)
+        self.release(evicted)
+
+        if version == 1:
+            self.delete_expired()
+
+    def __contains__(self, uuid: str):
+        #without loading the session into this process
+        with self.connect() as connection:
+            return connection.execute("SELECT 1 FROM sessions WHERE uuid = ?", (uuid,)).fetchone() is not None
+
+    def live(self):
+        with self.lock:
+            return [(uuid, entry[0]) for uuid, entry in self.cache.items()]
+
+    def last_saved(self, uuid: str):
+        with self.connect() as connection:
+            row = connection.execute("SELECT updated_at FROM sessions WHERE uuid = ?", (uuid,)).fetchone()
+        return row[0] if row is not None else None
+
+    def drop(self, uuid: str):
+        with self.lock:
+            entry = self.cache.pop(uuid, None)
+        return entry is not None
+
+    def delete(self, uuid: str):
+        assistant = self.get(uuid)
+        with self.connect() as connection:
+            deleted = connection.execute("DELETE FROM sessions WHERE uuid = ?", (uuid,)).rowcount > 0
+        with self.lock:
+            self.cache.pop(uuid, None)
+        if assistant is not None:
+            #the ChatAssistant destructor now deletes the chat's files as well
+            assistant.keep_files = False
+        return deleted
@@ -0,0 +1,202 @@
+import os
+import re
+import uuid as uuid_module
+import hashlib
+import threading
+from contextlib import contextmanager
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+#The largest file that can be uploaded, in bytes
+MAX_UPLOAD_SIZE = 512 * 1024 * 1024
+
+#Size of the pieces uploads are read and written in
+CHUNK_SIZE = 64 * 1024
+
+#Uploads are written here while they arrive, on the same filesystem as the uuid folders so finishing one is a rename
+INCOMING_DIRECTORY = os.path.join("uploads", "incoming")
+
+
+class HashingFile:
+    '''
+    Hashing File class
+
+    Writable file that an upload is streamed into. Hashes the data and enforces the size limit as each chunk is written,
+    so nothing is buffered in memory and an oversized upload is rejected as soon as it crosses the limit.
+
+    Methods:
+        commit(self, destination_path: str):
+        Moves the finished upload to destination_path and returns its sha256 digest
+    '''
+    def __init__(self, max_size: int = MAX_UPLOAD_SIZE):
+        '''
+        Constructor for the HashingFile class
+        '''
+        os.makedirs(INCOMING_DIRECTORY, exist_ok=True)
+        self.path = os.path.join(INCOMING_DIRECTORY, uuid_module.uuid4().hex)
+        self.file = open(self.path, 'w+b')
+        self.max_size = max_size
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise RequestEntityTooLarge(f"Uploads are limited to {self.max_size} bytes.")
+        self.digest.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name: str):
+        #read, seek, etc. go to the underlying file
+        return getattr(self.file, name)
+
+    def commit(self, destination_path: str):
+        '''
+        Moves the finished upload to destination_path, returns its sha256 hex digest
+        '''
+        self.file.close()
+        os.replace(self.path, destination_path)
+        return self.digest.hexdigest()
+
+    def close(self):
+        '''
+        Closes the file, deleting it if it was never committed (e.g. the request failed)
+        '''
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class UploadRequest(Request):
+    '''
+    Flask request that streams uploaded files straight to disk through a HashingFile,
+    instead of werkzeug's in-memory buffer or spooled temporary file
+    '''
+    def _get_file_stream(self, total_content_length, content_type, filename = None, content_length = None):
+        return HashingFile()
+
+
+class ChunkedUploads:
+    '''
+    Chunked Uploads class
+
+    Resumable uploads sent as a series of raw chunks. Each chunk is appended at the offset the client sends,
+    and a chunk with the wrong offset is rejected with the number of bytes received so far, so the client can resume from there.
+    Once an upload is committed its id is used up, a marker file is left next to where its part was so that chunks sent again with the same id,
+    e.g. a retried request, are refused instead of starting a new part that would replace the committed file.
+
+    Methods:
+        received(self, uuid: str, upload_id: str):
+        Returns the number of bytes received so far
+        append(self, uuid: str, upload_id: str, offset: int, stream):
+        Appends a chunk read from stream, returns whether it was accepted and the number of bytes received so far
+        commit(self, uuid: str, upload_id: str, destination_path: str):
+        Moves the finished upload to destination_path and returns its sha256 digest
+    '''
+    UPLOAD_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+    def __init__(self, max_size: int = MAX_UPLOAD_SIZE):
+        '''
+        Constructor for the ChunkedUploads class
+        '''
+        self.max_size = max_size
+
+        #part file path -> (bytes hashed, sha256 state), so the hash is computed as chunks arrive
+        self.digests = {}
+
+        #part file path -> [lock, requests using it], so chunks of one upload are written in order while other uploads carry on.
+        #An entry only lives while a request is using it
+        self.locks = {}
+
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def upload_lock(self, path: str):
+        '''
+        Holds the upload's lock for the body of the with block, dropping the lock once no request is using it
+        '''
+        with self.lock:
+            entry = self.locks.setdefault(path, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[path]
+
+    def part_path(self, uuid: str, upload_id: str):
+        if not self.UPLOAD_ID.match(upload_id) or not self.UPLOAD_ID.match(uuid):
+            raise ValueError("Invalid upload id.")
+        return os.path.join(INCOMING_DIRECTORY, f"{uuid}-{upload_id}.part")
+
+    def committed_path(self, part_path: str):
+        return part_path[:-len(".part")] + ".done"
+
+    def check_not_committed(self, path: str):
+        if os.path.exists(self.committed_path(path)):
+            raise FileExistsError("This upload has already been committed.")
+
+    def received(self, uuid: str, upload_id: str):
+        '''
+        Returns the number of bytes received so far
+        '''
+        path = self.part_path(uuid, upload_id)
+        self.check_not_committed(path)
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def append(self, uuid: str, upload_id: str, offset: int, stream):
+        '''
+        Appends the chunk read from stream at offset.
+        Returns whether the chunk was accepted (it is rejected if offset is not the number of bytes received so far), and the number of bytes received so far.
+        Raises FileExistsError if the upload has already been committed, and RequestEntityTooLarge, deleting what was received, if it goes over max_size.
+        '''
+        path = self.part_path(uuid, upload_id)
+        os.makedirs(INCOMING_DIRECTORY, exist_ok=True)
+
+        with self.upload_lock(path):
+            received = self.received(uuid, upload_id)
+            if offset != received:
+                return False, received
+
+            hashed, digest = self.digests.pop(path, (0, hashlib.sha256()))
+            #a part deleted since the last chunk (e.g. by the reaper) starts over
+            if not received:
+                hashed, digest = 0, hashlib.sha256()
+            with open(path, 'ab') as f:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                    received += len(chunk)
+                    if received > self.max_size:
+                        #no later chunk could make it fit, so the upload is dropped rather than left to resume
+                        f.close()
+                        os.remove(path)
+                        raise RequestEntityTooLarge(f"Uploads are limited to {self.max_size} bytes.")
+                    f.write(chunk)
+                    #the running hash is only valid if every byte went through it
+                    if hashed == received - len(chunk):
+                        digest.update(chunk)
+                        hashed = received
+            #if the chunk failed part way, the hash is dropped and commit hashes the file from disk instead
+            self.digests[path] = (hashed, digest)
+            return True, received
+
+    def commit(self, uuid: str, upload_id: str, destination_path: str):
+        '''
+        Moves the finished upload to destination_path, returns its sha256 hex digest.
+        Raises FileExistsError if the upload has already been committed, and FileNotFoundError if it was never started.
+        '''
+        path = self.part_path(uuid, upload_id)
+        with self.upload_lock(path):
+            self.check_not_committed(path)
+            hashed, digest = self.digests.pop(path, (0, hashlib.sha256()))
+            #finish the hash from disk if the server restarted part way through the upload
+            if hashed != os.path.getsize(path):
+                digest = hashlib.sha256()
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                        digest.update(chunk)
+            os.replace(path, destination_path)
+            open(self.committed_path(path), 'w').close()
+        return digest.hexdigest()
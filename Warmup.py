@@ -0,0 +1,41 @@
+import time
+import importlib
+from globals import kernel_pool, openai_client, metrics
+from ConversationHistory import ConversationHistory
+
+#heavy modules imported the first time they are needed rather than when the server starts: kernels and notebook outputs, and image variants
+LAZY_MODULES = ("jupyter_client", "nbformat.v4", "PIL.Image")
+
+
+def warmup(kernels: bool = True, connections: int = 2):
+    '''
+    Prepares a worker before it accepts traffic, so its first requests are as fast as the ones after them:
+    imports the lazily imported modules, loads the tokenizer, waits for the idle kernels and opens connections to OpenAI.
+    Returns the seconds each phase took, which /metrics also serves as startup_*_seconds gauges.
+    '''
+    timing = {}
+
+    started = time.perf_counter()
+    for module in LAZY_MODULES:
+        importlib.import_module(module)
+    timing["modules"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    ConversationHistory().count_tokens({"content": ""})
+    timing["tokenizer"] = time.perf_counter() - started
+
+    if kernels:
+        started = time.perf_counter()
+        ready = kernel_pool.warm()
+        timing["kernels"] = time.perf_counter() - started
+        print(f"Warmup: {ready} idle kernels ready")
+
+    if connections:
+        started = time.perf_counter()
+        opened = openai_client.warmup(connections)
+        timing["connections"] = time.perf_counter() - started
+        print(f"Warmup: {opened} connections to OpenAI open")
+
+    timing["total"] = sum(timing.values())
+    metrics.register(lambda: {f"startup_{phase}_seconds": seconds for phase, seconds in timing.items()})
+    return timing
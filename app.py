@@ -2,16 +2,22 @@
 GPT-X
 '''
 import os
-import re
-from flask import Flask, request, jsonify
+import json
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, jsonify, stream_with_context, send_from_directory, redirect
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from ChatAssistant import ChatAssistant
-from globals import assistants
+from globals import session_store, sessions_lock, kernel_pool, job_manager, context_router, completion_check, sandbox_manager, image_store, session_reaper, pipeline_executor, batch_runner, metrics, openai_client
+from Uploads import UploadRequest, HashingFile, ChunkedUploads, MAX_UPLOAD_SIZE
+from CodeBlocks import parse_response
+from Warmup import warmup
+from ContextRouter import classify_remotely
 
-def save_file_to_disk(file, file_name, uuid):
+def get_destination_path(file_name, uuid):
     '''
-    Save a file to disk
+    Get the path an uploaded file is saved to
     '''
 
     # If no directory for the instance  exists, create one
@@ -20,13 +26,33 @@ def save_file_to_disk(file, file_name, uuid):
 
     # destination_path = os.path.join("public", file_name)  # Create the destination path
     destination_path = os.path.join(uuid, file_name)  # Create the destination path
+    return destination_path
+
+def save_file_to_disk(file, file_name, uuid):
+    '''
+    Save a file to disk
+    '''
+    destination_path = get_destination_path(file_name, uuid)
 
     # Save the file to the destination
-    file.save(destination_path)
+    if isinstance(file.stream, HashingFile):
+        # The upload was streamed to disk and hashed as it arrived, so it only needs to be moved into place
+        digest = file.stream.commit(destination_path)
+        # Identical uploads from any chat share one copy on disk
+        sandbox_manager.ingest(destination_path, digest)
+    else:
+        file.save(destination_path)
+
+    return register_saved_file(destination_path, file_name, uuid)
+
+def register_saved_file(destination_path, file_name, uuid):
+    '''
+    Give the assistant access to a file saved to disk
+    '''
 
     # If file is successfully saved to disk
     if os.path.exists(destination_path):
-        assistant = assistants.get(uuid)
+        assistant = session_store.get(uuid)
         assistant.add_file_to_list(destination_path)
         print("File saved to disk successfully!")
 
@@ -54,36 +80,115 @@ def save_file_to_disk(file, file_name, uuid):
         }
         return response
 
-def extract_code_snippet(gpt_repsonse):
+def parse_gpt_response(gpt_response):
     '''
-    Extract any code snippet from the GPT-3 response and remove it from the response string
+    Split a GPT-3 response into the text shown to the user before and after "RES2:" (the response to the interpreter output),
+    its code snippets joined into one string (None if there are none), and its segments, in one pass over the response
     '''
-    pattern = r'```python(.*?)```'
-    match = re.search(pattern, gpt_repsonse, re.DOTALL)
-    code_snippet = match.group(1).strip() if match else None
-    return code_snippet
+    parsed = parse_response(gpt_response)
+    code_snippets = parsed.code_blocks()
+    code_snippet = "\n\n".join(code_snippets) if code_snippets else None
+    gpt_response2 = parsed.text(1) if parsed.has_part(1) else None
+    return parsed.text(0), gpt_response2, code_snippet, [segment.to_dict() for segment in parsed.segments]
 
-def remove_code_snippet(gpt_response):
+def format_send_message_response(gpt_response, interpreter_output):
     '''
-    Remove any code snippet from the GPT-3 response
+    Build the /send_message response body from a GPT-3 response and interpreter output
+    "segments" lists the prose, code blocks, RES2 boundary and image and link tags of the response in order, so the frontend does not have to scan for them
     '''
-    gpt_response = re.sub(r"```python(.*?)```", "", gpt_response, flags=re.DOTALL)
-    return gpt_response
+    gpt_response, gpt_response2, code_snippet, segments = parse_gpt_response(gpt_response)
+
+    if gpt_response2 is None:
+        return {"gpt_response": gpt_response,
+                "interpreter_output": interpreter_output,
+                "code_snippet": code_snippet,
+                "segments": segments}
+    else:
+        return {"gpt_response": gpt_response,
+                "gpt_response2": gpt_response2,
+                "interpreter_output": interpreter_output,
+                "code_snippet": code_snippet,
+                "segments": segments}
 
-def handle_response_with_two_parts(gpt_response):
+def wants_timing():
     '''
-    If the response contains "RES2:", split it into two parts and return both parts
+    Whether the request asked for the per-stage timing breakdown with timing=1
     '''
-    gpt_response2 = gpt_response.split("RES2:")[1]
-    gpt_response = gpt_response.split("RES2:")[0]
-    gpt_response2 = remove_code_snippet(gpt_response2)
+    return request.values.get("timing") in ("1", "true")
 
-    return gpt_response, gpt_response2
+def format_event(event, data):
+    '''
+    Format a server-sent event
+    '''
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_events(events):
+    '''
+    Returns a server-sent event response that sends each (event, data) put on the queue, until a "done" or "error" event
+    '''
+    def generate():
+        while True:
+            try:
+                event, data = events.get(timeout=15)
+            except queue.Empty:
+                # Keep the connection open while a slow stage runs
+                yield ": keepalive\n\n"
+                continue
+            yield format_event(event, data)
+            if event in ("done", "error"):
+                break
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def format_send_file_response(response, gpt_response, interpreter_output):
+    '''
+    Build the /send_file response body from the file save result, a GPT-3 response and interpreter output
+    '''
+    gpt_response, gpt_response2, code_snippet, segments = parse_gpt_response(gpt_response)
+
+    if gpt_response2 is None:
+        return {"system": response['result'],
+                "response": gpt_response,
+                "interpreter_output": interpreter_output,
+                "code_snippet": code_snippet,
+                "segments": segments}
+    else:
+        return {"system": response['result'],
+                "response": gpt_response,
+                "response2": gpt_response2,
+                "interpreter_output": interpreter_output,
+                "code_snippet": code_snippet,
+                "segments": segments}
 
 # Initialize Flask app
 app = Flask(__name__)
+# Stream uploaded files straight to disk, rejecting requests that are too large before they are read
+app.request_class = UploadRequest
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_SIZE + 1024 * 1024
 cors = CORS(app, resources={r"*": {"origins": "*"}})
 
+# Pre-start idle kernels so new chats are handed a warm kernel
+# With GPTX_WARMUP=1 in the environment the worker also waits for them, opens connections to OpenAI and imports the lazily loaded modules
+# before it accepts traffic; read when the app is imported, a WSGI entry point can also call Warmup.warmup() itself before serving
+WARMUP = os.environ.get("GPTX_WARMUP", "0").lower() not in ("", "0", "false", "no")
+if WARMUP:
+    warmup()
+else:
+    kernel_pool.prestart()
+
+# Evict idle chats and chats over their quotas in the background
+session_reaper.start()
+
+# Partially received chunked uploads
+chunked_uploads = ChunkedUploads()
+
+# Worker threads that run streamed turns, while the request thread relays their events to the client
+turn_executor = ThreadPoolExecutor(max_workers=16)
+
+# The most items one /send_batch request may send
+MAX_BATCH_ITEMS = 10000
+
 # @app.route("/save_api_key", methods=["POST"])
 # def save_api_key():
 #     '''
@@ -109,19 +214,22 @@ cors = CORS(app, resources={r"*": {"origins": "*"}})
 #     return jsonify({"status": "success"})
 def save_uuid():
     '''
-    Save the uuid of the user in the global assistants dictionary
+    Save the uuid of the user in the session store
     each uuid is associated with a ChatAssistant object
     '''
 
     uuid = request.json["uuid"]
     api_key = request.json["apiKey"]  # Extract the API key from the request
 
-    if uuid not in assistants:
-        assistants[uuid] = ChatAssistant(api_key, uuid)
-    else:
-        # Update the existing ChatAssistant object with the new API key
-        assistants[uuid].api_key = api_key
-    print(assistants)
+    with sessions_lock:
+        assistant = session_store.get(uuid)
+        if assistant is None:
+            assistant = ChatAssistant(api_key, uuid)
+        else:
+            # Update the existing ChatAssistant object with the new API key
+            assistant.set_api_key(api_key)
+        session_store.save(uuid, assistant)
+    print(f"Session {uuid} saved")
     return jsonify({"status": "success"})
 
 @app.route("/send_message", methods=["POST"])
@@ -134,24 +242,82 @@ def send_message():
     user_message = request.form["message"]
 
     # Send the message to the AI assistant and retrieve a GPT-3 response and interpreter output
-    assistant = assistants.get(uuid)
-    gpt_response, interpreter_output = assistant.send_message(user_message)
-
-    # Extract any code snippet
-    code_snippet = extract_code_snippet(gpt_response)
-    gpt_response = remove_code_snippet(gpt_response)
-
-    # Return the response
-    if "RES2:" not in gpt_response:
-        return jsonify({"gpt_response": gpt_response,
-                        "interpreter_output": interpreter_output,
-                        "code_snippet": code_snippet})
-    else:
-        gpt_response, gpt_response2 = handle_response_with_two_parts(gpt_response)
-        return jsonify({"gpt_response": gpt_response,
-                        "gpt_response2": gpt_response2,
-                        "interpreter_output": interpreter_output,
-                        "code_snippet": code_snippet})
+    assistant = session_store.get(uuid)
+    with metrics.collect() as timing, metrics.span("request", endpoint="send_message"):
+        gpt_response, interpreter_output = assistant.send_message(user_message)
+        session_store.save(uuid, assistant)
+
+    # Return the response, with how long each stage took if it was asked for
+    response = format_send_message_response(gpt_response, interpreter_output)
+    if wants_timing():
+        response["timing"] = timing
+    return jsonify(response)
+
+@app.route("/send_message_stream", methods=["POST"])
+def send_message_stream():
+    '''
+    Send a message to the assistant and stream each stage of the response as server-sent events
+    The final "done" event carries the same body as /send_message
+    The turn runs on turn_executor, but the request thread still waits on the event queue until the turn is over, so an open stream holds a WSGI worker
+    as /send_message does: this cuts the time to the first byte, not the number of workers needed, unless the app is served by an async (e.g. gevent) worker
+    '''
+    # Extract the uuid from the POST request and retrieve the AI assistant object
+    uuid = request.form["uuid"]
+    user_message = request.form["message"]
+    assistant = session_store.get(uuid)
+    timing_requested = wants_timing()
+
+    # Run the turn on a worker thread, which hands each stage to the response through the queue
+    events = queue.Queue()
+
+    def run_turn():
+        try:
+            with metrics.collect() as timing, metrics.span("request", endpoint="send_message_stream"):
+                gpt_response, interpreter_output = assistant.send_message(user_message, lambda event, data: events.put((event, data)))
+                session_store.save(uuid, assistant)
+            response = format_send_message_response(gpt_response, interpreter_output)
+            if timing_requested:
+                response["timing"] = timing
+            events.put(("done", response))
+        except Exception as error:
+            print(f"An unexpected error occurred: {error}")
+            events.put(("error", str(error)))
+
+    turn_executor.submit(run_turn)
+    return stream_events(events)
+
+@app.route("/send_batch", methods=["POST"])
+def send_batch():
+    '''
+    Send many messages, to one or more chats, and stream each result back as a server-sent event as soon as it is ready
+    The body is {"items": [{"uuid", "message"}, ...]}, with an optional "apiKey" to create the chats that do not exist yet as /save_uuid does
+    Messages to the same chat are sent in order, different chats run at the same time on the batch runner's workers
+    Each "result" event carries the item's index, uuid and seconds with the same body as /send_message (or its "error"), the final "done" event the batch's throughput
+    '''
+    body = request.get_json(silent=True) or {}
+    items = body.get("items")
+    if (not isinstance(items, list) or not items
+            or not all(isinstance(item, dict) and isinstance(item.get("uuid"), str) and isinstance(item.get("message"), str) for item in items)):
+        return jsonify({"error": "Provide a non-empty list of items, each with a uuid and a message."}), 400
+    if len(items) > MAX_BATCH_ITEMS:
+        return jsonify({"error": f"A batch may have at most {MAX_BATCH_ITEMS} items."}), 400
+
+    api_key = body.get("apiKey")
+    if api_key:
+        with sessions_lock:
+            for uuid in dict.fromkeys(item["uuid"] for item in items):
+                if session_store.get(uuid) is None:
+                    session_store.save(uuid, ChatAssistant(api_key, uuid))
+
+    events = queue.Queue()
+
+    def on_result(result):
+        if "error" not in result:
+            result.update(format_send_message_response(result.pop("gpt_response"), result.pop("interpreter_output")))
+        events.put(("result", result))
+
+    batch_runner.run(items, on_result, lambda stats: events.put(("done", stats)))
+    return stream_events(events)
 
 @app.route("/send_file", methods=["POST"])
 def send_file():
@@ -160,7 +326,7 @@ def send_file():
     '''
     # Extract the uuid from the POST request and retrieve the AI assistant object
     uuid = request.form["uuid"] 
-    assistant = assistants.get(uuid)
+    assistant = session_store.get(uuid)
 
     # Check if a file was uploaded
     if "file" not in request.files:
@@ -170,44 +336,212 @@ def send_file():
     file = request.files["file"]
     file_name = secure_filename(file.filename)
 
-    # Send the file to the AI assistant API and retrieve a response
-    # response = save_file_to_disk(file, file_name)
-    response = save_file_to_disk(file, file_name, uuid)
+    # Hold the chat while the file is saved and announced, so another request cannot run a turn in between
+    with assistant.lock, metrics.collect() as timing, metrics.span("request", endpoint="send_file"):
+        # Send the file to the AI assistant API and retrieve a response
+        # response = save_file_to_disk(file, file_name)
+        response = save_file_to_disk(file, file_name, uuid)
 
-    # Send the response from the AI assistant API to the AI assistant and retrieve a GPT-3 response and interpreter output
-    gpt_response, interpreter_output = assistant.send_message(response['result'])
+        # Send the response from the AI assistant API to the AI assistant and retrieve a GPT-3 response and interpreter output
+        gpt_response, interpreter_output = assistant.send_message(response['result'])
+        session_store.save(uuid, assistant)
 
-    # Extract any code snippet
-    code_snippet = extract_code_snippet(gpt_response)
-    gpt_response = remove_code_snippet(gpt_response)
+    # Return the response, with how long each stage took if it was asked for
+    body = format_send_file_response(response, gpt_response, interpreter_output)
+    if wants_timing():
+        body["timing"] = timing
+    return jsonify(body)
+
+@app.route("/export_notebook", methods=["GET"])
+def export_notebook():
+    '''
+    Download the code the assistant has run in the chat, and its outputs, as an .ipynb notebook
+    '''
+    uuid = request.args["uuid"]
+    assistant = session_store.get(uuid)
+    if assistant is None:
+        return jsonify({"error": "No chat with this uuid."}), 404
+
+    # The notebook is built from the chat's execution log only when it is asked for
+    notebook_path = assistant.export_notebook()
+    return send_from_directory(os.getcwd(), notebook_path, as_attachment=True, mimetype="application/x-ipynb+json")
+
+@app.route("/job_status", methods=["GET"])
+def job_status():
+    '''
+    Report the status, progress and output so far of a code execution that was moved to a background job
+    ?uuid= lists the chat's jobs, &job_id= reports one of them. A finished job has its "result", which is also added to the chat's messages.
+    '''
+    uuid = request.args["uuid"]
+    job_id = request.args.get("job_id")
+    if job_id is None:
+        return jsonify({"jobs": [job.report() for job in job_manager.jobs_for(uuid)]})
+
+    # Jobs are only reported to the chat that started them
+    job = job_manager.get(job_id)
+    if job is None or job.session_id != uuid:
+        return jsonify({"error": "No job with this id for this chat."}), 404
+    return jsonify(job.report())
+
+@app.route("/images/<key>", methods=["GET"], defaults={"variant": None})
+@app.route("/images/<key>/<variant>", methods=["GET"])
+def image(key, variant):
+    '''
+    Serve a DALL-E image from the image store: /images/<key> is the original, /images/<key>/webp a WebP copy and /images/<key>/thumb a WebP thumbnail
+    '''
+    location = image_store.locate(key, variant)
+    if location is None:
+        return jsonify({"error": "No image with this key."}), 404
+
+    kind, target = location
+    if kind == "remote":
+        # Still downloading, send the browser to OpenAI's URL without letting it keep the redirect
+        response = redirect(target)
+        response.headers["Cache-Control"] = "no-store"
+        return response
+
+    # A key always refers to the same image, so browsers and proxies may keep it for good, with an ETag for revalidation
+    response = send_from_directory(os.path.abspath(image_store.directory), target, max_age=31536000)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+@app.route("/upload_chunk", methods=["GET", "POST"])
+def upload_chunk():
+    '''
+    Resumable upload of a large file, sent as raw chunks in the request body
+    GET returns how many bytes of the upload have been received, so an interrupted upload can resume from there
+    POST appends the body at ?offset=, the last chunk adds &final=1&file_name= to send the file to the assistant like /send_file
+    Once the last chunk is in, the upload_id is used up: further requests with it get a 409
+    '''
+    uuid = request.args["uuid"]
+    upload_id = request.args["upload_id"]
+    if uuid not in session_store:
+        return jsonify({"error": "No chat with this uuid."}), 404
+
+    try:
+        if request.method == "GET":
+            return jsonify({"upload_id": upload_id, "received": chunked_uploads.received(uuid, upload_id)})
+
+        accepted, received = chunked_uploads.append(uuid, upload_id, int(request.args.get("offset", 0)), request.stream)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    except FileExistsError as error:
+        return jsonify({"error": str(error), "upload_id": upload_id}), 409
+
+    if not accepted:
+        return jsonify({"error": "The offset does not match the bytes received so far.", "upload_id": upload_id, "received": received}), 409
+    if request.args.get("final") != "1":
+        return jsonify({"upload_id": upload_id, "received": received})
+
+    assistant = session_store.get(uuid)
+    if assistant is None:
+        return jsonify({"error": "No chat with this uuid."}), 404
+    file_name = secure_filename(request.args.get("file_name", ""))
+    if not file_name:
+        return jsonify({"error": "Provide a file_name with the final chunk."}), 400
+
+    # Hold the chat while the file is saved and announced, so another request cannot run a turn in between
+    with assistant.lock, metrics.collect() as timing, metrics.span("request", endpoint="upload_chunk"):
+        destination_path = get_destination_path(file_name, uuid)
+        try:
+            digest = chunked_uploads.commit(uuid, upload_id, destination_path)
+        except FileExistsError as error:
+            # Committed by another request with the same id meanwhile
+            return jsonify({"error": str(error), "upload_id": upload_id}), 409
+        except FileNotFoundError:
+            # Never started, or deleted by the reaper
+            return jsonify({"error": "No upload with this id.", "upload_id": upload_id}), 404
+        sandbox_manager.ingest(destination_path, digest)
+        response = register_saved_file(destination_path, file_name, uuid)
+
+        gpt_response, interpreter_output = assistant.send_message(response['result'])
+        session_store.save(uuid, assistant)
+
+    # Return the response, with how long each stage took if it was asked for
+    body = format_send_file_response(response, gpt_response, interpreter_output)
+    if wants_timing():
+        body["timing"] = timing
+    return jsonify(body)
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    '''
+    Report stage latency histograms, token counts and kernel, router and recursion check gauges in the Prometheus text format
+    '''
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/router_stats", methods=["GET"])
+def router_stats():
+    '''
+    Report the context router's live cache/local/remote latencies next to the classifiers' accuracy on held-out examples
+    The remote classifier is evaluated too (one completion per example) with ?remote=1, using the server's OPENAI_API_KEY,
+    or with ?uuid=<chat>, using that chat's API key; otherwise only the local one is
+    '''
+    remote_classifier = None
+    uuid = request.args.get("uuid")
+    if uuid is not None:
+        assistant = session_store.get(uuid)
+        if assistant is None:
+            return jsonify({"error": "No chat with this uuid."}), 404
+        remote_classifier = assistant.remoteClassifier
+    elif request.args.get("remote", "0").lower() not in ("", "0", "false", "no"):
+        api_key = os.environ.get("OPENAI_API_KEY", "")
+        if api_key == "":
+            return jsonify({"error": "Set OPENAI_API_KEY, or pass the uuid of a chat, to evaluate the remote classifier."}), 400
+        client = openai_client.for_key(api_key)
+        remote_classifier = lambda message: classify_remotely(client, message)
+    return jsonify({"live": context_router.report(),
+                    "evaluation": context_router.evaluate(remote_classifier=remote_classifier)})
+
+@app.route("/completion_check_stats", methods=["GET"])
+def completion_check_stats():
+    '''
+    Report how often the recursion check was skipped by the heuristic gate and how often it asked the model
+    '''
+    return jsonify(completion_check.report())
+
+@app.route("/openai_stats", methods=["GET"])
+def openai_stats():
+    '''
+    Report the OpenAI client's call, retry and throttling counts, the requests and tokens of the last minute for each API key,
+    and the response cache's hit rates if it is enabled
+    '''
+    return jsonify({"client": openai_client.report(),
+                    "keys": openai_client.usage(),
+                    "cache": openai_client.cache.report() if openai_client.cache is not None else None})
+
+@app.route("/reaper_stats", methods=["GET"])
+def reaper_stats():
+    '''
+    Report how many chats the session reaper evicted for each reason, the bytes it reclaimed, and the disk and memory the chats used at its last sweep
+    '''
+    return jsonify(session_reaper.report())
+
+@app.route("/pipeline_stats", methods=["GET"])
+def pipeline_stats():
+    '''
+    Report how many turn stages ran in the background, and how often a speculative response was used, thrown away or never started
+    '''
+    return jsonify(pipeline_executor.report())
+
+@app.route("/batch_stats", methods=["GET"])
+def batch_stats():
+    '''
+    Report how many batches and items /send_batch has sent and how many failed, and the throughput and latencies of the last batch
+    '''
+    return jsonify(batch_runner.report())
 
-    # Return the response
-    if "RES2:" not in gpt_response:
-        return jsonify({"system": response['result'],
-                        "response": gpt_response,
-                        "interpreter_output": interpreter_output,
-                        "code_snippet": code_snippet})
-    else:
-        gpt_response, gpt_response2 = handle_response_with_two_parts(gpt_response)
-        return jsonify({"system": response['result'],
-                        "response": gpt_response,
-                        "response2": gpt_response2,
-                        "interpreter_output": interpreter_output,
-                        "code_snippet": code_snippet})
-    
 @app.route("/delete_chat", methods=["POST"])
 def delete_chat():
     '''
     Delete the chat history of the user
     '''
-    #delete the chatassistant object from the dictionary
+    #delete the chatassistant object from the session store
     uuid = request.json["uuid"]
-    assistant = assistants.get(uuid)
-    del assistant
-
-    #call the destructor
-    del assistants[uuid]
-    if uuid not in assistants:
+    with sessions_lock:
+        #the destructor is called once any turn still running on the chat has finished with it
+        deleted = session_store.delete(uuid)
+    if deleted:
         print("Chat history deleted successfully!")
         return jsonify({"status": "success"})
     else:
@@ -0,0 +1,288 @@
+'''
+Benchmark and load test for the Flask app
+
+Drives /send_message and /send_file through Flask's test client with the openai module patched to a local stand-in,
+so the numbers measure this server (kernels, sandboxes, routing, recursion checks) rather than OpenAI.
+Startup is measured first, in fresh interpreters: the time to import the app and each phase of the warmup.
+
+    python benchmark.py --concurrency 1,4,16 --history 0,50 --requests 20 --chat-latency 0.5
+    python benchmark.py --endpoints "" --startup-runs 5
+'''
+import os
+import io
+import sys
+import time
+import random
+import shutil
+import json
+import argparse
+import tempfile
+import subprocess
+import threading
+from collections import defaultdict
+
+import openai
+
+# Run from the repository regardless of the current directory, writing notebooks and uploads to a scratch directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+SCRATCH_DIRECTORY = tempfile.mkdtemp(prefix="gpt-x-benchmark-")
+
+from Metrics import percentile
+
+
+class FakeOpenAI:
+    '''
+    Fake OpenAI class
+
+    Stands in for openai.ChatCompletion, openai.Completion and openai.Image with fixed latencies.
+    Chat replies contain a python snippet with probability code_ratio, the interpreter's output gets a reply without code
+    and the recursion checker is answered "yes", as in a real turn.
+    '''
+    def __init__(self, chat_latency: float = 0.5, completion_latency: float = 0.2, image_latency: float = 1.0, code_ratio: float = 0.5, seed: int = 0):
+        '''
+        Constructor for the FakeOpenAI class
+        '''
+        self.chat_latency = chat_latency
+        self.completion_latency = completion_latency
+        self.image_latency = image_latency
+        self.code_ratio = code_ratio
+        self.random = random.Random(seed)
+        self.calls = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def count(self, name: str):
+        with self.lock:
+            self.calls[name] += 1
+
+    def chat_completion(self, model: str = "gpt-4", messages: list = (), stream: bool = False, **kwargs):
+        self.count("ChatCompletion")
+        time.sleep(self.chat_latency)
+
+        last = messages[-1]['content'] if messages else ""
+        if last.startswith("Automated Task Checker: If the user"):
+            content = "yes"
+        #the interpreter's output is sent back as the user's message, see ChatAssistant.generate_gpt_response
+        elif last.startswith("Babbage Python Interpreter"):
+            content = "The interpreter output shows the answer."
+        else:
+            with self.lock:
+                code = self.random.random() < self.code_ratio
+            content = "Here is the program:\n```python\nprint(sum(range(100)))\n```" if code else "Paris is the capital of France."
+
+        if stream:
+            return iter([openai.openai_object.OpenAIObject.construct_from({"choices": [{"delta": {"content": content}}]})])
+        return openai.openai_object.OpenAIObject.construct_from({"choices": [{"message": {"role": "assistant", "content": content}}]})
+
+    def completion(self, **kwargs):
+        self.count("Completion")
+        time.sleep(self.completion_latency)
+        return openai.openai_object.OpenAIObject.construct_from({"choices": [{"text": " Standard"}]})
+
+    def image(self, **kwargs):
+        self.count("Image")
+        time.sleep(self.image_latency)
+        return {"data": [{"url": "https://example.com/image.png"}]}
+
+    def install(self):
+        '''
+        Patches the openai module to use this stand-in
+        '''
+        openai.ChatCompletion.create = self.chat_completion
+        openai.Completion.create = self.completion
+        openai.Image.create = self.image
+
+
+class StageTimer:
+    '''
+    Stage Timer class
+
+    Wraps methods on the hot path to record how long each stage of a turn takes
+    '''
+    def __init__(self):
+        '''
+        Constructor for the StageTimer class
+        '''
+        self.times = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def wrap(self, owner, method_name: str, stage: str):
+        method = getattr(owner, method_name)
+        timer = self
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                with timer.lock:
+                    timer.times[stage].append(time.perf_counter() - start)
+
+        setattr(owner, method_name, timed)
+
+    def reset(self):
+        with self.lock:
+            self.times = defaultdict(list)
+
+
+def summarize(values: list):
+    return {"count": len(values),
+            "mean": sum(values) / len(values) if values else 0.0,
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99)}
+
+
+def prefill_history(assistant, turns: int):
+    '''
+    Adds turns of fake conversation to the assistant's history, to measure the cost of long chats
+    '''
+    for turn in range(turns):
+        assistant.messages.append({"role": "user", "content": f"Question number {turn}: what is {turn} squared, and why?"})
+        assistant.messages.append({"role": "assistant", "content": f"{turn} squared is {turn * turn}, because {turn} times {turn} is {turn * turn}."})
+
+
+def run_level(app_module, endpoint: str, concurrency: int, history: int, requests_per_session: int, file_size: int):
+    '''
+    Runs requests_per_session requests against endpoint from each of concurrency sessions at once.
+    Returns the request latencies and the wall-clock time.
+    '''
+    client = app_module.app.test_client()
+    uuids = [f"bench-{endpoint}-{concurrency}-{history}-{index}" for index in range(concurrency)]
+    for uuid in uuids:
+        client.post("/save_uuid", json={"uuid": uuid, "apiKey": "sk-benchmark"})
+        prefill_history(app_module.session_store.get(uuid), history)
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    payload = os.urandom(file_size)
+
+    def session(uuid: str):
+        session_client = app_module.app.test_client()
+        for index in range(requests_per_session):
+            start = time.perf_counter()
+            if endpoint == "send_message":
+                response = session_client.post("/send_message", data={"uuid": uuid, "message": f"What is the capital of France? ({index})"})
+            else:
+                response = session_client.post("/send_file", data={"uuid": uuid, "file": (io.BytesIO(payload), f"data_{index}.bin")},
+                                               content_type="multipart/form-data")
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code != 200:
+                    errors.append(response.status_code)
+
+    threads = [threading.Thread(target=session, args=(uuid,)) for uuid in uuids]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - start
+
+    for uuid in uuids:
+        client.post("/delete_chat", json={"uuid": uuid})
+
+    return latencies, errors, wall_time
+
+
+#run in a fresh interpreter by measure_startup, prints the seconds each startup phase took as its last line
+STARTUP_SCRIPT = '''
+import json, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter() - started
+from Warmup import warmup
+timing = warmup(connections={connections})
+app.kernel_pool.shutdown_all()
+print(json.dumps({{"import": imported, **timing}}))
+'''
+
+
+def measure_startup(runs: int, connections: int):
+    '''
+    Starts the app in runs fresh interpreters, returns {phase: [seconds of each run]} for the import and each warmup phase
+    '''
+    repository = os.path.dirname(os.path.abspath(__file__))
+    environment = dict(os.environ, PYTHONPATH=repository + os.pathsep + os.environ.get("PYTHONPATH", ""))
+    phases = defaultdict(list)
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT.format(connections=connections)], cwd=SCRATCH_DIRECTORY,
+                                env=environment, capture_output=True, text=True, timeout=300)
+        if result.returncode != 0:
+            raise RuntimeError(f"Startup run failed:\n{result.stderr}")
+        for phase, seconds in json.loads(result.stdout.strip().splitlines()[-1]).items():
+            phases[phase].append(seconds)
+    return phases
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /send_message and /send_file with a local OpenAI stand-in")
+    parser.add_argument("--endpoints", default="send_message,send_file", help="comma separated endpoints to benchmark")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated numbers of concurrent sessions")
+    parser.add_argument("--history", default="0,50", help="comma separated numbers of prior turns in each conversation")
+    parser.add_argument("--requests", type=int, default=10, help="requests sent by each session")
+    parser.add_argument("--chat-latency", type=float, default=0.5, help="seconds per ChatCompletion call")
+    parser.add_argument("--completion-latency", type=float, default=0.2, help="seconds per Completion call")
+    parser.add_argument("--image-latency", type=float, default=1.0, help="seconds per Image call")
+    parser.add_argument("--code-ratio", type=float, default=0.5, help="fraction of replies that contain a python snippet")
+    parser.add_argument("--file-size", type=int, default=1024 * 1024, help="bytes per /send_file upload")
+    parser.add_argument("--startup-runs", type=int, default=3, help="fresh interpreters to measure import and warmup time in, 0 to skip")
+    parser.add_argument("--warmup-connections", type=int, default=0, help="connections to OpenAI opened by the measured warmup (needs network)")
+    args = parser.parse_args()
+
+    if args.startup_runs:
+        print(f"Startup over {args.startup_runs} fresh interpreters (ms)")
+        print(f"{'phase':<14}{'mean':>10}{'min':>10}{'max':>10}")
+        for phase, times in measure_startup(args.startup_runs, args.warmup_connections).items():
+            summary = summarize(times)
+            print(f"{phase:<14}{summary['mean'] * 1000:>10.1f}{min(times) * 1000:>10.1f}{max(times) * 1000:>10.1f}")
+        print()
+
+    fake = FakeOpenAI(args.chat_latency, args.completion_latency, args.image_latency, args.code_ratio)
+    fake.install()
+
+    os.chdir(SCRATCH_DIRECTORY)
+    import app as app_module
+    from ChatAssistant import ChatAssistant
+    from KernelPool import KernelPool
+    from SandboxManager import SandboxManager
+
+    stages = StageTimer()
+    stages.wrap(KernelPool, "start_kernel", "kernel startup")
+    stages.wrap(SandboxManager, "prepare", "sandbox staging")
+    stages.wrap(ChatAssistant, "contextClassifier", "classifier")
+    stages.wrap(ChatAssistant, "generate_gpt_response", "model calls")
+    stages.wrap(ChatAssistant, "send_code_to_interpreter", "interpreter")
+    stages.wrap(ChatAssistant, "recursion", "recursion check")
+
+    print(f"ChatCompletion {args.chat_latency}s, Completion {args.completion_latency}s, Image {args.image_latency}s, code in {args.code_ratio:.0%} of replies")
+    print(f"{'endpoint':<14}{'sessions':>9}{'history':>9}{'requests':>9}{'errors':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>8}")
+    breakdowns = []
+    try:
+        for endpoint in filter(None, args.endpoints.split(",")):
+            for concurrency in [int(value) for value in args.concurrency.split(",")]:
+                for history in [int(value) for value in args.history.split(",")]:
+                    stages.reset()
+                    latencies, errors, wall_time = run_level(app_module, endpoint, concurrency, history, args.requests, args.file_size)
+                    summary = summarize(latencies)
+                    print(f"{endpoint:<14}{concurrency:>9}{history:>9}{summary['count']:>9}{len(errors):>7}"
+                          f"{summary['p50'] * 1000:>10.1f}{summary['p95'] * 1000:>10.1f}{summary['p99'] * 1000:>10.1f}{summary['count'] / wall_time:>8.2f}")
+                    breakdowns.append((endpoint, concurrency, history, {stage: summarize(times) for stage, times in stages.times.items()}))
+
+        print("\nStage breakdown (ms)")
+        print(f"{'endpoint':<14}{'sessions':>9}{'history':>9}  {'stage':<18}{'calls':>7}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}")
+        for endpoint, concurrency, history, breakdown in breakdowns:
+            for stage, summary in sorted(breakdown.items()):
+                print(f"{endpoint:<14}{concurrency:>9}{history:>9}  {stage:<18}{summary['count']:>7}{summary['mean'] * 1000:>10.1f}"
+                      f"{summary['p50'] * 1000:>10.1f}{summary['p95'] * 1000:>10.1f}{summary['p99'] * 1000:>10.1f}")
+
+        print("\nOpenAI calls:", dict(fake.calls))
+    finally:
+        app_module.kernel_pool.shutdown_all()
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        shutil.rmtree(SCRATCH_DIRECTORY, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,76 @@
 '''
 global variables
 '''
+import threading
+from KernelPool import KernelPool
+from ContextRouter import ContextRouter
+from CompletionCheck import CompletionCheckPolicy
+from SandboxManager import SandboxManager
+from SessionStore import MemorySessionStore
+from Metrics import Metrics
+from OpenAIClient import OpenAIClient
+from ResponseCache import ResponseCache
+from JobManager import JobManager
+from ImageStore import ImageStore
+from SessionReaper import SessionReaper
+from Pipeline import PipelineExecutor
+from BatchRunner import BatchRunner
 
-assistants = {}
+#ChatAssistant for each uuid
+#use SessionStore.SQLiteSessionStore("sessions.db") to keep sessions across restarts and share them between worker processes
+session_store = MemorySessionStore()
+
+#held while a session is looked up and created or deleted
+sessions_lock = threading.Lock()
+
+#IPython kernels shared by every ChatAssistant
+kernel_pool = KernelPool()
+
+#Per-chat sandbox directories and the content-addressed store for uploaded files
+sandbox_manager = SandboxManager()
+
+#Moves code executions that run past a threshold to a bounded set of background jobs, so they do not hold the HTTP request
+job_manager = JobManager()
+
+#Local copies of DALL-E images, keyed by prompt and stored by content, served by /images
+image_store = ImageStore()
+
+#Evicts idle chats and chats over the disk and memory quotas, and deletes files left behind by chats that are gone
+session_reaper = SessionReaper(session_store, sessions_lock, kernel_pool, sandbox_manager, job_manager)
+
+#Picks the prompt for each message, shared so its cache is shared between chats
+context_router = ContextRouter()
+
+#Decides when the recursion check needs to ask the model if the problem was solved
+completion_check = CompletionCheckPolicy()
+
+#Opt-in cache of OpenAI responses for calls that are repeated verbatim (classifier, recursion check, DALL-E prompt and image)
+#use ResponseCache() to cache in memory, or ResponseCache(disk_path="response_cache.db") to keep responses across restarts and share them between worker processes
+response_cache = None
+
+#Every OpenAI call goes through this client, for pooled connections, per-key concurrency limits and retries with backoff
+openai_client = OpenAIClient(cache=response_cache)
+
+#Stage timings, token counts and component gauges, served by /metrics
+metrics = Metrics()
+
+#Runs the stages of a turn that can overlap (warming the kernel, speculative responses) on a bounded pool of threads
+pipeline_executor = PipelineExecutor(metrics=metrics)
+
+#Sends the messages of /send_batch, one chat's messages in order and at most max_workers chats at once
+batch_runner = BatchRunner(session_store)
+
+metrics.register(lambda: {"kernels_idle": len(kernel_pool.idle_kernels),
+                          "kernels_assigned": len(kernel_pool.session_kernels),
+                          "kernels_starting": kernel_pool.starting})
+metrics.register(lambda: {f"completion_check_{name}": value for name, value in completion_check.report().items()})
+metrics.register(lambda: {f"router_{source}_calls": report["calls"] for source, report in context_router.report().items()})
+metrics.register(lambda: {f"jobs_{name}": value for name, value in job_manager.report().items()})
+metrics.register(lambda: {f"images_{name}": value for name, value in image_store.report().items()})
+metrics.register(lambda: {f"pipeline_{name}": value for name, value in pipeline_executor.report().items()})
+metrics.register(lambda: {f"reaper_{name}": value for name, value in session_reaper.report().items()})
+metrics.register(lambda: {f"batch_{name}": value for name, value in batch_runner.report().items()})
+metrics.register(lambda: {f"openai_{name}": value for name, value in openai_client.report().items()})
+if response_cache is not None:
+    metrics.register(lambda: {f"response_cache_{cache_type}_{name}": value
+                              for cache_type, stats in response_cache.report()["types"].items() for name, value in stats.items()})
@@ -0,0 +1,137 @@
+import random
+import pytest
+from CodeBlocks import ResponseParser, parse_response, extract_code_blocks, MAX_TAG_LENGTH
+
+#pieces random responses are built from: every marker, the text that ends it, and text that only looks like one
+PIECES = ["```", "```python\n", "```js\n", "````", "RES2:", "RES2", "[img]", "[/img]", "[link]", "[/link]", "[im", "g]",
+          "print(1)\n", "x = 'RES2:'\n", "hello ", "world", "\n", " ", "`", "[", "]", "https://example.com/a.png", "/f.csv"]
+
+
+def streamed(text: str, sizes):
+    '''
+    Parses text fed in chunks of the given sizes (the last one takes the rest)
+    '''
+    parser = ResponseParser()
+    position = 0
+    for size in sizes:
+        parser.feed(text[position:position + size])
+        position += size
+    return parser.feed(text[position:]).close()
+
+
+def segments(parser: ResponseParser):
+    return [(segment.kind, segment.part, segment.raw, segment.text, segment.language) for segment in parser.segments]
+
+
+def test_segments_of_a_whole_response():
+    parser = parse_response("Here:\n```python\nprint(1)\n```\n[img]https://example.com/a.png[/img] RES2: Done, [link]/f.csv[/link]")
+    assert [segment.to_dict() for segment in parser.segments] == [
+        {"type": "prose", "part": 0, "text": "Here:\n"},
+        {"type": "code", "part": 0, "text": "print(1)", "language": "python"},
+        {"type": "prose", "part": 0, "text": "\n"},
+        {"type": "image", "part": 0, "text": "https://example.com/a.png"},
+        {"type": "prose", "part": 0, "text": " "},
+        {"type": "res2", "part": 0, "text": "RES2:"},
+        {"type": "prose", "part": 1, "text": " Done, "},
+        {"type": "link", "part": 1, "text": "/f.csv"},
+    ]
+    assert parser.code_blocks() == ["print(1)"]
+    assert parser.text(0) == "Here:\n\n[img]https://example.com/a.png[/img] "
+    assert parser.text(1) == " Done, [link]/f.csv[/link]"
+
+
+@pytest.mark.parametrize("text", [
+    "a ```python\nprint(1)\n``` b",
+    "```js\nlet a\n``` then RES2: more",
+    "see [img]https://example.com/a.png[/img] and [link]/f.csv[/link]",
+    "A ```python\nx = 'RES2:'\n``` RES2: B",
+    "```\n[img]not a tag[/img]\n```",
+])
+def test_every_split_point_gives_the_same_segments(text):
+    whole = segments(parse_response(text))
+    for split in range(len(text) + 1):
+        assert segments(streamed(text, [split])) == whole, split
+    #and one character at a time
+    assert segments(streamed(text, [1] * len(text))) == whole
+
+
+def test_code_block_is_reported_as_soon_as_it_closes():
+    found = []
+    parser = ResponseParser(on_segment=found.append)
+    parser.feed("Run this:\n```pyt").feed("hon\nprint(1)\n``").feed("`")
+    assert [segment.kind for segment in found] == ["prose", "code"]
+    assert found[-1].text == "print(1)"
+    parser.feed(" and more").close()
+    assert [segment.kind for segment in found] == ["prose", "code", "prose"]
+
+
+def test_unpaired_fence_is_prose():
+    text = "Start ```python\nprint(1)\nnever closed"
+    parser = parse_response(text)
+    assert parser.code_blocks() == []
+    assert {segment.kind for segment in parser.segments} == {"prose"}
+    assert parser.text(0) == text
+
+
+def test_unpaired_fence_before_a_closed_block():
+    parser = parse_response("```python\nprint(1)\n```\nthen ``` alone")
+    assert parser.code_blocks() == ["print(1)"]
+    assert parser.text(0) == "\nthen ``` alone"
+
+
+def test_four_backtick_fence_is_not_run():
+    text = "````python\nprint(1)\n````"
+    parser = parse_response(text)
+    assert parser.code_blocks() == []
+    #shown to the user as it was written
+    assert parser.text(0) == text
+
+
+def test_res2_inside_a_python_block_does_not_split_the_response():
+    parser = parse_response("```python\nprint('RES2:')\n```")
+    assert parser.code_blocks() == ["print('RES2:')"]
+    assert not parser.has_part(1)
+
+
+def test_tag_open_at_res2_is_prose():
+    parser = parse_response("[img]https://example.com RES2: [/img]")
+    assert [segment.kind for segment in parser.segments] == ["prose", "res2", "prose"]
+    assert parser.has_part(1)
+
+
+def test_unclosed_tag_longer_than_the_limit_is_prose():
+    text = "[img]" + "a" * (MAX_TAG_LENGTH + 10) + "[/img]"
+    parser = parse_response(text)
+    assert "image" not in [segment.kind for segment in parser.segments]
+    assert parser.text(0) == text
+
+
+def test_finish_parses_only_what_was_not_fed():
+    found = []
+    parser = ResponseParser(on_segment=found.append)
+    parser.feed("a ```python\nprint(1)\n```")
+    parser.finish("a ```python\nprint(1)\n``` [img]u[/img]")
+    assert [segment.kind for segment in found] == ["prose", "code", "prose", "image"]
+
+
+def test_finish_with_a_different_response_parses_it_again():
+    parser = ResponseParser()
+    parser.feed("```python\nprint('first attempt')")
+    parser.finish("```python\nprint('retried')\n```")
+    assert parser.code_blocks() == ["print('retried')"]
+
+
+def test_extract_code_blocks():
+    assert extract_code_blocks("```python\na = 1\n```\n```js\nb\n```\n```python\nprint(a)\n```") == ["a = 1", "print(a)"]
+
+
+def test_streamed_and_whole_parsing_agree_on_random_responses():
+    generator = random.Random(0)
+    for _ in range(3000):
+        text = "".join(generator.choice(PIECES) for _ in range(generator.randint(0, 30)))
+        sizes = [generator.randint(1, 8) for _ in range(generator.randint(0, 20))]
+        whole = parse_response(text)
+        parser = streamed(text, sizes)
+        assert segments(parser) == segments(whole), (text, sizes)
+        #nothing is lost or repeated
+        assert "".join(segment.raw for segment in parser.segments) == text
@@ -0,0 +1,116 @@
+import pytest
+from ConversationHistory import ConversationHistory, Message
+
+
+@pytest.fixture(autouse=True)
+def no_tokenizer(monkeypatch):
+    #estimate token counts instead of fetching the tokenizer, so the counts do not depend on the network
+    monkeypatch.setitem(ConversationHistory.encodings, "gpt-4", None)
+
+
+def recount(history: ConversationHistory):
+    return ConversationHistory.TOKENS_PER_REPLY + sum(history.count_tokens(message.to_dict()) for message in history)
+
+
+def make_history(turns: int = 0, **kwargs):
+    history = ConversationHistory([{"role": "system", "content": "You are a helpful assistant."}], **kwargs)
+    for turn in range(turns):
+        history.append({"role": "user", "content": f"question {turn} " + "word " * 20})
+        history.append({"role": "assistant", "content": f"answer {turn} " + "word " * 20})
+    return history
+
+
+def test_running_total_matches_the_messages():
+    history = make_history(5)
+    assert history.total_tokens == recount(history)
+    assert all(isinstance(message, Message) for message in history)
+    assert history.payload()[1] == {"role": "user", "content": "question 0 " + "word " * 20}
+
+
+def test_list_operations_keep_the_total():
+    history = make_history(5)
+    history.pop()
+    del history[2:4]
+    history[1] = {"role": "user", "content": "replaced"}
+    history.insert(1, {"role": "user", "content": "inserted"})
+    history += [{"role": "assistant", "content": "added"}]
+    assert history.total_tokens == recount(history)
+    history.clear()
+    assert history.total_tokens == ConversationHistory.TOKENS_PER_REPLY
+
+
+def test_rollback_removes_what_was_added_after_the_checkpoint():
+    history = make_history(2)
+    before = (history.payload(), history.total_tokens)
+    mark = history.checkpoint()
+    history.append({"role": "user", "content": "Automated Task Checker: solved?"})
+    history.append({"role": "assistant", "content": "yes"})
+    history.rollback(mark)
+    assert (history.payload(), history.total_tokens) == before
+
+
+def test_rollback_keep_messages_only_removes_the_injected_prompt():
+    history = make_history(1)
+    mark = history.checkpoint()
+    history.append({"role": "user", "content": "what is 2 + 2?"})
+    tokens, total = history[-1].tokens, history.total_tokens
+    history.inject("use python to solve the following problem")
+    assert history.payload()[-1]["content"] == "use python to solve the following problem:::what is 2 + 2?"
+    assert history.total_tokens > total
+
+    history.append({"role": "assistant", "content": "4"})
+    history.rollback(mark, keep_messages=True)
+    assert [message["content"] for message in history[-2:]] == ["what is 2 + 2?", "4"]
+    assert history[-2].tokens == tokens
+    assert history.total_tokens == recount(history)
+
+
+def test_rollback_does_not_tokenize_again(monkeypatch):
+    history = make_history(1)
+    mark = history.checkpoint()
+    history.append({"role": "user", "content": "hello"})
+    history.inject("prompt")
+
+    def count_tokens(message):
+        raise AssertionError("tokenized again")
+    monkeypatch.setattr(history, "count_tokens", count_tokens)
+    history.rollback(mark, keep_messages=True)
+    history.rollback(mark)
+    assert len(history) == 3
+
+
+def test_rollback_of_a_prompt_injected_into_an_older_message():
+    history = make_history(1)
+    history.append({"role": "user", "content": "hello"})
+    mark = history.checkpoint()
+    history.inject("prompt")
+    history.append({"role": "user", "content": "checker"})
+    history.rollback(mark)
+    assert history.payload()[-1] == {"role": "user", "content": "hello"}
+    assert history.total_tokens == recount(history)
+
+
+def test_compact_trims_the_oldest_messages_and_keeps_the_system_prompt_and_recent_ones():
+    history = make_history(20, max_tokens=200, keep_recent=4)
+    recent = history.payload()[-4:]
+    history.compact()
+    assert history.total_tokens <= 200
+    assert history[0]["role"] == "system"
+    assert history.payload()[-4:] == recent
+    assert history.total_tokens == recount(history)
+    #what is left is the end of the conversation
+    assert history[1]["content"].startswith(("question", "answer"))
+
+
+def test_compact_never_trims_the_recent_messages():
+    history = make_history(3, max_tokens=10, keep_recent=4)
+    history.compact()
+    assert len(history) == 5
+    assert history.total_tokens > 10
+
+
+def test_compact_under_budget_changes_nothing():
+    history = make_history(3)
+    messages = list(history)
+    history.compact()
+    assert list(history) == messages
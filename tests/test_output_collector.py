@@ -0,0 +1,111 @@
+import base64
+import os
+from OutputCollector import OutputCollector
+
+
+def message(msg_type: str, **content):
+    return {"header": {"msg_type": msg_type}, "msg_type": msg_type, "parent_header": {}, "metadata": {}, "content": content}
+
+
+def stream(text: str, name: str = "stdout"):
+    return message("stream", name=name, text=text)
+
+
+def test_outputs_are_merged_in_the_order_they_arrived():
+    collector = OutputCollector()
+    collector.hook(stream("first\n"))
+    collector.hook(stream("warning\n", "stderr"))
+    collector.hook(message("execute_result", data={"text/plain": "42"}, metadata={}, execution_count=1))
+    assert collector.text() == "first\nwarning\n42"
+    assert [output.output_type for output in collector.notebook_outputs()] == ["stream", "stream", "execute_result"]
+
+
+def test_consecutive_stream_outputs_are_one_notebook_output():
+    collector = OutputCollector()
+    for line in range(3):
+        collector.hook(stream(f"line {line}\n"))
+    outputs = collector.notebook_outputs()
+    assert len(outputs) == 1
+    assert outputs[0].text == "line 0\nline 1\nline 2\n"
+
+
+def test_error_is_recorded_without_colour_codes():
+    collector = OutputCollector()
+    collector.hook(message("error", ename="ZeroDivisionError", evalue="division by zero",
+                           traceback=["\x1b[0;31mZeroDivisionError\x1b[0m: division by zero"]))
+    assert collector.error == "ZeroDivisionError: division by zero"
+    assert collector.text() == "ZeroDivisionError: division by zero"
+
+
+def test_byte_cap_calls_on_cap_once():
+    calls = []
+    collector = OutputCollector(max_bytes=1000, keep_chars=100, on_cap=lambda: calls.append(1))
+    for _ in range(50):
+        collector.hook(stream("x" * 99 + "\n"))
+    assert collector.capped
+    assert calls == [1]
+    assert collector.bytes == 5000
+
+
+def test_line_cap():
+    calls = []
+    collector = OutputCollector(max_lines=10, on_cap=lambda: calls.append(1))
+    for line in range(10):
+        collector.hook(stream(f"{line}\n"))
+    assert not collector.capped
+    collector.hook(stream("one too many\n"))
+    assert collector.capped
+    assert calls == [1]
+    assert collector.lines == 11
+
+
+def test_only_the_start_and_end_of_long_output_are_held():
+    collector = OutputCollector(max_bytes=10 ** 9, max_lines=10 ** 9, keep_chars=100)
+    for line in range(10000):
+        collector.hook(stream(f"line {line}\n"))
+    assert len(collector.head) == 100
+    assert collector.tail_chars == 100
+    text = collector.text()
+    assert text.startswith("line 0\n")
+    assert text.endswith("line 9999")
+    omitted = collector.bytes - 200
+    assert f"[{omitted} characters omitted]" in text
+
+
+def test_text_is_cut_to_max_chars_keeping_the_start_and_end():
+    collector = OutputCollector()
+    collector.hook(stream("".join(f"{number:04d}\n" for number in range(200))))
+    whole = collector.text()
+    assert collector.text(1000) == whole
+    text = collector.text(100)
+    assert text.startswith("0000\n")
+    assert text.endswith("0199")
+    assert "characters omitted" in text
+    assert len(text) < 160
+
+
+def test_output_after_the_cap_is_not_added_to_the_notebook_outputs():
+    collector = OutputCollector(max_lines=2, keep_chars=5)
+    collector.hook(stream("a\n"))
+    collector.hook(message("display_data", data={"text/plain": "shown"}, metadata={}))
+    collector.hook(stream("b\nc\n"))
+    collector.hook(stream("after the cap\n"))
+    outputs = collector.notebook_outputs()
+    assert [output.output_type for output in outputs] == ["stream", "display_data", "stream"]
+    assert "output limit reached" in outputs[-1].text
+    #followed by the end of the output
+    assert outputs[-1].text.endswith("cap\n")
+
+
+def test_images_are_saved_and_referred_to_by_path(tmp_path):
+    directory = str(tmp_path / "outputs")
+    collector = OutputCollector(image_directory=directory)
+    png = b"\x89PNG\r\n\x1a\nfake"
+    collector.hook(message("display_data", data={"image/png": base64.b64encode(png).decode(), "text/plain": "<Figure>"}, metadata={}))
+    assert len(collector.images) == 1
+    path = collector.images[0]
+    assert path.startswith("outputs" + os.sep)
+    with open(os.path.join(str(tmp_path), path), 'rb') as f:
+        assert f.read() == png
+    assert collector.text() == f"[image: {path}]"
+    assert collector.notebook_outputs()[0].data == {"text/plain": f"[image: {path}]"}
@@ -0,0 +1,166 @@
+import io
+import os
+import hashlib
+import pytest
+from werkzeug.exceptions import RequestEntityTooLarge
+from Uploads import ChunkedUploads, HashingFile, INCOMING_DIRECTORY
+from SandboxManager import SandboxManager
+
+UUID = "0b1e6f2a-3c4d-4e5f-8a9b-0c1d2e3f4a5b"
+
+
+class BrokenStream:
+    '''
+    Request body that is cut off after some bytes, like a client that disconnects mid-chunk
+    '''
+    def __init__(self, data: bytes):
+        self.data = io.BytesIO(data)
+
+    def read(self, size: int):
+        chunk = self.data.read(size)
+        if not chunk:
+            raise OSError("connection reset")
+        return chunk
+
+
+@pytest.fixture
+def uploads(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return ChunkedUploads(max_size=1000)
+
+
+def test_chunks_are_appended_at_the_received_offset(uploads):
+    assert uploads.append(UUID, "a", 0, io.BytesIO(b"hello ")) == (True, 6)
+    assert uploads.append(UUID, "a", 6, io.BytesIO(b"world")) == (True, 11)
+    assert uploads.received(UUID, "a") == 11
+
+
+def test_chunk_at_the_wrong_offset_is_rejected(uploads):
+    uploads.append(UUID, "a", 0, io.BytesIO(b"hello "))
+    assert uploads.append(UUID, "a", 3, io.BytesIO(b"lo world")) == (False, 6)
+    assert uploads.append(UUID, "a", 0, io.BytesIO(b"hello ")) == (False, 6)
+    assert uploads.received(UUID, "a") == 6
+
+
+def test_interrupted_chunk_resumes_from_what_was_received(uploads, tmp_path):
+    with pytest.raises(OSError):
+        uploads.append(UUID, "a", 0, BrokenStream(b"partial"))
+    received = uploads.received(UUID, "a")
+    assert received == 7
+
+    assert uploads.append(UUID, "a", received, io.BytesIO(b" rest")) == (True, 12)
+    destination = str(tmp_path / "file.txt")
+    #the running hash was dropped when the chunk failed, so commit hashes the file from disk
+    assert uploads.commit(UUID, "a", destination) == hashlib.sha256(b"partial rest").hexdigest()
+
+
+def test_commit_moves_the_upload_and_returns_its_digest(uploads, tmp_path):
+    uploads.append(UUID, "a", 0, io.BytesIO(b"hello "))
+    uploads.append(UUID, "a", 6, io.BytesIO(b"world"))
+    destination = str(tmp_path / "file.txt")
+
+    assert uploads.commit(UUID, "a", destination) == hashlib.sha256(b"hello world").hexdigest()
+    with open(destination, 'rb') as f:
+        assert f.read() == b"hello world"
+    assert not os.path.exists(uploads.part_path(UUID, "a"))
+
+
+def test_committed_upload_id_cannot_be_reused(uploads, tmp_path):
+    uploads.append(UUID, "a", 0, io.BytesIO(b"hello world"))
+    destination = str(tmp_path / "file.txt")
+    uploads.commit(UUID, "a", destination)
+
+    #a retried first chunk must not start a new part that the final chunk would commit over the file
+    with pytest.raises(FileExistsError):
+        uploads.append(UUID, "a", 0, io.BytesIO(b""))
+    with pytest.raises(FileExistsError):
+        uploads.commit(UUID, "a", destination)
+    with pytest.raises(FileExistsError):
+        uploads.received(UUID, "a")
+    assert not os.path.exists(uploads.part_path(UUID, "a"))
+    with open(destination, 'rb') as f:
+        assert f.read() == b"hello world"
+
+
+def test_commit_of_an_upload_that_never_started(uploads, tmp_path):
+    with pytest.raises(FileNotFoundError):
+        uploads.commit(UUID, "missing", str(tmp_path / "file.txt"))
+
+
+def test_upload_over_the_size_limit_is_dropped(uploads):
+    uploads.append(UUID, "a", 0, io.BytesIO(b"x" * 600))
+    with pytest.raises(RequestEntityTooLarge):
+        uploads.append(UUID, "a", 600, io.BytesIO(b"x" * 600))
+    assert not os.path.exists(uploads.part_path(UUID, "a"))
+    assert uploads.received(UUID, "a") == 0
+
+
+def test_locks_are_dropped_once_no_request_uses_them(uploads, tmp_path):
+    uploads.append(UUID, "a", 0, io.BytesIO(b"hello"))
+    uploads.append(UUID, "a", 0, io.BytesIO(b"hello"))
+    with pytest.raises(RequestEntityTooLarge):
+        uploads.append(UUID, "b", 0, io.BytesIO(b"x" * 2000))
+    with pytest.raises(FileNotFoundError):
+        uploads.commit(UUID, "c", str(tmp_path / "c.txt"))
+    uploads.commit(UUID, "a", str(tmp_path / "a.txt"))
+    assert uploads.locks == {}
+
+
+def test_invalid_upload_ids_are_rejected(uploads):
+    with pytest.raises(ValueError):
+        uploads.append(UUID, "../escape", 0, io.BytesIO(b"x"))
+    with pytest.raises(ValueError):
+        uploads.received("../" + UUID, "a")
+
+
+def test_hashing_file_enforces_the_size_limit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    upload = HashingFile(max_size=10)
+    upload.write(b"0123456789")
+    with pytest.raises(RequestEntityTooLarge):
+        upload.write(b"x")
+    upload.close()
+    assert os.listdir(INCOMING_DIRECTORY) == []
+
+
+def test_hashing_file_commit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    upload = HashingFile()
+    upload.write(b"hello ")
+    upload.write(b"world")
+    destination = str(tmp_path / "file.txt")
+
+    assert upload.commit(destination) == hashlib.sha256(b"hello world").hexdigest()
+    upload.close()
+    with open(destination, 'rb') as f:
+        assert f.read() == b"hello world"
+
+
+def test_identical_uploads_are_stored_once(tmp_path):
+    sandboxes = SandboxManager(root=str(tmp_path / "uploads"))
+    digest = hashlib.sha256(b"same data").hexdigest()
+    paths = []
+    for name in ("first.csv", "second.csv"):
+        path = tmp_path / name
+        path.write_bytes(b"same data")
+        sandboxes.ingest(str(path), digest)
+        paths.append(str(path))
+
+    assert os.listdir(sandboxes.store_directory) == [digest]
+    assert os.stat(sandboxes.store_path(digest)).st_mode & 0o777 == 0o444
+
+    #each chat gets a copy of its own to change
+    first = sandboxes.prepare("chat-a", [paths[0]])
+    second = sandboxes.prepare("chat-b", [paths[1]])
+    with open(os.path.join(first, "first.csv"), 'wb') as f:
+        f.write(b"changed")
+    with open(os.path.join(second, "second.csv"), 'rb') as f:
+        assert f.read() == b"same data"
+    with open(sandboxes.store_path(digest), 'rb') as f:
+        assert f.read() == b"same data"
+
+    #the stored copy stays while another chat uses it
+    sandboxes.delete("chat-a", [paths[0]])
+    assert os.path.exists(sandboxes.store_path(digest))
+    sandboxes.delete("chat-b", [paths[1]])
+    assert not os.path.exists(sandboxes.store_path(digest))